@@ -0,0 +1,156 @@
+'''
+File:     audit_log.py
+Author:   Quangtri Thai
+Contents: Buffered SQL statement log written by a background thread, with rotation and batched fsyncs.
+'''
+
+import atexit
+import collections
+import os
+import threading
+import time
+
+# off: nothing is logged
+# sampled: one in sample_rate statements, with its parameters filled in
+# statement: every statement as written in the code, without its parameters
+# full: every statement with its parameters filled in, like the old sql_log.SQL
+AUDIT_LEVELS = ("off", "sampled", "statement", "full")
+
+# default rotation of the log file, see AuditLog
+MAX_BYTES = 16*1024*1024
+MAX_AGE = 24*60*60
+
+# Statements are appended to a bounded in-memory buffer, nothing else happens on the query's thread: the parameters
+# of the full and sampled levels are filled in by the writer thread. The writer thread drains the buffer every
+# flush_interval seconds (or sooner when it is half full) and writes and fsyncs the whole batch at once. When the writer
+# can't keep up the oldest statements are dropped.
+# The file is rotated to log_file.1 ... log_file.<backups> once it reaches max_bytes or is max_age seconds old (0 never).
+class AuditLog():
+  def __init__(self, log_file, level="statement", sample_rate=100, buffer_size=10000, flush_interval=1,
+               max_bytes=MAX_BYTES, max_age=MAX_AGE, backups=3):
+    self.log_file = log_file
+    self.level = level
+    self.sample_rate = max(1, sample_rate)
+    self.flush_interval = flush_interval
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.backups = backups
+    self.buffer = collections.deque(maxlen=buffer_size)
+    self.cond = threading.Condition()
+    self.statement_count = 0
+    self.dropped = 0
+    self.written = 0
+    self.closed = False
+    self.file = None
+    self.file_size = 0
+    self.file_time = 0
+    self.thread = None
+    if level != "off":
+      self.thread = threading.Thread(target=self.write_loop, name="audit-log", daemon=True)
+      self.thread.start()
+
+  # cmd_formats are filled in at the full and sampled levels, by render on the writer thread
+  def log(self, curs, cmd, cmd_formats=None):
+    if self.level == "off":
+      return
+    if self.level == "sampled":
+      self.statement_count += 1 # unlocked, a lost increment only shifts the sample
+      if self.statement_count % self.sample_rate != 0:
+        return
+    if self.level == "statement" or cmd_formats is None:
+      self.append(cmd)
+    else:
+      # copied, the caller may reuse its parameters once the statement ran
+      self.append((curs.connection, cmd, dict(cmd_formats) if isinstance(cmd_formats, dict) else tuple(cmd_formats)))
+
+  # a statement with its parameters quoted like psycopg2 sends them, through a cursor of its own on the connection
+  # the statement ran on. the parameters are written after the statement when the connection is closed by then
+  def render(self, statement):
+    if isinstance(statement, str):
+      return statement
+    connection, cmd, cmd_formats = statement
+    try:
+      return connection.cursor().mogrify(cmd, cmd_formats).decode("utf-8")
+    except Exception:
+      return f"{cmd}-- parameters: {cmd_formats!r}"
+
+  def append(self, statement):
+    with self.cond:
+      if len(self.buffer) == self.buffer.maxlen:
+        self.dropped += 1
+      self.buffer.append(statement)
+      if len(self.buffer) >= self.buffer.maxlen//2:
+        self.cond.notify()
+
+  def write_loop(self):
+    while True:
+      with self.cond:
+        if not self.closed and len(self.buffer) < self.buffer.maxlen//2:
+          self.cond.wait(self.flush_interval)
+        statements = list(self.buffer)
+        self.buffer.clear()
+        closed = self.closed
+      if statements:
+        self.write(statements)
+      if closed:
+        if self.file is not None:
+          self.file.close()
+          self.file = None
+        return
+
+  def write(self, statements):
+    if self.file is not None and (self.file_size >= self.max_bytes or
+                                  (self.max_age > 0 and time.time()-self.file_time >= self.max_age)):
+      self.rotate()
+    if self.file is None:
+      self.file = open(self.log_file, "a")
+      self.file_size = self.file.tell()
+      self.file_time = time.time()
+    data = "".join(self.render(statement) + "\n\n" for statement in statements)
+    self.file.write(data)
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.file_size += len(data)
+    self.written += len(statements)
+
+  def rotate(self):
+    self.file.close()
+    self.file = None
+    if self.backups <= 0:
+      open(self.log_file, "w").close()
+      return
+    for i in range(self.backups-1, 0, -1):
+      if os.path.exists(f"{self.log_file}.{i}"):
+        os.replace(f"{self.log_file}.{i}", f"{self.log_file}.{i+1}")
+    os.replace(self.log_file, f"{self.log_file}.1")
+
+  # writes out whatever is still buffered and stops the writer thread
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify()
+    if self.thread is not None:
+      self.thread.join()
+
+# every DBManager writing to the same file in this process shares one AuditLog
+audit_logs = {}
+audit_logs_lock = threading.Lock()
+
+# clear empties the file, only the first time it's opened in this process
+def open_audit_log(log_file, level="statement", clear=False, **options):
+  path = os.path.abspath(log_file)
+  with audit_logs_lock:
+    audit_log = audit_logs.get(path)
+    if audit_log is None:
+      if clear:
+        open(log_file, "w").close()
+      audit_log = audit_logs[path] = AuditLog(log_file, level, **options)
+  return audit_log
+
+def close_all():
+  with audit_logs_lock:
+    logs = list(audit_logs.values())
+  for audit_log in logs:
+    audit_log.close()
+
+atexit.register(close_all)
@@ -0,0 +1,111 @@
+'''
+File:     batch_benchmark.py
+Author:   Quangtri Thai
+Contents: Compares the memory per packet and append and COPY encoding throughput of a list of logs and a packet_batch.PacketBatch.
+'''
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import copy_stream
+import packet_batch
+import packet_extractor
+
+results_file = "batch_benchmark_results"
+
+def report(line):
+  global results_file
+  print(line)
+  results = open(results_file, "a")
+  results.write(line + "\n")
+  results.close()
+
+# logs shaped like the extractors', with addresses picked from hosts distinct ones
+def synthetic_logs(count, hosts):
+  random.seed(0)
+  addresses = [f"192.168.{i//256}.{i%256}" for i in range(hosts)]
+  protocols = ["TCP", "UDP", "DNS", "TLS", "HTTP", "ICMP"]
+  ts = time.time()
+  for i in range(count):
+    ts += random.expovariate(1000)
+    protocol = random.choice(protocols)
+    ports = (str(random.randint(1024, 65535)), str(random.choice((53, 80, 443, 8080)))) if protocol != "ICMP" else (None, None)
+    yield [ts, random.choice(addresses), ports[0], random.choice(addresses), ports[1], protocol, str(random.randint(60, 1514))]
+
+def copy_log(log):
+  return [value.encode("utf-8").decode("utf-8") if isinstance(value, str) else value+0.0 if isinstance(value, float) else value for value in log]
+
+# bytes still allocated after build(logs) made its container, and the container
+def measure_memory(make_logs, build):
+  tracemalloc.start()
+  container = build(make_logs())
+  retained = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return retained, container
+
+def build_list(logs):
+  batch = []
+  for log in logs:
+    batch.append(log)
+  return batch
+
+def build_batch(logs):
+  batch = packet_batch.PacketBatch()
+  for log in logs:
+    batch.append(log)
+  return batch
+
+# seconds to read every chunk
+def time_chunks(chunks):
+  start_time = time.time()
+  byte_count = 0
+  for chunk in chunks:
+    byte_count += len(chunk)
+  return time.time()-start_time, byte_count
+
+def main():
+  global results_file
+  parser = argparse.ArgumentParser()
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument("-pcap", help="Capture file to read the packets from")
+  source.add_argument("-packets", type=int, help="Number of synthetic packets to use instead of a capture file")
+  parser.add_argument("-hosts", type=int, default=200, help="Number of distinct addresses in the synthetic packets")
+  parser.add_argument("-extractor", default="raw", choices=packet_extractor.EXTRACTORS, help="Packet field extraction backend, with -pcap")
+  parser.add_argument("-num_runs", type=int, default=3, help="Number of times to time the appends and encodings")
+  args = parser.parse_args()
+
+  if args.pcap is not None:
+    # read once up front so extraction isn't part of the timings
+    logs = list(packet_extractor.make_extractor(args.extractor, None, args.pcap).logs())
+  else:
+    logs = list(synthetic_logs(args.packets, args.hosts))
+  # fresh copies of the logs for the memory runs, like an extractor makes new objects for every packet.
+  # a list of logs keeps them alive and the batch only keeps one copy of each distinct string
+  make_logs = lambda: (copy_log(log) for log in logs)
+  count = len(logs)
+
+  open(results_file, "w").close()
+  report(f"source: {args.pcap if args.pcap is not None else 'synthetic'} | packets: {count} | hosts: {args.hosts if args.pcap is None else '-'}")
+  if count == 0:
+    return
+
+  list_bytes, log_list = measure_memory(make_logs, build_list)
+  batch_bytes, batch = measure_memory(make_logs, build_batch)
+  report(f"memory per packet: list {list_bytes/count:0.1f} bytes | batch {batch_bytes/count:0.1f} bytes ({batch.nbytes()/count:0.1f} by nbytes, {len(batch.strings.values)-1} distinct strings)")
+
+  for i in range(1, args.num_runs+1):
+    report(f"\nrun {i}")
+    for name, build in (("list", build_list), ("batch", build_batch)):
+      start_time = time.time()
+      build(logs)
+      runtime = time.time()-start_time
+      report(f"{name} append: {count/runtime:0.0f} pkts/sec")
+    for name, chunks in (("list csv", copy_stream.csv_chunks(log_list)), ("batch csv", batch.csv_chunks()),
+                         ("list binary", copy_stream.binary_chunks(log_list, copy_stream.LOG_BATCH_TYPES)), ("batch binary", batch.binary_chunks())):
+      runtime, byte_count = time_chunks(chunks)
+      report(f"{name} encode: {count/runtime:0.0f} pkts/sec, {byte_count/count:0.1f} bytes/packet")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,102 @@
+'''
+File:     benchmark.py
+Author:   Quangtri Thai
+Contents: Replays a pcap through the monitor pipeline against a local Postgres and reports its throughput and latency.
+'''
+
+import time
+import argparse
+
+import audit_log
+import copy_stream
+import flush_queue
+import monitor
+import packet_extractor
+
+results_file = "benchmark_results"
+
+# Monitor that records how long each window takes to reach the db instead of drawing the dashboard
+class BenchmarkMonitor(monitor.Monitor):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.flush_latencies = [] # time spent in flush_batch
+    self.queue_delays = [] # window cut -> window in the db
+    self.capture_delays = [] # last packet of the window captured -> window in the db, only meaningful at -replay_speed 1
+    self.flushed_packets = 0
+
+  def flush_batch(self, db_manager, window, log_table):
+    start_time = time.time()
+    super().flush_batch(db_manager, window, log_table)
+    end_time = time.time()
+    with self.monitor_lock:
+      self.flush_latencies.append(end_time-start_time)
+      self.queue_delays.append(end_time-window.close_time)
+      self.capture_delays.append(end_time-window.end_ts)
+      self.flushed_packets += window.count
+
+def percentile(values, p):
+  if not values:
+    return 0
+  values = sorted(values)
+  return values[min(len(values)-1, int(round(p/100*(len(values)-1))))]
+
+def report(line):
+  global results_file
+  print(line)
+  results = open(results_file, "a")
+  results.write(line + "\n")
+  results.close()
+
+def main():
+  global results_file
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-pcap", required=True, help="Capture file to replay")
+  parser.add_argument("-replay_speed", type=float, default=0, help="Replay speed relative to the original timing. 0 replays as fast as possible")
+  parser.add_argument("-table_timewindow", required=True, help="Time window size of the table in mintues")
+  parser.add_argument("-summ_timewindow", required=True, help="Time window size of the summarization in seconds")
+  parser.add_argument("-log_table", required=True, help="Temporary table where the stream would be stored before being summarized")
+  parser.add_argument("-summ_table", required=True, help="Table where the stream is summarized to")
+  parser.add_argument("-user", required=True, help="User of the database")
+  parser.add_argument("-password", required=True, help="User's access password")
+  parser.add_argument("-host", required=True, help="Host database is located on")
+  parser.add_argument("-database", required=True, help="Name of the database")
+  parser.add_argument("-extractor", default="pyshark", choices=packet_extractor.EXTRACTORS, help="Packet field extraction backend")
+  parser.add_argument("-aggregate", default="stream", choices=("stream", "sql", "sketch"), help="Summarize flows in-process (stream), in Postgres (sql), or only the heaviest flows in fixed memory (sketch)")
+  parser.add_argument("-copy_mode", default="memory", choices=copy_stream.COPY_MODES, help="How batches are fed to COPY")
+  parser.add_argument("-keep_raw", action="store_true", help="With -aggregate stream, also write raw packets to log_table")
+  parser.add_argument("-flush_workers", type=int, default=0, help="Number of background flush threads. 0 flushes inline")
+  parser.add_argument("-queue_size", type=int, default=50000, help="Max number of packets buffered between capture and the flush workers")
+  parser.add_argument("-backpressure", default="block", choices=flush_queue.BACKPRESSURE_POLICIES, help="What to do with new packets when the queue is full")
+  parser.add_argument("-audit_level", default="statement", choices=audit_log.AUDIT_LEVELS, help="How much of the SQL sent to the database is logged to sql_log.SQL")
+  parser.add_argument("-shards", type=int, default=1, help="Number of processes parsing the capture in parallel, needs -extractor raw")
+  parser.add_argument("-num_runs", type=int, default=1, help="Number of times to replay the capture")
+  args = parser.parse_args()
+  if args.shards > 1 and args.extractor != "raw":
+    parser.error("-shards requires -extractor raw")
+
+  open(results_file, "w").close()
+  report(f"pcap: {args.pcap} | extractor: {args.extractor} | aggregate: {args.aggregate} | keep_raw: {args.keep_raw} | copy_mode: {args.copy_mode} | flush_workers: {args.flush_workers} | shards: {args.shards} | replay_speed: {args.replay_speed} | audit_level: {args.audit_level}")
+
+  for i in range(1, args.num_runs+1):
+    # timestamps are rebased so the capture delay is measured against the replay's own clock
+    bench = BenchmarkMonitor(None, float(args.table_timewindow), float(args.summ_timewindow), args.log_table, args.summ_table,
+                             args.user, args.password, args.host, args.database, 0, 1,
+                             args.flush_workers, args.queue_size, args.backpressure, 10, args.aggregate, args.keep_raw, args.extractor,
+                             args.pcap, args.replay_speed, True, args.copy_mode, None, args.audit_level, shards=args.shards)
+    start_time = time.time()
+    bench.run()
+    runtime = time.time()-start_time
+
+    report(f"\nrun {i}")
+    report(f"packets read: {bench.extractor.packet_count} | skipped: {bench.skip_count} | flushed: {bench.flushed_packets}")
+    if bench.packet_queue is not None:
+      report(f"queue max depth: {bench.packet_queue.max_depth} | dropped: {bench.packet_queue.dropped()}")
+    for shard in bench.extractor.shard_stats():
+      report(f"shard {shard['name']}: {shard['packets']} packets, {shard['dropped']} dropped")
+    report(f"runtime: {runtime:0.3f} secs | sustained: {bench.extractor.packet_count/runtime:0.1f} pkts/sec")
+    report(f"windows flushed: {len(bench.flush_latencies)}")
+    for name, values in (("flush latency", bench.flush_latencies), ("queue delay", bench.queue_delays), ("end-to-end delay", bench.capture_delays)):
+      report(f"{name}: p50 {percentile(values, 50):0.4f} | p95 {percentile(values, 95):0.4f} | max {percentile(values, 100):0.4f} secs")
+
+if __name__ == "__main__":
+  main()
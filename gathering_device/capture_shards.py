@@ -0,0 +1,161 @@
+'''
+File:     capture_shards.py
+Author:   Quangtri Thai
+Contents: Captures several interfaces, or one interface split by a BPF hash filter, in parallel processes feeding the monitor's single aggregator.
+'''
+
+import multiprocessing
+import queue
+import time
+import traceback
+
+import metrics
+import packet_batch
+import packet_extractor
+
+SHARD_PACKETS = metrics.gauge("shard_packets", "Packets parsed by each capture process since it started", ("shard",))
+SHARD_DROPPED = metrics.gauge("shard_dropped_packets", "Packets a capture process dropped because the aggregator fell behind", ("shard",))
+
+# BPF filter keeping shard's share of the traffic when shard_count processes sniff the same interface, and only
+# what capture_filter keeps when it is given.
+# Packets are split on the sum of the last 32 bits of their addresses, so both directions of a conversation go to
+# the same shard. Packets that aren't IP (ARP, 802.11 management frames, ...) all go to shard 0
+def shard_filter(shard, shard_count, capture_filter=None):
+  if shard_count == 1:
+    return capture_filter
+  ipv4 = f"(ip and (ip[12:4] + ip[16:4]) % {shard_count} = {shard})"
+  ipv6 = f"(ip6 and (ip6[20:4] + ip6[36:4]) % {shard_count} = {shard})"
+  if shard == 0:
+    shard_expr = f"{ipv4} or {ipv6} or not (ip or ip6)"
+  else:
+    shard_expr = f"{ipv4} or {ipv6}"
+  if capture_filter is None:
+    return shard_expr
+  return f"({capture_filter}) and ({shard_expr})"
+
+# Body of each capture process. Parses packets with its own extractor and puts them on out_queue in
+# packet_batch.PacketBatch encoding, batch_size packets at a time or every flush_interval seconds while packets come.
+# When the aggregator is batches behind, batches are dropped here instead of holding up the capture.
+# counters[2*shard_id] counts parsed packets and counters[2*shard_id+1] dropped ones
+def run_shard(shard_id, extractor_name, interface, pcap_file, capture_filter, file_shard, sample_rate, sample_mode, out_queue, counters,
+              batch_size, flush_interval):
+  try:
+    extractor = packet_extractor.make_extractor(extractor_name, interface, pcap_file, capture_filter=capture_filter,
+                                                sample_rate=sample_rate, sample_mode=sample_mode)
+    if file_shard is not None:
+      extractor.shard = file_shard
+    batch = packet_batch.PacketBatch()
+    flush_time = time.time()+flush_interval
+    for log in extractor.read_logs():
+      batch.append(log)
+      counters[2*shard_id] += 1
+      if len(batch) >= batch_size or time.time() >= flush_time:
+        if pcap_file is not None:
+          # a file doesn't drop packets when the aggregator is slow, it waits
+          out_queue.put((shard_id, batch.to_bytes()))
+        else:
+          try:
+            out_queue.put_nowait((shard_id, batch.to_bytes()))
+          except queue.Full:
+            counters[2*shard_id+1] += len(batch)
+        batch = packet_batch.PacketBatch()
+        flush_time = time.time()+flush_interval
+    if len(batch) > 0:
+      out_queue.put((shard_id, batch.to_bytes()))
+    out_queue.put((shard_id, None))
+  except Exception:
+    out_queue.put((shard_id, traceback.format_exc()))
+
+# Extractor that runs shard_count capture processes per interface, or shard_count processes reading every
+# shard_count-th record of pcap_file (raw extractor only), so the dissection of each one gets its own core.
+# Their packets are yielded here, on the monitor's process, which aggregates and flushes them all.
+# Packets of different shards come interleaved, a few milliseconds apart at most, not strictly in timestamp order.
+# Each process samples its own packets with sample_rate and sample_mode.
+class ShardedExtractor(packet_extractor.Extractor):
+  def __init__(self, extractor_name, interfaces=None, pcap_file=None, replay_speed=0, rebase_ts=False, shard_count=1,
+               capture_filter=None, sample_rate=1, sample_mode="count", queue_batches=64, batch_size=256, flush_interval=0.05):
+    super().__init__(None, pcap_file, replay_speed, rebase_ts, capture_filter)
+    if pcap_file is not None and shard_count > 1 and extractor_name != "raw":
+      raise ValueError("only the raw extractor can split a capture file between processes")
+    self.extractor_name = extractor_name
+    # (name, interface, capture filter, (index, count) of the file's records)
+    self.shards = []
+    if pcap_file is not None:
+      for i in range(shard_count):
+        self.shards.append((f"{pcap_file}/{i}", None, None, (i, shard_count) if shard_count > 1 else None))
+    else:
+      for interface in interfaces:
+        for i in range(shard_count):
+          name = interface if shard_count == 1 else f"{interface}/{i}"
+          self.shards.append((name, interface, shard_filter(i, shard_count, capture_filter), None))
+    self.name = f"{extractor_name} x{len(self.shards)}"
+    self.sample_rate = sample_rate
+    self.sample_mode = sample_mode
+    self.queue_batches = queue_batches
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    context = multiprocessing.get_context()
+    self.queue = context.Queue(queue_batches)
+    self.counters = context.Array("q", 2*len(self.shards), lock=False)
+    self.processes = []
+    self.rates = [(0, None)]*len(self.shards) # (packets, time) at the previous shard_stats call
+    for shard_id, shard in enumerate(self.shards):
+      SHARD_PACKETS.labels(shard[0]).function = lambda shard_id=shard_id: self.counters[2*shard_id]
+      SHARD_DROPPED.labels(shard[0]).function = lambda shard_id=shard_id: self.counters[2*shard_id+1]
+
+  def read_logs(self):
+    context = multiprocessing.get_context()
+    for shard_id, (name, interface, capture_filter, file_shard) in enumerate(self.shards):
+      process = context.Process(target=run_shard, name=f"capture-{name}", daemon=True,
+                                args=(shard_id, self.extractor_name, interface, self.pcap_file, capture_filter, file_shard,
+                                      self.sample_rate, self.sample_mode, self.queue, self.counters, self.batch_size, self.flush_interval))
+      process.start()
+      self.processes.append(process)
+    running = set(range(len(self.shards)))
+    try:
+      while running:
+        try:
+          shard_id, data = self.queue.get(timeout=1)
+        except queue.Empty:
+          for shard_id in list(running):
+            if not self.processes[shard_id].is_alive() and self.queue.empty():
+              raise RuntimeError(f"capture process {self.shards[shard_id][0]} exited with code {self.processes[shard_id].exitcode}")
+          continue
+        if data is None:
+          running.discard(shard_id)
+        elif isinstance(data, str):
+          raise RuntimeError(f"capture process {self.shards[shard_id][0]} failed:\n{data}")
+        else:
+          for log in packet_batch.PacketBatch.read_logs(data):
+            yield log
+    finally:
+      self.close()
+
+  # [{"name", "packets", "dropped", "pps"}, ...], pps since the previous call
+  def shard_stats(self):
+    cur_time = time.time()
+    stats = []
+    for shard_id, shard in enumerate(self.shards):
+      packets = self.counters[2*shard_id]
+      prev_packets, prev_time = self.rates[shard_id]
+      pps = (packets-prev_packets)/(cur_time-prev_time) if prev_time is not None and cur_time > prev_time else 0
+      self.rates[shard_id] = (packets, cur_time)
+      stats.append({"name": shard[0], "packets": packets, "dropped": self.counters[2*shard_id+1], "pps": pps})
+    return stats
+
+  def close(self):
+    for process in self.processes:
+      if process.is_alive():
+        process.terminate()
+    for process in self.processes:
+      process.join(1)
+
+# a plain extractor for one interface or capture file in this process, a ShardedExtractor otherwise
+def make_capture(name, interfaces=None, pcap_file=None, replay_speed=0, rebase_ts=False, shard_count=1, capture_filter=None,
+                 sample_rate=1, sample_mode="count"):
+  if isinstance(interfaces, str):
+    interfaces = [interfaces]
+  if shard_count <= 1 and (pcap_file is not None or len(interfaces) == 1):
+    return packet_extractor.make_extractor(name, interfaces[0] if interfaces else None, pcap_file, replay_speed, rebase_ts,
+                                           capture_filter, sample_rate, sample_mode)
+  return ShardedExtractor(name, interfaces, pcap_file, replay_speed, rebase_ts, shard_count, capture_filter, sample_rate, sample_mode)
@@ -0,0 +1,165 @@
+'''
+File:     copy_stream.py
+Author:   Quangtri Thai
+Contents: File-like adapters that feed rows from memory to COPY, in csv or PostgreSQL binary format, and a pipe between two COPYs.
+'''
+
+import csv
+import io
+import queue
+import struct
+
+COPY_MODES = ("memory", "binary", "csv")
+
+# column types of network_log_batch, in column order
+LOG_BATCH_TYPES = ("float8", "text", "int4", "text", "int4", "text", "int4")
+
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = struct.pack("!h", -1)
+
+# Read-only file object over an iterator of byte chunks, which is all copy_expert needs.
+# Chunks are produced lazily so only a chunk or two of the batch is ever encoded at once.
+class ChunkReader():
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.buffer = b""
+    self.offset = 0
+
+  def read(self, size=-1):
+    while size < 0 or len(self.buffer)-self.offset < size:
+      chunk = next(self.chunks, None)
+      if chunk is None:
+        break
+      self.buffer = self.buffer[self.offset:] + chunk
+      self.offset = 0
+    if size < 0:
+      size = len(self.buffer)-self.offset
+    data = self.buffer[self.offset:self.offset+size]
+    self.offset += len(data)
+    return data
+
+  def readline(self, size=-1):
+    end = self.buffer.find(b"\n", self.offset)
+    while end < 0:
+      chunk = next(self.chunks, None)
+      if chunk is None:
+        return self.read(size)
+      self.buffer = self.buffer[self.offset:] + chunk
+      self.offset = 0
+      end = self.buffer.find(b"\n")
+    return self.read(end+1-self.offset if size < 0 else min(size, end+1-self.offset))
+
+# csv chunks in the same format the csv files were written with: minimal quoting, None as an empty field
+def csv_chunks(rows, rows_per_chunk=1000):
+  chunk = io.StringIO()
+  writer = csv.writer(chunk, quoting=csv.QUOTE_MINIMAL, quotechar='"', delimiter=",", lineterminator="\r\n")
+  count = 0
+  for row in rows:
+    writer.writerow(row)
+    count += 1
+    if count == rows_per_chunk:
+      yield chunk.getvalue().encode("utf-8")
+      chunk.seek(0)
+      chunk.truncate()
+      count = 0
+  if count > 0:
+    yield chunk.getvalue().encode("utf-8")
+
+def csv_reader(rows):
+  return ChunkReader(csv_chunks(rows))
+
+# PostgreSQL binary COPY encoding. Each field is an int32 byte length (-1 for NULL) followed by the value.
+# An empty string is sent as NULL, like the empty field it is in the csv files, which COPY reads with NULL ''.
+def encode_float8(value):
+  return b"\x00\x00\x00\x08" + struct.pack("!d", float(value))
+
+def encode_int4(value):
+  return b"\x00\x00\x00\x04" + struct.pack("!i", int(value))
+
+def encode_text(value):
+  data = str(value).encode("utf-8")
+  return struct.pack("!i", len(data)) + data
+
+ENCODERS = {"float8": encode_float8, "int4": encode_int4, "text": encode_text}
+NULL_FIELD = struct.pack("!i", -1)
+
+def binary_chunks(rows, types, rows_per_chunk=1000):
+  encoders = [ENCODERS[t] for t in types]
+  field_count = struct.pack("!h", len(types))
+  yield BINARY_HEADER
+  chunk = []
+  count = 0
+  for row in rows:
+    chunk.append(field_count)
+    for encode, value in zip(encoders, row):
+      chunk.append(NULL_FIELD if value == None or value == "" else encode(value))
+    count += 1
+    if count == rows_per_chunk:
+      yield b"".join(chunk)
+      chunk = []
+      count = 0
+  chunk.append(BINARY_TRAILER)
+  yield b"".join(chunk)
+
+def binary_reader(rows, types=LOG_BATCH_TYPES):
+  return ChunkReader(binary_chunks(rows, types))
+
+# Bounded in-memory pipe between a COPY TO on one connection (writer thread) and a COPY FROM on another (reader).
+# Writes are coalesced into chunk_size chunks and at most max_chunks are buffered, so memory stays bounded
+# while both COPYs run at the same time.
+class ChunkPipe():
+  def __init__(self, max_chunks=16, chunk_size=65536):
+    self.chunks = queue.Queue(maxsize=max_chunks)
+    self.chunk_size = chunk_size
+    self.pending = bytearray()
+    self.reader = ChunkReader(self.read_chunks())
+    self.aborted = False
+    self.error = None
+    self.byte_count = 0
+
+  # writer side, called by copy_expert for COPY TO
+  def write(self, data):
+    if isinstance(data, str):
+      data = data.encode("utf-8")
+    self.pending += data
+    self.byte_count += len(data)
+    if len(self.pending) >= self.chunk_size:
+      self.put_chunk(bytes(self.pending))
+      self.pending = bytearray()
+    return len(data)
+
+  def put_chunk(self, chunk):
+    while True:
+      if self.aborted:
+        raise IOError("COPY pipe reader aborted")
+      try:
+        self.chunks.put(chunk, timeout=0.5)
+        return
+      except queue.Full:
+        pass
+
+  # writer side, signals the end of the data, or that the COPY TO failed with error
+  def close(self, error=None):
+    self.error = error
+    if self.pending and error is None:
+      self.put_chunk(bytes(self.pending))
+    self.pending = bytearray()
+    self.put_chunk(None)
+
+  # reader side, stops the writer when the COPY FROM fails
+  def abort(self):
+    self.aborted = True
+
+  def read_chunks(self):
+    while True:
+      chunk = self.chunks.get()
+      if chunk is None:
+        return
+      yield chunk
+
+  # reader side, called by copy_expert for COPY FROM
+  def read(self, size=-1):
+    return self.reader.read(size)
+
+  def readline(self, size=-1):
+    return self.reader.readline(size)
@@ -0,0 +1,102 @@
+'''
+File:     dashboard.py
+Author:   Quangtri Thai
+Contents: Draws a program's dashboard on its own thread, redrawing only the lines that changed, or writes it as JSON lines when headless.
+'''
+
+import json
+import sys
+import threading
+
+import metrics
+
+RENDER_SECONDS = metrics.histogram("render_seconds", "Time to take a snapshot of the stats and draw the dashboard or write its JSON line")
+
+# Every interval seconds, but no more than max_fps times a second, takes a snapshot with stats(max_rows) and
+# draws format_lines(snapshot, width) on screen, so the capture or poll loop never waits on the terminal.
+# Lines that are the same as on the previous frame are left alone instead of clearing and redrawing the screen.
+# With no screen (-headless) each snapshot is written to out as one line of JSON instead, and asciimatics
+# is never imported. stats is called from the renderer's thread, only read what is safe to read from there.
+class Renderer():
+  def __init__(self, stats, format_lines, interval=1, screen=None, out=None, max_fps=4, max_rows=10):
+    self.stats = stats
+    self.format_lines = format_lines
+    self.interval = max(interval, 1/max_fps)
+    self.screen = screen
+    self.out = out if out is not None else sys.stdout
+    self.max_rows = max_rows # flows in each JSON line, the screen's height otherwise
+    self.lines = [] # what is on the screen
+    self.stopped = threading.Event()
+    self.thread = None
+    self.error = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="renderer", daemon=True)
+    self.thread.start()
+
+  # draws one last frame so the final stats are shown, and raises what stopped the renderer if it failed
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+    if self.error is None:
+      self.render()
+    if self.error is not None:
+      raise self.error
+
+  def run(self):
+    try:
+      while not self.stopped.wait(self.interval):
+        self.render()
+    except Exception as e:
+      self.error = e
+
+  def render(self):
+    with RENDER_SECONDS.time():
+      if self.screen is None:
+        self.out.write(json.dumps(self.stats(self.max_rows), default=str) + "\n")
+        self.out.flush()
+        return
+      self.draw(self.format_lines(self.stats(self.screen.height), self.screen.width))
+
+  # prints the lines that changed since the last frame, padded to cover what was there before
+  def draw(self, lines):
+    screen = self.screen
+    lines = [line[:screen.width] for line in lines[:screen.height]]
+    for y, line in enumerate(lines):
+      previous = self.lines[y] if y < len(self.lines) else ""
+      if line != previous:
+        screen.print_at(line.ljust(len(previous)), 0, y)
+    for y in range(len(lines), len(self.lines)):
+      screen.print_at(" "*len(self.lines[y]), 0, y)
+    self.lines = lines
+    screen.refresh()
+
+# the header and rows of a flow table, cols is [name, width, ...] and each row a list of values
+def table_lines(cols, rows):
+  header_str = " | ".join("{0:{1}s}".format(cols[i], cols[i+1]) for i in range(0, len(cols), 2))
+  lines = [header_str, "-"*len(header_str)]
+  for row in rows:
+    fields = []
+    for i, value in enumerate(row):
+      data = "{:0.2f}".format(value) if isinstance(value, int) or isinstance(value, float) else str(value)
+      fields.append("{0:{1}s}".format(data, cols[i*2+1]))
+    lines.append(" | ".join(fields))
+  return lines
+
+def endpoint_str(address, port):
+  return address if port is None else f"{address}:{port}"
+
+# flows as DBManager.get_summ_pps_info and flow_tracker.FlowTracker.top return them, as dicts for the JSON lines
+def flow_dicts(pps_info):
+  return [{"src": info[0], "srcport": info[1], "dst": info[2], "dstport": info[3], "last_seen": info[4], "pps": info[5], "pps_margin": info[6]}
+          for info in pps_info]
+
+def flow_rows(flows):
+  return [[endpoint_str(flow["src"], flow["srcport"]), endpoint_str(flow["dst"], flow["dstport"]), flow["last_seen"], flow["pps"]] for flow in flows]
+
+# the flow table of a dashboard, with a +/- column for the 95% margin of each pps when the packets were sampled
+def flow_table_lines(cols, flows):
+  if any(flow["pps_margin"] for flow in flows):
+    return table_lines(cols + ["+/-", 8], [row + [flow["pps_margin"]] for row, flow in zip(flow_rows(flows), flows)])
+  return table_lines(cols, flow_rows(flows))
@@ -5,12 +5,28 @@ Contents: Class to access and query Postgres.
 '''
 
 import psycopg2
+import psycopg2.extras
 import csv
+import re
+import threading
 import time
 
+import audit_log
+import copy_stream
+import metrics
+import packet_batch
+import rollup
+import sketches
+import summary_merge
+
 # Manages the psql database, handling inserts, deletes, etc.
+# copy_mode controls how batches are fed to COPY: "memory" streams csv rows from memory,
+# "binary" streams PostgreSQL binary format (log batches only), "csv" goes through csv_file on disk for debugging.
+# Statements are logged to sql_log_file at audit_level (see audit_log.AUDIT_LEVELS) by a background writer,
+# which rotates the file at audit_max_bytes or every audit_max_age seconds.
 class DBManager():
-  def __init__(self, user, password, host, database, sql_log_file="sql_log.SQL", csv_file="log_batch.csv", clear_log=True):
+  def __init__(self, user, password, host, database, sql_log_file="sql_log.SQL", csv_file="log_batch.csv", clear_log=True, copy_mode="memory",
+               audit_level="statement", audit_max_bytes=audit_log.MAX_BYTES, audit_max_age=audit_log.MAX_AGE):
     self.user = user
     self.password = password
     self.host = host
@@ -21,152 +37,865 @@ class DBManager():
                                     database=self.database)
     self.sql_log_file = sql_log_file
     self.csv_file = csv_file
+    self.copy_mode = copy_mode
+    self.audit_log = audit_log.open_audit_log(self.sql_log_file, audit_level, clear=clear_log, max_bytes=audit_max_bytes, max_age=audit_max_age)
+    self.prepared = set() # names of the statements prepared on db_conn
 
-    if clear_log: open(self.sql_log_file, "w").close()
+  # cheap round trip to check the connection still works
+  def is_alive(self):
+    if self.db_conn.closed:
+      return False
+    try:
+      curs = self.db_conn.cursor()
+      curs.execute("SELECT 1")
+      self.db_conn.rollback()
+      return True
+    except psycopg2.Error:
+      return False
 
-  def insert_log(self, table, log):
-    sql_log = open(self.sql_log_file, "a")
+  def reconnect(self):
+    self.close()
+    self.db_conn = psycopg2.connect(user=self.user,
+                                    password=self.password,
+                                    host=self.host,
+                                    database=self.database)
+    self.prepared = set()
 
+  def close(self):
+    if not self.db_conn.closed:
+      self.db_conn.close()
+
+  def insert_log(self, table, log):
     cmd = """
     INSERT INTO {table} VALUES(%(ts)s, %(src)s, %(srcport)s, %(dst)s, %(dstport)s, %(protocol)s, %(len)s)
     """.format(table=table)
     cmd_formats = {"ts": log[0], "src": log[1], "srcport": log[2], "dst": log[3], "dstport": log[4], "protocol": log[5], "len": log[6]}
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
 
   def clear_log_table(self, table, clear_ts=None):
-    sql_log = open(self.sql_log_file, "a")
-
     if clear_ts != None:
       cmd = """
       DELETE FROM {table} WHERE timestamp <= %(ts)s
       """.format(table=table)
     else:
+      # TRUNCATE leaves no dead rows behind for autovacuum
       cmd = """
-      DELETE FROM {table}
+      TRUNCATE {table}
       """.format(table=table)
     cmd_formats = {"ts": clear_ts}
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
 
   def clear_summ_table(self, table, clear_ts=None):
-    sql_log = open(self.sql_log_file, "a")
-
     if clear_ts != None:
       cmd = """
       DELETE FROM {table} WHERE min_timestamp <= %(ts)s
       """.format(table=table)
     else:
+      # TRUNCATE leaves no dead rows behind for autovacuum
       cmd = """
-      DELETE FROM {table}
+      TRUNCATE {table}
       """.format(table=table)
     cmd_formats = {"ts": clear_ts}
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+
+  # creates a session-private copy of table, used as a staging table by concurrent flushers
+  def create_temp_log_table(self, table, temp_table):
+    cmd = """
+    CREATE TEMP TABLE IF NOT EXISTS {temp_table} (LIKE {table} INCLUDING ALL)
+    """.format(table=table, temp_table=temp_table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+    return temp_table
+
+  # the raw packet table. when it is only a staging table for summarize_table it is unlogged and emptied with TRUNCATE,
+  # when raw packets are kept for table_timewindow it is partitioned on timestamp for retention.RetentionManager.
+  # packets of several interfaces or capture shards can have the same timestamp, so it isn't unique
+  def create_log_table(self, table, partitioned=False):
+    cmd = """
+    CREATE {unlogged}TABLE IF NOT EXISTS {table}(
+      timestamp double precision not null,
+      src text not null,
+      srcport integer,
+      dst text not null,
+      dstport integer,
+      protocol text,
+      length integer
+    ){partition_by}
+    """.format(table=table, unlogged="" if partitioned else "UNLOGGED ", partition_by=" PARTITION BY RANGE (timestamp)" if partitioned else "")
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    # tables made by an older version still have the unique constraint
+    cmd = """
+    ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_timestamp_key
+    """.format(table=table)
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+
+  # the summary table, partitioned on min_timestamp for retention.RetentionManager.
+  # the master's copy also records which gathering device (sensor) and row there (sensor_id) each row came from,
+  # a partitioned table's unique constraints have to include min_timestamp
+  def create_summary_table(self, summ_table, master=False):
+    cmd = """
+    CREATE TABLE IF NOT EXISTS {summ_table}(
+      id serial,
+      min_timestamp double precision not null,
+      max_timestamp double precision not null,
+      src text not null,
+      srcport integer,
+      dst text not null,
+      dstport integer,
+      protocol text,
+      min_length integer,
+      max_length integer,
+      avg_length numeric,
+      summ_size integer,
+      sample_rate integer not null default 1,{master_columns}
+      primary key (id, min_timestamp)
+    ) PARTITION BY RANGE (min_timestamp)
+    """.format(summ_table=summ_table, master_columns="""
+      sensor text,
+      sensor_id integer,
+      unique (sensor, sensor_id, min_timestamp),""" if master else "")
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    # tables created before packets could be sampled
+    cmd = """
+    ALTER TABLE {summ_table} ADD COLUMN IF NOT EXISTS sample_rate integer not null default 1
+    """.format(summ_table=summ_table)
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    if master:
+      # a master table made by hand from an older README has no sensor columns, and merge_summary_staging_table's
+      # ON CONFLICT needs the unique index to skip re-sent rows. the index is named like the constraint
+      # CREATE TABLE makes, so it isn't made twice
+      cmd = """
+      ALTER TABLE {summ_table} ADD COLUMN IF NOT EXISTS sensor text, ADD COLUMN IF NOT EXISTS sensor_id integer
+      """.format(summ_table=summ_table)
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+      cmd = """
+      CREATE UNIQUE INDEX IF NOT EXISTS {summ_table}_sensor_sensor_id_min_timestamp_key ON {summ_table}(sensor, sensor_id, min_timestamp)
+      """.format(summ_table=summ_table)
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+    self.db_conn.commit()
+
+  # rollup tables for get_summ_pps_info (see rollup.py), an index for the newest timestamp of the summary table,
+  # and rollup_state, the master's watermark of the summary rows already rolled up
+  def create_rollup_tables(self, summ_table):
+    curs = self.db_conn.cursor()
+    for size in rollup.ROLLUP_SIZES:
+      cmd = """
+      CREATE TABLE IF NOT EXISTS {rollup_table}(
+        bucket double precision not null,
+        src text not null,
+        srcport integer not null,
+        dst text not null,
+        dstport integer not null,
+        packets bigint not null,
+        last_ts double precision not null,
+        variance double precision not null default 0,
+        primary key (bucket, src, srcport, dst, dstport)
+      ) PARTITION BY RANGE (bucket)
+      """.format(rollup_table=rollup.rollup_table(summ_table, size))
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+      cmd = """
+      ALTER TABLE {rollup_table} ADD COLUMN IF NOT EXISTS variance double precision not null default 0
+      """.format(rollup_table=rollup.rollup_table(summ_table, size))
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+    cmd = """
+    CREATE INDEX IF NOT EXISTS {summ_table}_max_timestamp_idx ON {summ_table}(max_timestamp)
+    """.format(summ_table=summ_table)
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    cmd = """
+    CREATE TABLE IF NOT EXISTS rollup_state(
+      summ_table text primary key,
+      last_id bigint not null
+    )
+    """
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+
+  # rollups is {size: rollup.rollup_rows(...)}, each row is added to the bucket's counts
+  def insert_rollups(self, summ_table, rollups, until_id=None):
+    curs = self.db_conn.cursor()
+    for size, rows in rollups.items():
+      cmd = """
+      INSERT INTO {rollup_table} AS r(bucket, src, srcport, dst, dstport, packets, last_ts, variance) VALUES %s
+      ON CONFLICT (bucket, src, srcport, dst, dstport)
+      DO UPDATE SET packets = r.packets+excluded.packets, last_ts = greatest(r.last_ts, excluded.last_ts),
+        variance = r.variance+excluded.variance
+      """.format(rollup_table=rollup.rollup_table(summ_table, size))
+      self.audit_log.log(curs, cmd)
+      psycopg2.extras.execute_values(curs, cmd, rows, page_size=1000)
+    if until_id is not None:
+      cmd = """
+      INSERT INTO rollup_state VALUES(%(summ_table)s, %(until_id)s)
+      ON CONFLICT (summ_table) DO UPDATE SET last_id = excluded.last_id
+      """
+      cmd_formats = {"summ_table": summ_table, "until_id": until_id}
+      self.audit_log.log(curs, cmd, cmd_formats)
+      curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+
+  def get_rollup_watermark(self, summ_table):
+    cmd = """
+    SELECT last_id FROM rollup_state WHERE summ_table = %(summ_table)s
+    """
+    cmd_formats = {"summ_table": summ_table}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    row = curs.fetchone()
+    return 0 if row is None else row[0]
+
+  # the master's deduplicated flow view, see summary_merge.SummaryMerger. its watermark is kept in rollup_state
+  # under the merged table's name
+  def create_merge_tables(self, summ_table):
+    cmd = """
+    CREATE TABLE IF NOT EXISTS {sensor_table}(
+      bucket double precision not null,
+      src text not null,
+      srcport integer not null,
+      dst text not null,
+      dstport integer not null,
+      protocol text not null,
+      sensor text not null,
+      min_timestamp double precision not null,
+      max_timestamp double precision not null,
+      min_length integer,
+      max_length integer,
+      length_sum double precision not null,
+      length_weight double precision not null,
+      packets double precision not null,
+      variance double precision not null,
+      primary key (bucket, src, srcport, dst, dstport, protocol, sensor)
+    ) PARTITION BY RANGE (bucket)
+    """.format(sensor_table=summary_merge.sensor_table(summ_table))
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    cmd = """
+    CREATE TABLE IF NOT EXISTS {merged_table}(
+      bucket double precision not null,
+      src text not null,
+      srcport integer not null,
+      dst text not null,
+      dstport integer not null,
+      protocol text not null,
+      min_timestamp double precision not null,
+      max_timestamp double precision not null,
+      min_length integer,
+      max_length integer,
+      avg_length double precision,
+      packets double precision not null,
+      variance double precision not null,
+      sensors text[] not null,
+      primary key (bucket, src, srcport, dst, dstport, protocol)
+    ) PARTITION BY RANGE (bucket)
+    """.format(merged_table=summary_merge.merged_table(summ_table))
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+
+  # rows are summary_merge.sensor_bucket_rows(...), added to each sensor's counts. the global rows of the buckets
+  # and flows they touch are then merged again from every sensor's counts: packets and their variance are the
+  # sensor's that saw the most packets, since sensors with overlapping coverage see the same ones, the timestamps
+  # and lengths span all of them, and sensors lists who saw the flow
+  def merge_summary(self, summ_table, rows, until_id=None):
+    sensor_table = summary_merge.sensor_table(summ_table)
+    merged_table = summary_merge.merged_table(summ_table)
+    curs = self.db_conn.cursor()
+    cmd = """
+    INSERT INTO {sensor_table} AS s(bucket, src, srcport, dst, dstport, protocol, sensor, min_timestamp, max_timestamp,
+      min_length, max_length, length_sum, length_weight, packets, variance) VALUES %s
+    ON CONFLICT (bucket, src, srcport, dst, dstport, protocol, sensor)
+    DO UPDATE SET min_timestamp = least(s.min_timestamp, excluded.min_timestamp), max_timestamp = greatest(s.max_timestamp, excluded.max_timestamp),
+      min_length = least(s.min_length, excluded.min_length), max_length = greatest(s.max_length, excluded.max_length),
+      length_sum = s.length_sum+excluded.length_sum, length_weight = s.length_weight+excluded.length_weight,
+      packets = s.packets+excluded.packets, variance = s.variance+excluded.variance
+    """.format(sensor_table=sensor_table)
+    self.audit_log.log(curs, cmd)
+    psycopg2.extras.execute_values(curs, cmd, rows, page_size=1000)
+    cmd = """
+    INSERT INTO {merged_table} AS m(bucket, src, srcport, dst, dstport, protocol, min_timestamp, max_timestamp,
+      min_length, max_length, avg_length, packets, variance, sensors)
+    SELECT bucket, src, srcport, dst, dstport, protocol, min(min_timestamp), max(max_timestamp),
+      min(min_length), max(max_length), sum(length_sum)/nullif(sum(length_weight), 0),
+      max(packets), (array_agg(variance ORDER BY packets DESC))[1], array_agg(sensor ORDER BY sensor)
+    FROM {sensor_table} JOIN (VALUES %s) AS touched(bucket, src, srcport, dst, dstport, protocol) USING (bucket, src, srcport, dst, dstport, protocol)
+    GROUP BY bucket, src, srcport, dst, dstport, protocol
+    ON CONFLICT (bucket, src, srcport, dst, dstport, protocol)
+    DO UPDATE SET min_timestamp = excluded.min_timestamp, max_timestamp = excluded.max_timestamp, min_length = excluded.min_length,
+      max_length = excluded.max_length, avg_length = excluded.avg_length, packets = excluded.packets, variance = excluded.variance,
+      sensors = excluded.sensors
+    """.format(sensor_table=sensor_table, merged_table=merged_table)
+    self.audit_log.log(curs, cmd)
+    touched = sorted(set(row[:6] for row in rows))
+    psycopg2.extras.execute_values(curs, cmd, touched, template="(%s::double precision, %s, %s::integer, %s, %s::integer, %s)", page_size=1000)
+    if until_id is not None:
+      cmd = """
+      INSERT INTO rollup_state VALUES(%(summ_table)s, %(until_id)s)
+      ON CONFLICT (summ_table) DO UPDATE SET last_id = excluded.last_id
+      """
+      cmd_formats = {"summ_table": merged_table, "until_id": until_id}
+      self.audit_log.log(curs, cmd, cmd_formats)
+      curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+
+  # one serialized sketches.FlowSketch per summary window with -aggregate sketch, partitioned like the summary table
+  def create_sketch_table(self, summ_table):
+    cmd = """
+    CREATE TABLE IF NOT EXISTS {sketch_table}(
+      id serial,
+      min_timestamp double precision not null,
+      max_timestamp double precision not null,
+      packets bigint not null,
+      distinct_src integer not null,
+      distinct_dst integer not null,
+      distinct_dstport integer not null,
+      sketch bytea not null,
+      primary key (id, min_timestamp)
+    ) PARTITION BY RANGE (min_timestamp)
+    """.format(sketch_table=sketches.sketch_table(summ_table))
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+
+  def insert_sketch(self, summ_table, sketch):
+    cmd = """
+    INSERT INTO {sketch_table}(min_timestamp, max_timestamp, packets, distinct_src, distinct_dst, distinct_dstport, sketch)
+    VALUES(%(min_ts)s, %(max_ts)s, %(packets)s, %(distinct_src)s, %(distinct_dst)s, %(distinct_dstport)s, %(sketch)s)
+    """.format(sketch_table=sketches.sketch_table(summ_table))
+    distinct_src, distinct_dst, distinct_dstport = sketch.distinct_counts()
+    cmd_formats = {"min_ts": sketch.min_ts, "max_ts": sketch.max_ts, "packets": sketch.packets, "distinct_src": distinct_src,
+                   "distinct_dst": distinct_dst, "distinct_dstport": distinct_dstport, "sketch": psycopg2.Binary(sketch.to_bytes())}
+    curs = self.db_conn.cursor()
+    # the serialized sketch is too big to be worth logging
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+
+  # the newest sketch with id > since_id as (id, serialized sketch), None if there is none
+  def get_latest_sketch(self, summ_table, since_id):
+    cmd = """
+    SELECT id, sketch FROM {sketch_table} WHERE id > %(since_id)s ORDER BY id DESC LIMIT 1
+    """.format(sketch_table=sketches.sketch_table(summ_table))
+    cmd_formats = {"since_id": since_id}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    row = curs.fetchone()
+    return None if row is None else (row[0], bytes(row[1]))
+
+  def is_partitioned(self, table):
+    cmd = """
+    SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%(table)s))
+    """
+    cmd_formats = {"table": table}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    return curs.fetchone()[0]
+
+  # returns [(partition, lower bound, upper bound), ...], the bounds are None for partitions that aren't a plain range
+  def get_partitions(self, table):
+    cmd = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%(table)s)
+    """
+    cmd_formats = {"table": table}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    partitions = []
+    for partition, bound in curs.fetchall():
+      # e.g. FOR VALUES FROM ('300') TO ('600')
+      match = re.match(r"FOR VALUES FROM \('?([^')]+)'?\) TO \('?([^')]+)'?\)", bound or "")
+      try:
+        partitions.append((partition, float(match.group(1)), float(match.group(2))))
+      except (AttributeError, ValueError):
+        partitions.append((partition, None, None))
+    return partitions
+
+  def create_partition(self, table, partition, lower, upper, unlogged=False):
+    cmd = """
+    CREATE {unlogged}TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES FROM (%(lower)s) TO (%(upper)s)
+    """.format(table=table, partition=partition, unlogged="UNLOGGED " if unlogged else "")
+    cmd_formats = {"lower": lower, "upper": upper}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+
+  # with detach the partition's rows are kept in a table of their own, for archiving. it's renamed to
+  # <partition>_detached_<n> in the same transaction, so a partition for the same range can be created again
+  # when late rows (a spool replayed after an outage) need one
+  def drop_partition(self, table, partition, detach=False):
+    curs = self.db_conn.cursor()
+    if detach:
+      cmd = """
+      ALTER TABLE {table} DETACH PARTITION {partition}
+      """.format(table=table, partition=partition)
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+      cmd = """
+      SELECT relname FROM pg_class WHERE relname LIKE %(pattern)s
+      """
+      cmd_formats = {"pattern": partition + "\\_detached\\_%"}
+      self.audit_log.log(curs, cmd, cmd_formats)
+      curs.execute(cmd, cmd_formats)
+      suffixes = [name[len(partition)+len("_detached_"):] for (name,) in curs.fetchall()]
+      count = max([int(suffix) for suffix in suffixes if suffix.isdigit()] + [0])
+      cmd = """
+      ALTER TABLE {partition} RENAME TO {partition}_detached_{n}
+      """.format(partition=partition, n=count+1)
+    else:
+      cmd = """
+      DROP TABLE IF EXISTS {partition}
+      """.format(partition=partition)
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+
+  # rows of a summary table's partition for summary_archive.SummaryArchiver, oldest first
+  def get_archive_rows(self, table, columns):
+    cmd = """
+    SELECT {columns} FROM {table} ORDER BY min_timestamp
+    """.format(columns=", ".join(columns), table=table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+    return curs.fetchall()
+
+  # delete_older_rows for summary_archive.SummaryArchiver: the rows are deleted and returned by one statement, so a row
+  # inserted meanwhile is either archived and deleted or neither, and the delete only commits once write(rows) has
+  # stored them. if write fails, the rows stay for the next try
+  def delete_archive_rows(self, table, columns, column, clear_ts, write):
+    cmd = """
+    DELETE FROM {table} WHERE {column} <= %(ts)s RETURNING {columns}
+    """.format(table=table, column=column, columns=", ".join(columns))
+    cmd_formats = {"ts": clear_ts}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    try:
+      curs.execute(cmd, cmd_formats)
+      rows = curs.fetchall()
+      if rows:
+        write(rows)
+    except Exception:
+      self.db_conn.rollback()
+      raise
+    self.db_conn.commit()
+
+  # row by row retention, for tables that aren't partitioned
+  def delete_older_rows(self, table, column, clear_ts):
+    cmd = """
+    DELETE FROM {table} WHERE {column} <= %(ts)s
+    """.format(table=table, column=column)
+    cmd_formats = {"ts": clear_ts}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
 
+  # log_batch is a list of logs or a packet_batch.PacketBatch, which is encoded straight from its columns
   def insert_log_batch(self, table, log_batch):
-    # write log_batch to csv
+    columnar = isinstance(log_batch, packet_batch.PacketBatch)
+    if self.copy_mode == "binary":
+      cmd = """
+      COPY {table} FROM stdin WITH (FORMAT binary)
+      """.format(table=table)
+      self.copy_rows(cmd, log_batch.binary_reader() if columnar else copy_stream.binary_reader(log_batch))
+      return
+
+    cmd = """
+    COPY {table} FROM stdin WITH DELIMITER AS ',' csv QUOTE '\"' ESCAPE '\"' NULL ''
+    """.format(table=table)
+    if columnar and self.copy_mode == "memory":
+      self.copy_rows(cmd, log_batch.csv_reader())
+      return
+    self.copy_csv_rows(cmd, log_batch)
+
+  # copies already summarized rows (see flow_aggregator.SUMMARY_COLUMNS) straight into summ_table and returns them.
+  # with with_ids the rows' ids are taken from the table's sequence up front, and the rows are returned with their id appended
+  def insert_summary_batch(self, summ_table, summ_rows, with_ids=False):
+    self.lock_summary_ids(summ_table)
+    if with_ids:
+      ids = self.reserve_summary_ids(summ_table, len(summ_rows))
+      summ_rows = [tuple(row) + (summ_id,) for row, summ_id in zip(summ_rows, ids)]
+      cmd = """
+      COPY {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, id)
+      FROM stdin WITH DELIMITER AS ',' csv QUOTE '\"' ESCAPE '\"' NULL ''
+      """.format(summ_table=summ_table)
+      self.copy_csv_rows(cmd, summ_rows)
+      return summ_rows
+
+    cmd = """
+    COPY {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate)
+    FROM stdin WITH DELIMITER AS ',' csv QUOTE '\"' ESCAPE '\"' NULL ''
+    """.format(summ_table=summ_table)
+    self.copy_csv_rows(cmd, summ_rows)
+    return summ_rows
+
+  # A summary row's id is taken from the sequence when it is inserted, but the row is only seen once its transaction
+  # commits. Two writers committing out of order would let a reader's max(id) watermark (see get_new_summary_range)
+  # pass the ids of rows that are still being written, and those rows would never be shipped or rolled up.
+  # Every insert into a summary table takes this lock before its ids are drawn and holds it until it commits,
+  # so the ids become visible in order and max(id) is a safe watermark.
+  def lock_summary_ids(self, summ_table):
+    cmd = """
+    SELECT pg_advisory_xact_lock(hashtext(%(summ_table)s))
+    """
+    cmd_formats = {"summ_table": summ_table}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+
+  def reserve_summary_ids(self, summ_table, count):
+    cmd = """
+    SELECT nextval(pg_get_serial_sequence(%(summ_table)s, 'id')) FROM generate_series(1, %(count)s)
+    """
+    cmd_formats = {"summ_table": summ_table, "count": count}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    return [row[0] for row in curs.fetchall()]
+
+  # feeds rows to a csv COPY, from memory or through csv_file when copy_mode is "csv"
+  def copy_csv_rows(self, cmd, rows):
+    if self.copy_mode != "csv":
+      self.copy_rows(cmd, copy_stream.csv_reader(rows))
+      return
+
+    # write rows to csv
     with open(self.csv_file, "w") as csv_log:
       writer = csv.writer(csv_log, quoting=csv.QUOTE_MINIMAL, quotechar='"', delimiter=",", lineterminator="\r\n")
-      for log in log_batch:
-        writer.writerow(log)
+      for row in rows:
+        writer.writerow(row)
 
     # copy csv to table
-    sql_log = open(self.sql_log_file, "a")
+    with open(self.csv_file) as csv_log:
+      self.copy_rows(cmd, csv_log)
 
-    cmd = """
-    COPY {table} FROM stdin WITH DELIMITER AS ',' csv QUOTE '\"' ESCAPE '\"' NULL ''
-    """.format(table=table)
+  def copy_rows(self, cmd, reader):
     curs = self.db_conn.cursor()
-    sql_log.write(cmd + "\n\n")
-    sql_log.close()
-    curs.copy_expert(cmd, open(self.csv_file))
-    self.db_conn.commit()
-
-  def summarize_table(self, log_table, summ_table):
-    sql_log = open(self.sql_log_file, "a")
-
-    cmd = """
-    INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size)
-    SELECT
-      min(timestamp),
-      max(timestamp),
-      src,
-      srcport,
-      dst,
-      dstport,
-      protocol,
-      min(length),
-      max(length),
-      avg(length),
-      count(*)
-    FROM {log_table}
-    GROUP BY src, srcport, dst, dstport, protocol
+    self.audit_log.log(curs, cmd)
+    curs.copy_expert(cmd, reader, size=65536)
+    self.db_conn.commit()
+
+  # with returning, the new summary rows are returned with their id appended.
+  # sample_rate is recorded with the rows when log_table holds 1 in sample_rate of the packets.
+  # lock_summary_ids' lock is taken once the GROUP BY is done (id_lock needs all of summary's rows), and before the
+  # first row is inserted (every inserted row needs id_lock's), so concurrent flushers still group their windows in parallel
+  def summarize_table(self, log_table, summ_table, returning=False, sample_rate=1):
+    cmd = """
+    WITH summary AS (
+      SELECT
+        min(timestamp),
+        max(timestamp),
+        src,
+        srcport,
+        dst,
+        dstport,
+        protocol,
+        min(length),
+        max(length),
+        avg(length),
+        count(*),
+        %(sample_rate)s
+      FROM {log_table}
+      GROUP BY src, srcport, dst, dstport, protocol
+    ), id_lock AS (
+      SELECT pg_advisory_xact_lock(hashtext(%(summ_table)s)) FROM (SELECT count(*) FROM summary) AS summary_count
+    )
+    INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate)
+    SELECT summary.* FROM summary, id_lock
     """.format(log_table=log_table, summ_table=summ_table)
-    cmd_formats = {}
+    if returning:
+      cmd += "RETURNING min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, id\n"
+    cmd_formats = {"sample_rate": sample_rate, "summ_table": summ_table}
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
+    if returning:
+      return curs.fetchall()
 
   def get_row_count(self, table):
-    sql_log = open(self.sql_log_file, "a")
-
     cmd = """
     SELECT count(*) FROM {table}
     """.format(table=table)
     cmd_formats = {}
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
     return curs.fetchone()[0]
 
-  def copy_summary_to_csv(self, summ_table, csv_file=None):
+  # returns (max id, row count) of the summary rows with id > since_id, max id is since_id when there are none.
+  # no row with a lower id can still show up later, see lock_summary_ids
+  def get_new_summary_range(self, summ_table, since_id):
+    cmd = """
+    SELECT coalesce(max(id), %(since_id)s), count(*) FROM {summ_table} WHERE id > %(since_id)s
+    """.format(summ_table=summ_table)
+    cmd_formats = {"since_id": since_id}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    return curs.fetchone()
+
+  # the min_timestamps of the summary rows with since_id < id <= until_id
+  def get_summary_time_range(self, summ_table, since_id, until_id):
+    cmd = """
+    SELECT min(min_timestamp), max(min_timestamp) FROM {summ_table} WHERE id > %(since_id)s AND id <= %(until_id)s
+    """.format(summ_table=summ_table)
+    cmd_formats = {"since_id": since_id, "until_id": until_id}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    return curs.fetchone()
+
+  # with since_id, only the rows with since_id < id <= until_id are copied, tagged with
+  # the sensor they came from and their id on that sensor so the receiver can apply them idempotently
+  def copy_summary_to_csv(self, summ_table, csv_file=None, since_id=None, until_id=None, sensor=None):
     if csv_file == None: csv_file = self.csv_file
     curs = self.db_conn.cursor()
 
+    if since_id == None:
+      with open(csv_file, "w") as csv_summ:
+        curs.copy_to(csv_summ, summ_table, sep=",",\
+          columns=("min_timestamp", "max_timestamp", "src", "srcport", "dst", "dstport", "protocol", "min_length", "max_length", "avg_length", "summ_size", "sample_rate"))
+      self.db_conn.commit()
+      return
+
+    cmd = self.new_summary_copy_cmd(summ_table, since_id, until_id, sensor)
     with open(csv_file, "w") as csv_summ:
-      curs.copy_to(csv_summ, summ_table, sep=",",\
-        columns=("min_timestamp", "max_timestamp", "src", "srcport", "dst", "dstport", "protocol", "min_length", "max_length", "avg_length", "summ_size"))
+      curs.copy_expert(cmd, csv_summ)
     self.db_conn.commit()
 
-  def copy_summary_from_csv(self, summ_table, csv_file=None):
+  def new_summary_copy_cmd(self, summ_table, since_id, until_id, sensor):
+    cmd = """
+    COPY (
+      SELECT min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, %(sensor)s, id
+      FROM {summ_table}
+      WHERE id > %(since_id)s AND id <= %(until_id)s
+      ORDER BY id
+    ) TO STDOUT WITH DELIMITER AS ','
+    """.format(summ_table=summ_table)
+    cmd_formats = {"sensor": sensor, "since_id": since_id, "until_id": until_id}
+    curs = self.db_conn.cursor()
+    cmd = curs.mogrify(cmd, cmd_formats).decode("utf-8")
+    self.audit_log.log(curs, cmd)
+    return cmd
+
+  # Copies the summary rows with since_id < id <= until_id straight into remote_dbmanager's summ_table.
+  # COPY TO on this connection runs in a thread feeding COPY FROM on the remote connection through a bounded
+  # in-memory pipe, so both run at the same time and nothing is written to disk. Rows are applied idempotently
+  # like copy_summary_from_csv with deduplicate. Returns the number of bytes transferred.
+  def copy_summary_to_db(self, remote_dbmanager, summ_table, since_id, until_id, sensor):
+    cmd = self.new_summary_copy_cmd(summ_table, since_id, until_id, sensor)
+    pipe = copy_stream.ChunkPipe()
+
+    def copy_out():
+      try:
+        self.db_conn.cursor().copy_expert(cmd, pipe)
+        self.db_conn.commit()
+        pipe.close()
+      except Exception as e:
+        self.db_conn.rollback()
+        if not pipe.aborted:
+          pipe.close(e)
+
+    writer = threading.Thread(target=copy_out, name="copy-out", daemon=True)
+    writer.start()
+    try:
+      staging_table = remote_dbmanager.create_summary_staging_table(summ_table)
+      remote_dbmanager.db_conn.cursor().copy_expert("COPY {staging_table} FROM STDIN WITH DELIMITER AS ','".format(staging_table=staging_table), pipe, size=65536)
+    except Exception:
+      pipe.abort()
+      writer.join()
+      remote_dbmanager.db_conn.rollback()
+      raise
+    writer.join()
+    if pipe.error is not None:
+      remote_dbmanager.db_conn.rollback()
+      raise pipe.error
+    remote_dbmanager.merge_summary_staging_table(summ_table, staging_table)
+    return pipe.byte_count
+
+  # with deduplicate, rows are expected to carry (sensor, sensor_id) as written by copy_summary_to_csv with since_id,
+  # and rows already in summ_table are skipped, so re-sent rows are harmless
+  def copy_summary_from_csv(self, summ_table, csv_file=None, deduplicate=False):
     if csv_file == None: csv_file = self.csv_file
     curs = self.db_conn.cursor()
 
+    if not deduplicate:
+      with open(csv_file, "r") as csv_summ:
+        curs.copy_from(csv_summ, summ_table, sep=",",\
+          columns=("min_timestamp", "max_timestamp", "src", "srcport", "dst", "dstport", "protocol", "min_length", "max_length", "avg_length", "summ_size", "sample_rate"))
+      self.db_conn.commit()
+      return
+
+    staging_table = self.create_summary_staging_table(summ_table)
     with open(csv_file, "r") as csv_summ:
-      curs.copy_from(csv_summ, summ_table, sep=",",\
-        columns=("min_timestamp", "max_timestamp", "src", "srcport", "dst", "dstport", "protocol", "min_length", "max_length", "avg_length", "summ_size"))
+      curs.copy_from(csv_summ, staging_table, sep=",")
+    self.merge_summary_staging_table(summ_table, staging_table)
+
+  # returns the summary rows with since_id < id <= until_id, id last, for shipping over the worker socket.
+  # with_sensor, on the master's table, the sensor each row came from goes before the id
+  def get_new_summary_rows(self, summ_table, since_id, until_id, with_sensor=False):
+    cmd = """
+    SELECT min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, {sensor}id
+    FROM {summ_table}
+    WHERE id > %(since_id)s AND id <= %(until_id)s
+    ORDER BY id
+    """.format(summ_table=summ_table, sensor="sensor, " if with_sensor else "")
+    cmd_formats = {"since_id": since_id, "until_id": until_id}
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
+    return curs.fetchall()
 
-  # return structure: [[src, srcport, dst, dstport, pps, delay], ...]
-  def get_summ_pps_info(self, table, timewindow):
-    sql_log = open(self.sql_log_file, "a")
+  # applies summary rows received from workers (summary columns, sensor, sensor_id) with one COPY,
+  # skipping rows that are already in summ_table. returns the number of rows that were new
+  def insert_shipped_summary(self, summ_table, shipped_rows):
+    staging_table = self.create_summary_staging_table(summ_table)
+    cmd = """
+    COPY {staging_table} FROM stdin WITH DELIMITER AS ',' csv QUOTE '\"' ESCAPE '\"' NULL ''
+    """.format(staging_table=staging_table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.copy_expert(cmd, copy_stream.csv_reader(shipped_rows), size=65536)
+    return self.merge_summary_staging_table(summ_table, staging_table)
 
+  # session-private table shaped like the shipped summary rows, used to apply them with ON CONFLICT
+  def create_summary_staging_table(self, summ_table):
+    staging_table = summ_table + "_staging"
+    cmd = """
+    CREATE TEMP TABLE IF NOT EXISTS {staging_table} AS
+    SELECT min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, sensor, sensor_id
+    FROM {summ_table} WITH NO DATA
+    """.format(summ_table=summ_table, staging_table=staging_table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    return staging_table
+
+  # returns the number of rows that were new. the master and the worker_servers copying into its db with -transport db
+  # insert over separate connections, lock_summary_ids keeps their ids visible in order for the master's rollups
+  def merge_summary_staging_table(self, summ_table, staging_table):
+    self.lock_summary_ids(summ_table)
+    cmd = """
+    INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, sensor, sensor_id)
+    SELECT * FROM {staging_table}
+    ON CONFLICT DO NOTHING
+    """.format(summ_table=summ_table, staging_table=staging_table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    new_rows = curs.rowcount
+    curs.execute("TRUNCATE {staging_table}".format(staging_table=staging_table))
+    self.db_conn.commit()
+    return new_rows
+
+  def get_max_timestamp(self, summ_table):
+    cmd = """
+    SELECT max(max_timestamp) FROM {summ_table}
+    """.format(summ_table=summ_table)
+    curs = self.db_conn.cursor()
+    self.audit_log.log(curs, cmd)
+    curs.execute(cmd)
+    self.db_conn.commit()
+    return curs.fetchone()[0]
+
+  # return structure: [[src, srcport, dst, dstport, delay, pps, pps margin], ...]
+  # per flow pps over the last timewindow seconds before the newest timestamp, read from the rollup of
+  # rollup.rollup_size(timewindow) through a statement prepared once per connection.
+  # only the buckets in the window are read, however much the table holds. pps margin is the half width of the
+  # 95% confidence interval of pps when the packets were sampled, see rollup.rollup_rows, and 0 otherwise
+  def get_summ_pps_info(self, table, timewindow):
     cur_time = time.time()
+    size = rollup.rollup_size(timewindow)
+    rollup_table = rollup.rollup_table(table, size)
+    statement = f"pps_{rollup_table}"
+    curs = self.db_conn.cursor()
+    if statement not in self.prepared:
+      cmd = """
+      PREPARE {statement}(double precision, double precision) AS
+      WITH temp AS (SELECT max(last_ts) AS max_time FROM {rollup_table} WHERE bucket = (SELECT max(bucket) FROM {rollup_table}))
+      SELECT src, nullif(srcport, -1), dst, nullif(dstport, -1), $1-max(last_ts), sum(packets)/$2, 1.96*sqrt(sum(variance))/$2
+      FROM {rollup_table}, temp
+      WHERE bucket > max_time-$2-{half_size}
+      GROUP BY src, srcport, dst, dstport
+      """.format(statement=statement, rollup_table=rollup_table, half_size=size/2)
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+      self.prepared.add(statement)
     cmd = """
-    WITH temp AS (SELECT max(max_timestamp) AS max_time FROM {table})
-    SELECT src, srcport, dst, dstport, %(cur_time)s-max(max_timestamp), sum(summ_size)/%(timewindow)s
-    FROM {table}, temp
-    WHERE max_timestamp > max_time-%(timewindow)s
-    GROUP BY src, srcport, dst, dstport
-    """.format(table=table)
+    EXECUTE {statement}(%(cur_time)s, %(timewindow)s)
+    """.format(statement=statement)
     cmd_formats = {"cur_time":cur_time, "timewindow":timewindow}
+    self.audit_log.log(curs, cmd, cmd_formats)
+    curs.execute(cmd, cmd_formats)
+    self.db_conn.commit()
+    return curs.fetchall()
+
+  # get_summ_pps_info over the master's merged view instead of the rollups, so flows that several sensors saw are
+  # only counted once. bucket_size is the merged view's, see summary_merge.SummaryMerger
+  def get_merged_pps_info(self, summ_table, timewindow, bucket_size=1):
+    cur_time = time.time()
+    merged_table = summary_merge.merged_table(summ_table)
+    statement = f"pps_{merged_table}"
     curs = self.db_conn.cursor()
-    sql_log.write(curs.mogrify(cmd, cmd_formats).decode("utf-8") + "\n\n")
-    sql_log.close()
+    if statement not in self.prepared:
+      cmd = """
+      PREPARE {statement}(double precision, double precision) AS
+      WITH temp AS (SELECT max(max_timestamp) AS max_time FROM {merged_table} WHERE bucket = (SELECT max(bucket) FROM {merged_table}))
+      SELECT src, nullif(srcport, -1), dst, nullif(dstport, -1), $1-max(max_timestamp), sum(packets)/$2, 1.96*sqrt(sum(variance))/$2
+      FROM {merged_table}, temp
+      WHERE bucket > max_time-$2-{half_size}
+      GROUP BY src, srcport, dst, dstport
+      """.format(statement=statement, merged_table=merged_table, half_size=bucket_size/2)
+      self.audit_log.log(curs, cmd)
+      curs.execute(cmd)
+      self.prepared.add(statement)
+    cmd = """
+    EXECUTE {statement}(%(cur_time)s, %(timewindow)s)
+    """.format(statement=statement)
+    cmd_formats = {"cur_time":cur_time, "timewindow":timewindow}
+    self.audit_log.log(curs, cmd, cmd_formats)
     curs.execute(cmd, cmd_formats)
     self.db_conn.commit()
     return curs.fetchall()
+
+# every public method's duration, e.g. insert_log_batch is the COPY of a window's packets and summarize_table its GROUP BY
+DB_METHOD_SECONDS = metrics.histogram("db_method_seconds", "Duration of each DBManager method", ("method",))
+metrics.instrument_methods(DBManager, DB_METHOD_SECONDS)
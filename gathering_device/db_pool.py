@@ -0,0 +1,96 @@
+'''
+File:     db_pool.py
+Author:   Quangtri Thai
+Contents: Bounded pool of long-lived DBManager connections shared by worker_server.py's sessions.
+'''
+
+import contextlib
+import threading
+import time
+
+class PoolTimeout(Exception):
+  pass
+
+# Hands out at most max_size DBManagers, creating them with make_db_manager as needed and reusing them after.
+# A connection that sat idle for check_interval seconds is checked before it's handed out and reconnected if it died,
+# and one that breaks while in use is thrown away so the next acquire opens a new one.
+class DBManagerPool():
+  def __init__(self, make_db_manager, max_size=4, acquire_timeout=10, check_interval=30):
+    self.make_db_manager = make_db_manager
+    self.max_size = max_size
+    self.acquire_timeout = acquire_timeout
+    self.check_interval = check_interval
+    self.idle = [] # [(dbmanager, time it was released), ...]
+    self.size = 0 # connections open or being opened, idle or in use
+    self.cond = threading.Condition()
+    self.reconnects = 0
+    self.discarded = 0
+
+  def acquire(self):
+    deadline = time.time()+self.acquire_timeout
+    with self.cond:
+      while not self.idle and self.size >= self.max_size:
+        remaining = deadline-time.time()
+        if remaining <= 0:
+          raise PoolTimeout(f"no db connection free after {self.acquire_timeout} secs ({self.max_size} in use)")
+        self.cond.wait(remaining)
+      dbmanager = None
+      if self.idle:
+        dbmanager, released_time = self.idle.pop()
+      else:
+        self.size += 1
+
+    try:
+      if dbmanager is None:
+        dbmanager = self.make_db_manager()
+      elif dbmanager.db_conn.closed or (time.time()-released_time >= self.check_interval and not dbmanager.is_alive()):
+        dbmanager.reconnect()
+        self.reconnects += 1
+    except:
+      self.discard(dbmanager)
+      raise
+    return dbmanager
+
+  def release(self, dbmanager):
+    with self.cond:
+      self.idle.append((dbmanager, time.time()))
+      self.cond.notify()
+
+  # closes a connection that can't be reused and frees its slot
+  def discard(self, dbmanager):
+    if dbmanager is not None:
+      try:
+        dbmanager.close()
+      except:
+        pass
+    with self.cond:
+      self.size -= 1
+      self.discarded += 1
+      self.cond.notify()
+
+  # with pool.connection() as dbmanager: ...
+  # a failed transaction is rolled back before the connection goes back to the pool
+  @contextlib.contextmanager
+  def connection(self):
+    dbmanager = self.acquire()
+    try:
+      yield dbmanager
+    except:
+      if dbmanager.db_conn.closed:
+        self.discard(dbmanager)
+      else:
+        try:
+          dbmanager.db_conn.rollback()
+          self.release(dbmanager)
+        except:
+          self.discard(dbmanager)
+      raise
+    self.release(dbmanager)
+
+  def close(self):
+    with self.cond:
+      idle = self.idle
+      self.idle = []
+      self.size -= len(idle)
+    for dbmanager, released_time in idle:
+      dbmanager.close()
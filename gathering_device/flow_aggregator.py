@@ -0,0 +1,102 @@
+'''
+File:     flow_aggregator.py
+Author:   Quangtri Thai
+Contents: Incremental per-flow summarization of the packet stream, done in the monitor instead of in Postgres.
+'''
+
+import time
+from decimal import Decimal
+
+import packet_batch
+
+# column order of the rows emitted by FlowAggregator, matching network_log_summary.
+# sample_rate is the 1 in sample_rate packet sampling the counts were taken with, see packet_extractor.Sampler
+SUMMARY_COLUMNS = ("min_timestamp", "max_timestamp", "src", "srcport", "dst", "dstport", "protocol", "min_length", "max_length", "avg_length", "summ_size",
+                   "sample_rate")
+
+def to_int(value):
+  if value == None or value == "":
+    return None
+  return int(value)
+
+# Keeps running min/max timestamp, min/max/avg length and count per (src, srcport, dst, dstport, protocol).
+# Emits the same rows as DBManager.summarize_table's GROUP BY over the same logs: NULL keys group together,
+# min/max/avg ignore NULL lengths, and summ_size is count(*).
+class FlowAggregator():
+  def __init__(self, sample_rate=1):
+    self.flows = {}
+    self.sample_rate = sample_rate
+
+  def add(self, log):
+    ts = float(log[0])
+    length = to_int(log[6])
+    key = (log[1], to_int(log[2]), log[3], to_int(log[4]), log[5])
+    flow = self.flows.get(key)
+    if flow is None:
+      # [min_ts, max_ts, min_len, max_len, len_total, len_count, count]
+      if length is None:
+        self.flows[key] = [ts, ts, None, None, 0, 0, 1]
+      else:
+        self.flows[key] = [ts, ts, length, length, length, 1, 1]
+      return
+    if ts < flow[0]: flow[0] = ts
+    if ts > flow[1]: flow[1] = ts
+    if length is not None:
+      if flow[2] is None or length < flow[2]: flow[2] = length
+      if flow[3] is None or length > flow[3]: flow[3] = length
+      flow[4] += length
+      flow[5] += 1
+    flow[6] += 1
+
+  def __len__(self):
+    return len(self.flows)
+
+  # returns the summary rows in SUMMARY_COLUMNS order
+  def rows(self):
+    rows = []
+    for key, flow in self.flows.items():
+      avg_length = Decimal(flow[4])/Decimal(flow[5]) if flow[5] > 0 else None
+      rows.append((flow[0], flow[1], key[0], key[1], key[2], key[3], key[4], flow[2], flow[3], avg_length, flow[6], self.sample_rate))
+    return rows
+
+  def clear(self):
+    self.flows = {}
+
+# One summary window of the packet stream. Keeps the raw logs in a packet_batch.PacketBatch when they are still needed
+# (raw table writes or SQL summarization) and/or a FlowAggregator when summarizing in-process.
+# make_flows can make something else with FlowAggregator's add and rows, like sketches.FlowSketch.
+class LogWindow():
+  def __init__(self, keep_logs=True, aggregate=False, make_flows=FlowAggregator):
+    self.logs = packet_batch.PacketBatch() if keep_logs else None
+    self.flows = make_flows() if aggregate else None
+    self.start_ts = None
+    self.end_ts = None
+    self.min_ts = None # packets can arrive slightly out of order, these bound every timestamp in the window
+    self.max_ts = None
+    self.count = 0
+    self.close_time = None # wall clock time the window was cut
+
+  def add(self, log):
+    ts = float(log[0])
+    if self.start_ts is None:
+      self.start_ts = ts
+      self.min_ts = ts
+      self.max_ts = ts
+    self.end_ts = ts
+    if ts < self.min_ts:
+      self.min_ts = ts
+    elif ts > self.max_ts:
+      self.max_ts = ts
+    self.count += 1
+    if self.logs is not None:
+      self.logs.append(log)
+    if self.flows is not None:
+      self.flows.add(log)
+
+  def close(self):
+    self.close_time = time.time()
+
+  def duration(self):
+    if self.start_ts is None:
+      return 0
+    return self.end_ts-self.start_ts
@@ -0,0 +1,132 @@
+'''
+File:     flow_tracker.py
+Author:   Quangtri Thai
+Contents: Sliding window of per flow packet counts in memory, for the dashboard's top flows by pps.
+'''
+
+import heapq
+import itertools
+import math
+import threading
+
+import rollup
+
+# Counts packets per flow (src, srcport, dst, dstport) over the last window_size seconds of packet timestamps.
+# Packets go into a ring of one second buckets, and running totals over the ring are kept up to date as buckets
+# are added and expire, so a packet costs O(1) and a query only looks at the flows still in the window.
+# Packets older than the window are ignored. add is called from the capture loop and top from the dashboard,
+# which may run on a flusher thread, hence the lock.
+# The flows are ranked for top in a heap whose entries are only brought up to date for the flows that changed,
+# so a refresh doesn't sort every flow in the window again.
+# When packets are sampled 1 in sample_rate, counts are scaled back up and top gives the 95% margin of each pps.
+# With max_flows, at most that many flows are kept: a new flow evicts the one with the fewest packets in the window,
+# like sketches.SpaceSaving, so memory stays fixed and the heavy flows the dashboard shows are still counted exactly.
+class FlowTracker():
+  def __init__(self, window_size, sample_rate=1, max_flows=None):
+    self.window_size = window_size
+    self.sample_rate = sample_rate
+    self.max_flows = max_flows
+    self.bucket_count = max(1, int(math.ceil(window_size)))
+    self.buckets = [{} for i in range(self.bucket_count)]
+    self.head = None # newest second seen
+    self.totals = {} # flow -> packets in the window
+    self.last_seen = {} # flow -> timestamp of its newest packet
+    self.heap = [] # [(-packets, -last seen, order, flow), ...] as each flow was when top last saw it change
+    self.changed = set() # flows added to or expired since top last ran
+    self.order = itertools.count()
+    self.min_heap = [] # [(packets when pushed, order, flow), ...], with max_flows. see evict
+    self.lock = threading.Lock()
+
+  def add(self, log):
+    ts = float(log[0])
+    second = int(ts)
+    flow = (log[1], log[2], log[3], log[4])
+    with self.lock:
+      if self.head is None:
+        self.head = second
+      elif second > self.head:
+        self.advance(second)
+      elif second <= self.head-self.bucket_count:
+        return
+      if self.max_flows is not None and flow not in self.totals:
+        if len(self.totals) >= self.max_flows:
+          self.evict()
+        heapq.heappush(self.min_heap, (1, next(self.order), flow))
+      bucket = self.buckets[second % self.bucket_count]
+      bucket[flow] = bucket.get(flow, 0)+1
+      self.totals[flow] = self.totals.get(flow, 0)+1
+      if ts > self.last_seen.get(flow, 0):
+        self.last_seen[flow] = ts
+      self.changed.add(flow)
+
+  # moves the window forward to end at second, expiring the buckets that fall out of it
+  def advance(self, second):
+    for expired in range(max(self.head+1, second-self.bucket_count+1), second+1):
+      bucket = self.buckets[expired % self.bucket_count]
+      for flow, count in bucket.items():
+        total = self.totals[flow]-count
+        if total > 0:
+          self.totals[flow] = total
+          self.changed.add(flow)
+          if self.max_flows is not None:
+            heapq.heappush(self.min_heap, (total, next(self.order), flow))
+        else:
+          del self.totals[flow]
+          del self.last_seen[flow]
+          self.changed.discard(flow)
+      bucket.clear()
+    self.head = second
+    if len(self.min_heap) > 2*len(self.totals)+self.bucket_count:
+      self.min_heap = [(count, next(self.order), flow) for flow, count in self.totals.items()]
+      heapq.heapify(self.min_heap)
+
+  # drops the flow with the fewest packets in the window. every flow has a min_heap entry of at most its packets:
+  # one is pushed when it's new and whenever packets expire, and adding packets leaves the older, smaller entry.
+  # an entry above the flow's packets is outdated and dropped, one below them is pushed again with its packets,
+  # so the first entry that matches is the smallest flow
+  def evict(self):
+    while True:
+      count, order, flow = heapq.heappop(self.min_heap)
+      total = self.totals.get(flow)
+      if total is None or total < count:
+        continue
+      if total > count:
+        heapq.heappush(self.min_heap, (total, next(self.order), flow))
+        continue
+      del self.totals[flow]
+      del self.last_seen[flow]
+      self.changed.discard(flow)
+      for bucket in self.buckets:
+        bucket.pop(flow, None)
+      return
+
+  # the k flows with the highest pps, ties to the most recently seen, in the same
+  # (src, srcport, dst, dstport, secs since last seen, pps, pps margin) rows as DBManager.get_summ_pps_info.
+  # each flow that changed gets a new heap entry, and the outdated entries are dropped as they come up, so a refresh
+  # costs O((changed flows + k) log flows). the heap is rebuilt once outdated entries make up half of it
+  def top(self, k, cur_time):
+    rate = self.sample_rate
+    with self.lock:
+      for flow in self.changed:
+        count = self.totals.get(flow)
+        if count is not None:
+          heapq.heappush(self.heap, (-count, -self.last_seen[flow], next(self.order), flow))
+      self.changed.clear()
+      if len(self.heap) > 2*len(self.totals)+k:
+        self.heap = [(-count, -self.last_seen[flow], next(self.order), flow) for flow, count in self.totals.items()]
+        heapq.heapify(self.heap)
+      entries = []
+      flows = set()
+      while self.heap and len(entries) < k:
+        entry = heapq.heappop(self.heap)
+        flow = entry[3]
+        if self.totals.get(flow) == -entry[0] and self.last_seen[flow] == -entry[1] and flow not in flows:
+          entries.append(entry)
+          flows.add(flow)
+      for entry in entries:
+        heapq.heappush(self.heap, entry)
+      return [flow+(cur_time+last_seen, -count*rate/self.window_size, rollup.pps_margin(-count*rate*(rate-1), self.window_size))
+              for count, last_seen, order, flow in entries]
+
+  def __len__(self):
+    return len(self.totals)
@@ -0,0 +1,150 @@
+'''
+File:     flush_queue.py
+Author:   Quangtri Thai
+Contents: Bounded packet queue and background flusher threads, used to keep database work off the capture loop.
+'''
+
+import collections
+import queue
+import threading
+
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "sample")
+
+# Bounded queue of parsed packet logs between the capture loop (producer) and the flusher (consumer).
+# When the queue is full the policy decides what happens to a new log:
+#   block       - the capture loop waits until the flusher makes room
+#   drop_oldest - the oldest queued log is evicted to make room
+#   sample      - only every sample_rate-th log is kept (evicting the oldest), the rest are dropped
+class PacketQueue():
+  def __init__(self, max_size, policy="block", sample_rate=10):
+    if policy not in BACKPRESSURE_POLICIES:
+      raise ValueError(f"Unknown backpressure policy: {policy}")
+    self.max_size = max_size
+    self.policy = policy
+    self.sample_rate = max(1, sample_rate)
+    self.logs = collections.deque()
+    self.lock = threading.Lock()
+    self.not_empty = threading.Condition(self.lock)
+    self.not_full = threading.Condition(self.lock)
+    self.closed = False
+
+    self.full_count = 0 # number of logs that arrived while the queue was full
+    self.drop_count = 0 # logs evicted from the head of the queue
+    self.sample_drop_count = 0 # logs rejected by the sample policy
+    self.max_depth = 0
+
+  # returns False if the log was not queued
+  def put(self, log):
+    with self.lock:
+      if self.closed:
+        return False
+      if len(self.logs) >= self.max_size:
+        self.full_count += 1
+        if self.policy == "block":
+          while len(self.logs) >= self.max_size and not self.closed:
+            self.not_full.wait()
+          if self.closed:
+            return False
+        elif self.policy == "drop_oldest":
+          self.logs.popleft()
+          self.drop_count += 1
+        else:
+          if self.full_count % self.sample_rate != 0:
+            self.sample_drop_count += 1
+            return False
+          self.logs.popleft()
+          self.drop_count += 1
+      self.logs.append(log)
+      if len(self.logs) > self.max_depth:
+        self.max_depth = len(self.logs)
+      self.not_empty.notify()
+    return True
+
+  # blocks until at least one log is queued, then returns up to max_items logs.
+  # an empty list means the queue was closed and fully drained.
+  def get_many(self, max_items=1024):
+    with self.lock:
+      while not self.logs and not self.closed:
+        self.not_empty.wait()
+      logs = []
+      while self.logs and len(logs) < max_items:
+        logs.append(self.logs.popleft())
+      self.not_full.notify_all()
+    return logs
+
+  def close(self):
+    with self.lock:
+      self.closed = True
+      self.not_empty.notify_all()
+      self.not_full.notify_all()
+
+  def depth(self):
+    return len(self.logs)
+
+  def dropped(self):
+    return self.drop_count + self.sample_drop_count
+
+# Background flusher. A dispatcher thread drains the packet queue and cuts it into summary windows,
+# handing each finished window to one of num_workers flusher threads that do the database work.
+# Each flusher thread owns its own DBManager (psycopg2 connection) created by make_db_manager(worker_id).
+class Flusher():
+  def __init__(self, monitor, packet_queue, num_workers, make_db_manager):
+    self.monitor = monitor
+    self.packet_queue = packet_queue
+    self.num_workers = num_workers
+    self.make_db_manager = make_db_manager
+    # small hand-off queue so a slow database pushes back into the packet queue's policy
+    self.window_queue = queue.Queue(maxsize=num_workers*2)
+    self.threads = []
+    self.error = None
+    self.flush_count = 0
+
+  def start(self):
+    dispatcher = threading.Thread(target=self.dispatch, name="flush-dispatcher", daemon=True)
+    self.threads.append(dispatcher)
+    for i in range(self.num_workers):
+      worker = threading.Thread(target=self.work, args=(i,), name=f"flusher-{i}", daemon=True)
+      self.threads.append(worker)
+    for thread in self.threads:
+      thread.start()
+
+  def stop(self):
+    self.packet_queue.close()
+    for thread in self.threads:
+      thread.join()
+
+  def dispatch(self):
+    window = self.monitor.new_window()
+    while True:
+      logs = self.packet_queue.get_many()
+      if not logs:
+        break
+      for log in logs:
+        window.add(log)
+        if self.monitor.window_closed(window):
+          window.close()
+          self.window_queue.put(window)
+          window = self.monitor.new_window()
+    # queue closed, flush whatever is left
+    if window.count > 0:
+      window.close()
+      self.window_queue.put(window)
+    for i in range(self.num_workers):
+      self.window_queue.put(None)
+
+  def work(self, worker_id):
+    try:
+      db_manager = self.make_db_manager(worker_id)
+      log_table = self.monitor.log_table
+      # concurrent windows can't share one staging table when it is summarized and emptied per window
+      if self.num_workers > 1 and self.monitor.summ_timewindow != None and self.monitor.aggregate == "sql":
+        log_table = db_manager.create_temp_log_table(self.monitor.log_table, f"{self.monitor.log_table}_flusher{worker_id}")
+      while True:
+        window = self.window_queue.get()
+        if window is None:
+          break
+        self.monitor.flush_batch(db_manager, window, log_table)
+        self.flush_count += 1
+    except Exception as e:
+      self.error = e
+      self.packet_queue.close()
@@ -0,0 +1,280 @@
+'''
+File:     metrics.py
+Author:   Quangtri Thai
+Contents: Low-overhead counters, gauges and latency histograms, served as Prometheus text over HTTP and written to a JSON stats file.
+'''
+
+import bisect
+import functools
+import http.server
+import json
+import math
+import os
+import threading
+import time
+
+# upper bounds in seconds, from per-packet work (microseconds) to db statements on a busy Pi (seconds)
+DEFAULT_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter():
+  def __init__(self):
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+# set by hand, or read from function when it is given
+class Gauge():
+  def __init__(self, function=None):
+    self.function = function
+    self.value = 0
+
+  def set(self, value):
+    self.value = value
+
+  def get(self):
+    return self.function() if self.function is not None else self.value
+
+# Counts observations into fixed buckets, so observing is a bisect and an increment however many there are.
+# Percentiles are interpolated within the bucket they fall in.
+class Histogram():
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.bounds = list(buckets)
+    self.counts = [0]*(len(self.bounds)+1) # the last one is +Inf
+    self.sum = 0
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.bounds, value)
+    with self.lock:
+      self.counts[i] += 1
+      self.sum += value
+      self.count += 1
+
+  # with histogram.time(): ...
+  def time(self):
+    return Timer(self)
+
+  def percentile(self, p):
+    with self.lock:
+      counts = list(self.counts)
+      count = self.count
+    if count == 0:
+      return 0
+    rank = p/100*count
+    seen = 0
+    for i, bucket_count in enumerate(counts):
+      if seen+bucket_count >= rank and bucket_count > 0:
+        lower = self.bounds[i-1] if i > 0 else 0
+        upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+        return lower+(upper-lower)*(rank-seen)/bucket_count
+      seen += bucket_count
+    return self.bounds[-1]
+
+class Timer():
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self.histogram.observe(time.perf_counter()-self.start)
+    return False
+
+# One metric name and its children, one per combination of label values
+class Family():
+  def __init__(self, kind, name, help, label_names, make):
+    self.kind = kind
+    self.name = name
+    self.help = help
+    self.label_names = tuple(label_names)
+    self.make = make
+    self.children = {}
+    self.lock = threading.Lock()
+    if not self.label_names:
+      self.children[()] = make()
+
+  def labels(self, *values):
+    values = tuple(str(value) for value in values)
+    child = self.children.get(values)
+    if child is None:
+      with self.lock:
+        child = self.children.setdefault(values, self.make())
+    return child
+
+# Every metric of a process, registered once at import time by the modules that update them
+class Registry():
+  def __init__(self):
+    self.families = {}
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+
+  # the family when it has labels, otherwise its only metric
+  def register(self, kind, name, help, label_names, make):
+    with self.lock:
+      family = self.families.get(name)
+      if family is None:
+        family = self.families[name] = Family(kind, name, help, label_names, make)
+    return family if family.label_names else family.children[()]
+
+  def counter(self, name, help, label_names=()):
+    return self.register("counter", name, help, label_names, Counter)
+
+  # registering a gauge again points it at the new function, e.g. for the next Monitor of a benchmark
+  def gauge(self, name, help, label_names=(), function=None):
+    gauge = self.register("gauge", name, help, label_names, lambda: Gauge(function))
+    if function is not None and not label_names:
+      gauge.function = function
+    return gauge
+
+  def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+    return self.register("histogram", name, help, label_names, lambda: Histogram(buckets))
+
+  # Prometheus text exposition format 0.0.4
+  def render_prometheus(self):
+    lines = []
+    for family in list(self.families.values()):
+      lines.append(f"# HELP {family.name} {family.help}")
+      lines.append(f"# TYPE {family.name} {family.kind}")
+      for values, child in list(family.children.items()):
+        labels = [f'{name}="{escape_label(value)}"' for name, value in zip(family.label_names, values)]
+        if family.kind == "histogram":
+          cumulative = 0
+          for bound, count in zip(child.bounds+[math.inf], list(child.counts)):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(float(bound))
+            bucket_labels = format_labels(labels+['le="' + le + '"'])
+            lines.append(f"{family.name}_bucket{bucket_labels} {cumulative}")
+          lines.append(f"{family.name}_sum{format_labels(labels)} {child.sum}")
+          lines.append(f"{family.name}_count{format_labels(labels)} {child.count}")
+        elif family.kind == "counter":
+          lines.append(f"{family.name}{format_labels(labels)} {child.value}")
+        else:
+          lines.append(f"{family.name}{format_labels(labels)} {child.get()}")
+    return "\n".join(lines) + "\n"
+
+  # {name: {label values joined with ",": value or {count, sum, p50, p95, p99}}}
+  def snapshot(self):
+    stats = {}
+    for family in list(self.families.values()):
+      values = {}
+      for label_values, child in list(family.children.items()):
+        key = ",".join(f"{name}={value}" for name, value in zip(family.label_names, label_values))
+        if family.kind == "histogram":
+          values[key] = {"count": child.count, "sum": child.sum, "p50": child.percentile(50), "p95": child.percentile(95), "p99": child.percentile(99)}
+        elif family.kind == "counter":
+          values[key] = child.value
+        else:
+          values[key] = child.get()
+      stats[family.name] = values[""] if list(values) == [""] else values
+    return stats
+
+def escape_label(value):
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+  return "{" + ",".join(labels) + "}" if labels else ""
+
+REGISTRY = Registry()
+
+def counter(name, help, label_names=()):
+  return REGISTRY.counter(name, help, label_names)
+
+def gauge(name, help, label_names=(), function=None):
+  return REGISTRY.gauge(name, help, label_names, function)
+
+def histogram(name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+  return REGISTRY.histogram(name, help, label_names, buckets)
+
+# wraps every public method of cls to observe its duration in family, labelled with the method's name
+def instrument_methods(cls, family):
+  for name, method in list(vars(cls).items()):
+    if name.startswith("_") or not callable(method):
+      continue
+    setattr(cls, name, timed(family.labels(name), method))
+
+def timed(histogram, function):
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      histogram.observe(time.perf_counter()-start)
+  return wrapper
+
+# GET /metrics on host:port answers with the registry in Prometheus text format
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+  class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split("?")[0] not in ("/", "/metrics"):
+        self.send_error(404)
+        return
+      body = registry.render_prometheus().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+  return server
+
+# Writes registry.snapshot() to path every interval seconds, replacing the file in one rename so readers never see
+# half of it. rates are the counters' increase per second since the previous write
+class StatsWriter():
+  def __init__(self, path, interval=10, registry=REGISTRY):
+    self.path = path
+    self.interval = interval
+    self.registry = registry
+    self.previous = None
+    self.previous_time = None
+    self.stopped = threading.Event()
+
+  def start(self):
+    threading.Thread(target=self.run, name="stats-writer", daemon=True).start()
+
+  def stop(self):
+    self.stopped.set()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.write()
+
+  def write(self):
+    cur_time = time.time()
+    stats = self.registry.snapshot()
+    rates = {}
+    if self.previous is not None and cur_time > self.previous_time:
+      elapsed = cur_time-self.previous_time
+      for name, family in list(self.registry.families.items()):
+        if family.kind != "counter" or name not in self.previous:
+          continue
+        if isinstance(stats[name], dict):
+          rates[name] = {key: (value-self.previous[name].get(key, 0))/elapsed for key, value in stats[name].items()}
+        else:
+          rates[name] = (stats[name]-self.previous[name])/elapsed
+    self.previous = stats
+    self.previous_time = cur_time
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "w") as stats_file:
+      json.dump({"time": cur_time, "uptime": cur_time-self.registry.start_time, "rates": rates, "metrics": stats}, stats_file, indent=1)
+    os.replace(temp_path, self.path)
+
+# the -metrics_port endpoint and -stats_file writer of monitor.py, worker_server.py and master_client.py, each when it is given
+def start_exporters(port=None, stats_file=None, stats_interval=10, host="127.0.0.1"):
+  if port is not None:
+    start_http_server(port, host)
+  if stats_file is not None:
+    StatsWriter(stats_file, stats_interval).start()
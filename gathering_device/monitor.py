@@ -1,23 +1,67 @@
 import time
 import argparse
 import csv
+import threading
 
-import pyshark
-from asciimatics.screen import Screen
+import psycopg2
 
+import audit_log
+import capture_shards
+import copy_stream
+import dashboard
 import db_manager
+import flush_queue
+import flow_aggregator
+import flow_tracker
+import metrics
+import packet_extractor
+import retention
+import rollup
+import sketches
+import spool
+import summary_archive
+import summary_publisher
 # import data_processor # no need to pre-process data anymore
 
+# per packet: track and aggregate (or enqueue with flush workers). per window: flush, which includes its
+# db_manager.DBManager methods, see db_method_seconds. dashboard redraws are in render_seconds
+STAGE_SECONDS = metrics.histogram("monitor_stage_seconds", "Duration of each stage of the capture loop", ("stage",))
+TRACK_SECONDS = STAGE_SECONDS.labels("track")
+AGGREGATE_SECONDS = STAGE_SECONDS.labels("aggregate")
+ENQUEUE_SECONDS = STAGE_SECONDS.labels("enqueue")
+FLUSH_SECONDS = STAGE_SECONDS.labels("flush")
+SKIPPED_PACKETS = metrics.counter("skipped_packets_total", "Packets skipped for having no source or destination address")
+FLUSHED_WINDOWS = metrics.counter("flushed_windows_total", "Windows written to the db or spooled")
+WINDOW_DELAY_SECONDS = metrics.histogram("window_delay_seconds", "Time from the end of a window to the end of its flush")
+
 
 # runs and coordinates the monitoring of the network
 # table_timewindow is in units of minutes and summ_timewindow is in seconds
 class Monitor():
-  def __init__(self, interface, table_timewindow, summ_timewindow, log_table, summ_table, user, password, host, database, display_rate, display_size):
-    self.db_manager = db_manager.DBManager(user, password, host, database)
+  def __init__(self, interface, table_timewindow, summ_timewindow, log_table, summ_table, user, password, host, database, display_rate, display_size,
+               flush_workers=0, queue_size=50000, backpressure="block", queue_sample_rate=10, aggregate="sql", keep_raw=False, extractor="pyshark",
+               pcap_file=None, replay_speed=0, rebase_ts=False, copy_mode="memory", publish=None,
+               audit_level="statement", partition_size=None, detach_partitions=False, sketch_flows=1000, hll_precision=12,
+               spool_dir=None, spool_max_mb=256, flush_budget=None, shards=1, capture_filter=None, sample_rate=1, sample_mode="count",
+               archive_dir=None, audit_max_bytes=audit_log.MAX_BYTES, audit_max_age=audit_log.MAX_AGE):
+    self.db_args = (user, password, host, database)
+    self.copy_mode = copy_mode
+    self.audit_level = audit_level
+    self.audit_max_bytes = audit_max_bytes
+    self.audit_max_age = audit_max_age
+    self.db_manager = db_manager.DBManager(user, password, host, database, copy_mode=copy_mode, audit_level=audit_level,
+                                           audit_max_bytes=audit_max_bytes, audit_max_age=audit_max_age)
     # self.data_processor = data_processor.DataProcessor()
     self.table_timewindow = table_timewindow
     self.summ_timewindow = summ_timewindow
-    self.capture = pyshark.LiveCapture(interface=interface)
+    # sniff interface (a list of interfaces to sniff them all), or replay pcap_file through the same pipeline when it is given.
+    # several interfaces, or shards > 1 processes splitting each interface, are captured in parallel processes.
+    # capture_filter is a BPF filter applied in the kernel while sniffing, and with sample_rate > 1 only 1 in sample_rate
+    # packets is parsed (see packet_extractor.Sampler). the counts are scaled back up when they are read
+    self.sample_rate = sample_rate
+    self.sample_mode = sample_mode
+    self.extractor = capture_shards.make_capture(extractor, interface, pcap_file, replay_speed, rebase_ts, shards, capture_filter,
+                                                 sample_rate, sample_mode)
     self.log_table = log_table
     self.summ_table = summ_table
 
@@ -28,162 +72,350 @@ class Monitor():
     writer.writerow(["summ row count", "src:port", "dst:port", "pps", "delay"])
     monitor_log.close()
 
-    self.check_ts = time.time()
     self.display_rate = display_rate # seconds
     self.delay_count = 0
     self.avg_delay = 0
     self.total_delay = 0
     self.display_size = display_size
+    # the dashboard's top flows come from memory, the db is only written to. in sketch mode the tracker keeps
+    # as many flows as a window's sketch, so memory doesn't grow with the number of flows either
+    self.flow_tracker = flow_tracker.FlowTracker(display_size, sample_rate, sketch_flows if aggregate == "sketch" else None)
     self.skip_count = 0
+    self.sketch_counts = None # flows tracked and distinct counts of the last flushed window, with aggregate="sketch"
+
+    # flush_workers > 0 moves db work off the capture loop onto background flusher threads
+    self.flush_workers = flush_workers
+    self.packet_queue = None
+    if self.flush_workers > 0:
+      self.packet_queue = flush_queue.PacketQueue(queue_size, backpressure, queue_sample_rate)
+      metrics.gauge("queue_depth", "Packets waiting for the flush workers", function=self.packet_queue.depth)
+      metrics.gauge("queue_dropped_packets", "Packets dropped or sampled out while the queue was full",
+                    function=lambda: self.packet_queue.drop_count+self.packet_queue.sample_drop_count)
+    self.monitor_lock = threading.Lock()
+
+    # aggregate="stream" summarizes flows in-process and only writes summary rows,
+    # aggregate="sql" stages every packet in log_table and summarizes it with a GROUP BY.
+    # aggregate="sketch" is stream mode in fixed memory: only the sketch_flows heaviest flows of each window are
+    # summarized, and the window's sketches.FlowSketch (with distinct counts in 3*2^hll_precision bytes) is stored too.
+    # keep_raw additionally writes the raw packets to log_table in stream and sketch mode.
+    self.aggregate = aggregate
+    self.keep_raw = keep_raw
+    self.sketch_flows = sketch_flows
+    self.hll_precision = hll_precision
+
+    # publish is worker_server's "host:port" publish address. each flushed window's summary rows are
+    # pushed there right away for masters that subscribe instead of polling
+    self.publisher = None
+    if publish is not None:
+      self.publisher = summary_publisher.Publisher(publish)
+
+    # tables are created here when they don't exist yet. raw packets that are kept for table_timewindow go to a
+    # partitioned log_table, otherwise log_table is only an unlogged staging table for summarize_table.
+    # old rows are removed by dropping whole partitions, see retention.RetentionManager
+    keep_logs = summ_timewindow == None or (aggregate != "sql" and keep_raw)
+    self.db_manager.create_log_table(log_table, partitioned=keep_logs)
+    self.log_retention = None
+    if keep_logs:
+      self.log_retention = retention.RetentionManager(log_table, "timestamp", table_timewindow*60, partition_size,
+                                                      detach=detach_partitions, unlogged=True)
+    self.summ_retention = None
+    self.rollups = None
+    if summ_table != None:
+      self.db_manager.create_summary_table(summ_table)
+      # with archive_dir, summary rows are written to columnar segments there before they're dropped, see summary_archive
+      archiver = None
+      if archive_dir is not None:
+        archiver = summary_archive.SummaryArchiver(archive_dir, flow_aggregator.SUMMARY_COLUMNS)
+      self.summ_retention = retention.RetentionManager(summ_table, "min_timestamp", table_timewindow*60, partition_size,
+                                                       detach=detach_partitions, archiver=archiver)
+      # the dashboard reads pps from these instead of the summary table
+      self.db_manager.create_rollup_tables(summ_table)
+      self.rollups = rollup.Rollups(summ_table, table_timewindow*60, partition_size, detach_partitions)
+    self.sketch_retention = None
+    if summ_table != None and aggregate == "sketch":
+      self.db_manager.create_sketch_table(summ_table)
+      self.sketch_retention = retention.RetentionManager(sketches.sketch_table(summ_table), "min_timestamp", table_timewindow*60, partition_size,
+                                                         detach=detach_partitions)
+
+    # spool_dir turns on the write-ahead spool: windows that fail to be written, or that come while a flush takes
+    # longer than flush_budget seconds (default summ_timewindow), are kept in spool_dir and replayed in the order
+    # they were spooled by a background thread once the db is back. windows spooled before a restart are replayed too
+    self.spool = None
+    self.replayer = None
+    self.spooling = False
+    self.spool_error = None # why the last window was spooled
+    self.spool_lock = threading.Lock() # flushers decide between the db and the spool one at a time
+    self.flush_budget = flush_budget if flush_budget else (summ_timewindow if summ_timewindow != None else 1)
+    if spool_dir is not None:
+      self.spool = spool.Spool(spool_dir, spool_max_mb*1024*1024)
+      metrics.gauge("spool_depth", "Windows waiting in the spool", function=self.spool.depth)
+      metrics.gauge("spool_bytes", "Bytes of the spool on disk", function=self.spool.size)
+
+  # renderer is a dashboard.Renderer drawing dashboard_stats, None to run without a dashboard, e.g. when benchmarking
+  def run(self, renderer=None):
+    if renderer is not None:
+      renderer.start()
+    if self.spool is not None:
+      make_replay_db_manager = lambda: db_manager.DBManager(*self.db_args, csv_file="log_batch_replay.csv", clear_log=False, copy_mode=self.copy_mode, audit_level=self.audit_level,
+                                                            audit_max_bytes=self.audit_max_bytes, audit_max_age=self.audit_max_age)
+      self.replayer = spool.Replayer(self.spool, spool.WindowBatch.from_bytes, self.replay_batch, make_replay_db_manager)
+      self.replayer.start()
 
-  def run(self, screen):
-    log_batch = []
-    count = 0
-    for packet in self.capture.sniff_continuously():
-      # extract needed data from packet
-      log = []
-      log.append(self.get_sniff_ts(packet))
-      log.append(self.get_src(packet))
-      log.append(self.get_src_port(packet))
-      log.append(self.get_dst(packet))
-      log.append(self.get_dst_port(packet))
-      log.append(self.get_protocol(packet))
-      log.append(self.get_length(packet))
+    flusher = None
+    if self.flush_workers > 0:
+      # each flusher gets its own connection and its own csv file to stage COPY batches through
+      make_db_manager = lambda worker_id: db_manager.DBManager(*self.db_args, csv_file=f"log_batch_flusher{worker_id}.csv", clear_log=False, copy_mode=self.copy_mode, audit_level=self.audit_level,
+                                                                   audit_max_bytes=self.audit_max_bytes, audit_max_age=self.audit_max_age)
+      flusher = flush_queue.Flusher(self, self.packet_queue, self.flush_workers, make_db_manager)
+      flusher.start()
+
+    window = self.new_window()
+    # extractor yields the needed data from each packet: [sniff_ts, src, srcport, dst, dstport, protocol, length]
+    for log in self.extractor.logs():
       # log = self.data_processor.process_log(log)
       if log[1] == None or log[3] == None:
         self.skip_count += 1
+        SKIPPED_PACKETS.inc()
         continue
-      log_batch.append(log)
+      stage_start = time.perf_counter()
+      self.flow_tracker.add(log)
+      TRACK_SECONDS.observe(time.perf_counter()-stage_start)
 
-      # push to db in batchs of summ_timewindow
-      start_ts = float(log_batch[0][0])
-      end_ts = float(log_batch[len(log_batch)-1][0])
-      if self.summ_timewindow == None:
-        # use db_manager to insert log to network_log
-        # clear network_log of past data based on table_timewindow
-        self.db_manager.insert_log_batch(self.log_table, log_batch)
-        self.log_monitor(screen, log_batch, self.log_table)
-        clear_ts = end_ts-self.table_timewindow*60
-        self.db_manager.clear_log_table(self.log_table, clear_ts)
-        log_batch = []
-      elif end_ts-start_ts >= self.summ_timewindow:
-        # use data_processor to process log_batch
-        # use db_manager to write log_batch to csv, then copy csv to network_log_temp
+      # producer/consumer mode: hand the log to the flusher and go back to sniffing
+      if flusher is not None:
+        if flusher.error is not None:
+          raise flusher.error
+        stage_start = time.perf_counter()
+        self.packet_queue.put(log)
+        ENQUEUE_SECONDS.observe(time.perf_counter()-stage_start)
+        continue
+
+      stage_start = time.perf_counter()
+      window.add(log)
+      AGGREGATE_SECONDS.observe(time.perf_counter()-stage_start)
+      if self.window_closed(window):
+        window.close()
+        self.flush_batch(self.db_manager, window, self.log_table)
+        window = self.new_window()
+
+    # capture ended (end of a replayed pcap), flush whatever is left
+    if flusher is not None:
+      flusher.stop()
+      if flusher.error is not None:
+        raise flusher.error
+    elif window.count > 0:
+      window.close()
+      self.flush_batch(self.db_manager, window, self.log_table)
+    if renderer is not None:
+      renderer.stop()
+
+  def stream_summarizing(self):
+    return self.summ_timewindow != None and self.aggregate in ("stream", "sketch")
+
+  def new_window(self):
+    keep_logs = not self.stream_summarizing() or self.keep_raw
+    make_flows = lambda: flow_aggregator.FlowAggregator(self.sample_rate)
+    if self.aggregate == "sketch":
+      make_flows = lambda: sketches.FlowSketch(self.sketch_flows, self.hll_precision, self.sample_rate)
+    return flow_aggregator.LogWindow(keep_logs=keep_logs, aggregate=self.stream_summarizing(), make_flows=make_flows)
+
+  # push to db in batchs of summ_timewindow
+  def window_closed(self, window):
+    if self.summ_timewindow == None:
+      return True
+    return window.duration() >= self.summ_timewindow
+
+  # writes one finished window to the db. called from the capture loop, or from a flusher thread
+  # with that thread's own db_manager and staging log_table.
+  def flush_batch(self, db_manager, window, log_table):
+    with FLUSH_SECONDS.time():
+      batch = self.window_batch(window)
+      if self.spool is None:
+        self.write_batch(db_manager, batch, log_table)
+      else:
+        self.write_or_spool(db_manager, batch, log_table)
+    FLUSHED_WINDOWS.inc()
+    self.log_monitor(window, log_table, self.summ_table)
+
+  # the db work window needs, see spool.WindowBatch
+  def window_batch(self, window):
+    if self.summ_timewindow == None:
+      return spool.WindowBatch(spool.STEP_LOGS, window.min_ts, window.max_ts, window.end_ts, logs=window.logs)
+    if self.aggregate == "sql":
+      return spool.WindowBatch(spool.STEP_LOGS | spool.STEP_SUMMARY | spool.STEP_ROLLUPS, window.min_ts, window.max_ts, window.end_ts,
+                               logs=window.logs)
+    # the window was summarized as packets arrived, only the summary rows go to the db
+    # raw packets are optional and kept for table_timewindow like the raw log mode
+    steps = spool.STEP_SUMMARY | spool.STEP_ROLLUPS
+    if window.logs is not None:
+      steps |= spool.STEP_LOGS
+    sketch = None
+    if self.sketch_retention is not None:
+      steps |= spool.STEP_SKETCH
+      sketch = window.flows
+    return spool.WindowBatch(steps, window.min_ts, window.max_ts, window.end_ts, logs=window.logs, summ_rows=window.flows.rows(), sketch=sketch)
+
+  # does the steps of batch that are left, clearing each one as it commits
+  def write_batch(self, db_manager, batch, log_table):
+    if self.summ_timewindow != None and self.aggregate == "sql":
+      if batch.steps & spool.STEP_SUMMARY:
+        # use db_manager to write log_batch to network_log_batch
         # use db_manager to summarize network_log_batch to network_log_summary
-        # clear network_log_summary of past data based on table_timewindow
-        # clear network_log_batch of all data
-        self.db_manager.insert_log_batch(self.log_table, log_batch)
-        self.db_manager.summarize_table(self.log_table, self.summ_table)
-        self.log_monitor(screen, log_batch, self.log_table, self.summ_table)
-        clear_ts = 0
-        self.db_manager.clear_log_table(self.log_table)
-        clear_ts = end_ts-self.table_timewindow*60
-        self.db_manager.clear_summ_table(self.summ_table, clear_ts)
-        log_batch = []
-
-  # Functions to get info from the packet, often returning None if not found
-
-  def layer_exist(self, packet, layer):
-    return layer in [layer.layer_name for layer in packet.layers]
-
-  def get_sniff_ts(self, packet):
-    return packet.sniff_timestamp
-
-  def get_src(self, packet):
-    if self.layer_exist(packet, "ip"):
-      return packet.ip.src
-    elif self.layer_exist(packet, "eth"):
-      return packet.eth.src
-    elif self.layer_exist(packet, "wlan"):
-      if "sa" in dir(packet.wlan):
-        return packet.wlan.sa
-      elif "ta" in dir(packet.wlan):
-        return packet.wlan.ta + " (TA)"
-    return None
-
-  def get_dst(self, packet):
-    if self.layer_exist(packet, "ip"):
-      return packet.ip.dst
-    elif self.layer_exist(packet, "eth"):
-      return packet.eth.dst
-    elif self.layer_exist(packet, "wlan"):
-      if "da" in dir(packet.wlan):
-        return packet.wlan.da
-      elif "ra" in dir(packet.wlan):
-        return packet.wlan.ra + " (RA)"
-    return None
-
-  def get_src_port(self, packet):
-    if self.layer_exist(packet, "tcp"):
-      return packet.tcp.srcport
-    elif self.layer_exist(packet, "udp"):
-      return packet.udp.srcport
-    return None
-
-  def get_dst_port(self, packet):
-    if self.layer_exist(packet, "tcp"):
-      return packet.tcp.dstport
-    elif self.layer_exist(packet, "udp"):
-      return packet.udp.dstport
-    return None 
-
-  def get_protocol(self, packet):
-    return packet.highest_layer
-
-  def get_length(self, packet):
-    return packet.length
+        # the staging table is emptied before each window instead of after, so a window that failed
+        # part way doesn't leave its packets behind for the next one
+        db_manager.clear_log_table(log_table)
+        db_manager.insert_log_batch(log_table, batch.logs)
+        self.summ_retention.prepare(db_manager, batch.min_ts, batch.max_ts)
+        batch.summ_rows = db_manager.summarize_table(log_table, self.summ_table, returning=True, sample_rate=self.sample_rate)
+        batch.done(spool.STEP_LOGS | spool.STEP_SUMMARY)
+    else:
+      if batch.steps & spool.STEP_LOGS:
+        # use db_manager to insert log to network_log
+        self.log_retention.prepare(db_manager, batch.min_ts, batch.max_ts)
+        db_manager.insert_log_batch(log_table, batch.logs)
+        batch.done(spool.STEP_LOGS)
+      if batch.steps & spool.STEP_SUMMARY:
+        self.summ_retention.prepare(db_manager, batch.min_ts, batch.max_ts)
+        batch.summ_rows = db_manager.insert_summary_batch(self.summ_table, batch.summ_rows, with_ids=self.publisher is not None)
+        batch.done(spool.STEP_SUMMARY)
+    if batch.steps & spool.STEP_ROLLUPS:
+      self.rollups.add(db_manager, batch.summ_rows)
+      batch.done(spool.STEP_ROLLUPS)
+      if self.publisher is not None:
+        self.publisher.publish(batch.summ_rows)
+    if batch.steps & spool.STEP_SKETCH:
+      self.sketch_retention.prepare(db_manager, batch.min_ts, batch.max_ts)
+      db_manager.insert_sketch(self.summ_table, batch.sketch)
+      batch.done(spool.STEP_SKETCH)
+
+    # clear past data based on table_timewindow
+    for table_retention in (self.log_retention, self.summ_retention, self.rollups, self.sketch_retention):
+      if table_retention is not None:
+        table_retention.enforce(db_manager, batch.end_ts)
+
+  # writes batch to the db, or to the spool when the db fails. once a flush takes longer than flush_budget
+  # or fails, windows keep going to the spool until the replayer has caught up, so the capture loop isn't held up
+  # by a slow db meanwhile, and the windows that come after a failed one are replayed after it.
+  # the decision and the append are made under spool_lock, so with several flushers a window that starts after
+  # another one was spooled is spooled too. windows that were already being written when another one failed
+  # still reach the db before it: with flush_workers > 1 windows are written side by side in no set order anyway
+  def write_or_spool(self, db_manager, batch, log_table):
+    with self.spool_lock:
+      spooled = self.spooling or self.spool.depth() > 0
+      if spooled:
+        self.spooling = False
+        self.spool.append(batch.to_bytes())
+    if spooled:
+      return
+    start_time = time.time()
+    try:
+      if db_manager.db_conn.closed:
+        db_manager.reconnect()
+      self.write_batch(db_manager, batch, log_table)
+    except (psycopg2.Error, OSError) as e:
+      try:
+        db_manager.db_conn.rollback()
+      except psycopg2.Error:
+        pass
+      with self.spool_lock:
+        self.spool_error = str(e)
+        # aging out is all that failed when there are no steps left, the next window does it
+        if batch.steps:
+          self.spool.append(batch.to_bytes())
+      return
+    if time.time()-start_time > self.flush_budget:
+      with self.spool_lock:
+        self.spooling = True
+
+  # replays a spooled window on the replayer's connection
+  def replay_batch(self, db_manager, batch):
+    log_table = self.log_table
+    if self.summ_timewindow != None and self.aggregate == "sql":
+      # its own staging table, the flushers keep using theirs while it replays
+      log_table = db_manager.create_temp_log_table(self.log_table, f"{self.log_table}_replay")
+    self.write_batch(db_manager, batch, log_table)
 
   # Functions to monitor the program
 
-  def log_monitor(self, screen, log_batch, log_table, summ_table=None):
+  def log_monitor(self, window, log_table, summ_table=None):
+    # flusher threads and the renderer share these
+    with self.monitor_lock:
+      self.update_monitor(window, log_table, summ_table)
+
+  def update_monitor(self, window, log_table, summ_table=None):
     cur_ts = time.time()
-    latest_ts = float(log_batch[len(log_batch)-1][0])
+    latest_ts = window.end_ts
     delay_ts = cur_ts-latest_ts
 
-    self.total_delay = delay_ts
+    self.total_delay += delay_ts
     self.delay_count += 1
-    if (cur_ts - self.check_ts) >= self.display_rate:
-      self.avg_delay = self.total_delay/self.delay_count
-
-      # get summ pps info and print it
-      # organized by highest pps, lowest delay. only look at 60sec time window.
-      pps_info = self.db_manager.get_summ_pps_info(self.summ_table, self.display_size)
-      sorted_pps_info = sorted(pps_info, key=lambda info: (-info[5], info[4]))
-
-      screen.clear()
-      screen.print_at(f"Avg Delay: {self.avg_delay:0.2f} secs", 0, 0)
-      screen.print_at(f"Window: {self.display_size} secs", 0, 1)
-      screen.print_at(f"Total Skipped Packets: {self.skip_count}", 0, 2)
-
-      col_info = ["src:port", 26, "dst:port", 26, "last occurrence(secs)", 21, "pps", 8] # header follow by max width
-      header_str = ""
-      for i in range(0, len(col_info), 2):
-        header_str += "{0:{1}s} | ".format(col_info[i], col_info[i+1])
-      header_str = header_str[:-3]
-      screen.print_at(header_str, 0, 3)
-      screen.print_at("-"*len(header_str), 0, 4)
-
-      data_offset = 5
-      for row in range(len(sorted_pps_info)):
-        info = sorted_pps_info[row]
-        data_str = ""
-        data_str += "{0:{1}s} | ".format(info[0], col_info[1]) if info[1] is None else "{0:{1}s} | ".format(info[0]+":"+str(info[1]), col_info[1])
-        data_str += "{0:{1}s} | ".format(info[2], col_info[3]) if info[3] is None else "{0:{1}s} | ".format(info[2]+":"+str(info[3]), col_info[3])
-        for i in range(4, len(info)):
-          j = (i-2)*2+1
-          data = "{:0.2f}".format(info[i]) if isinstance(info[i], int) or isinstance(info[i], float) else str(info[i])
-          data_str += "{0:{1}s} | ".format(data, col_info[j]) if i == 4 else "{0:{1}s} | ".format(data, col_info[j])
-        data_str = data_str[:-3]
-        screen.print_at(data_str, 0, row+data_offset)
-      screen.refresh()
-
-      self.check_ts = time.time()
+    WINDOW_DELAY_SECONDS.observe(delay_ts)
+    if isinstance(window.flows, sketches.FlowSketch):
+      self.sketch_counts = (len(window.flows),) + window.flows.distinct_counts()
+
+  # what the dashboard shows, called from the renderer's thread every display_rate seconds.
+  # the delay is averaged over the windows flushed since the previous call
+  def dashboard_stats(self, max_rows):
+    cur_ts = time.time()
+    with self.monitor_lock:
+      if self.delay_count > 0:
+        self.avg_delay = self.total_delay/self.delay_count
       self.total_delay = 0
       self.delay_count = 0
+      sketch_counts = self.sketch_counts
+    stats = {"time": cur_ts, "avg_delay": self.avg_delay, "window": self.display_size, "skipped": self.skip_count,
+             "capture_pps": self.extractor.packets_per_sec(), "extractor": self.extractor.name, "sample_rate": self.sample_rate,
+             "sample_mode": self.sample_mode}
+    shard_stats = self.extractor.shard_stats()
+    if shard_stats:
+      stats["shards"] = shard_stats
+    if self.packet_queue is not None:
+      stats["queue"] = {"depth": self.packet_queue.depth(), "max_size": self.packet_queue.max_size, "max_depth": self.packet_queue.max_depth,
+                        "dropped_oldest": self.packet_queue.drop_count, "dropped_sampled": self.packet_queue.sample_drop_count}
+    if self.spool is not None:
+      error = self.replayer.error if self.replayer is not None and self.replayer.error is not None else self.spool_error
+      stats["spool"] = {"depth": self.spool.depth(), "bytes": self.spool.size(), "max_bytes": self.spool.max_bytes, "age": self.spool.age(),
+                        "replayed": self.spool.replayed, "dropped": self.spool.dropped, "corrupt": self.spool.corrupt, "failed": self.spool.failed,
+                        "error": error if self.spool.depth() > 0 else None}
+    if sketch_counts is not None:
+      stats["sketch"] = {"flows": sketch_counts[0], "max_flows": self.sketch_flows, "distinct_src": sketch_counts[1],
+                         "distinct_dst": sketch_counts[2], "distinct_dstport": sketch_counts[3]}
+    # organized by highest pps, lowest delay. only look at display_size secs of packets.
+    stats["flows"] = dashboard.flow_dicts(self.flow_tracker.top(max_rows, cur_ts))
+    return stats
+
+  def dashboard_lines(self, stats, width):
+    lines = [f"Avg Delay: {stats['avg_delay']:0.2f} secs",
+             f"Window: {stats['window']} secs",
+             f"Total Skipped Packets: {stats['skipped']}",
+             f"Capture: {stats['capture_pps']:0.0f} pkts/sec ({stats['extractor']})"]
+    if stats["sample_rate"] > 1:
+      lines[-1] += f" | sampling 1 in {stats['sample_rate']} ({stats['sample_mode']}), pps scaled up"
+    if "shards" in stats:
+      lines.append("Shards: " + " | ".join(f"{shard['name']} {shard['pps']:0.0f} pkts/sec, {shard['dropped']} dropped" for shard in stats["shards"]))
+    if "queue" in stats:
+      queue = stats["queue"]
+      lines.append(f"Queue: {queue['depth']}/{queue['max_size']} (max {queue['max_depth']}) | Dropped: {queue['dropped_oldest']} oldest, {queue['dropped_sampled']} sampled")
+    if "spool" in stats:
+      spool_stats = stats["spool"]
+      spool_str = f"Spool: {spool_stats['depth']} windows, {spool_stats['bytes']/1024/1024:0.0f}/{spool_stats['max_bytes']/1024/1024:0.0f} MB, oldest {spool_stats['age']:0.1f} secs"
+      spool_str += f" | replayed {spool_stats['replayed']}, dropped {spool_stats['dropped']}, corrupt {spool_stats['corrupt']}, failed {spool_stats['failed']}"
+      if spool_stats["error"]:
+        spool_str += f" | {spool_stats['error'].splitlines()[0]}"
+      lines.append(spool_str)
+    if "sketch" in stats:
+      sketch = stats["sketch"]
+      lines.append(f"Sketch: {sketch['flows']}/{sketch['max_flows']} flows tracked | ~{sketch['distinct_src']} srcs, ~{sketch['distinct_dst']} dsts, ~{sketch['distinct_dstport']} dst ports")
+    col_info = ["src:port", 26, "dst:port", 26, "last occurrence(secs)", 21, "pps", 8] # header follow by max width
+    return lines + dashboard.flow_table_lines(col_info, stats["flows"])
 
 def main():
   parser = argparse.ArgumentParser()
-  parser.add_argument("-interface", required=True, help="Interface to sniff")
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument("-interface", nargs="+", help="Interface to sniff, or several interfaces to sniff in parallel processes")
+  source.add_argument("-pcap", help="Capture file to replay through the pipeline instead of sniffing an interface")
+  parser.add_argument("-replay_speed", type=float, default=0, help="With -pcap, replay speed relative to the original timing (1 = original, 2 = twice as fast). 0 replays as fast as possible")
+  parser.add_argument("-rebase_ts", action="store_true", help="With -pcap, shift packet timestamps so the replay looks like live traffic")
   parser.add_argument("-table_timewindow", required=True, help="Time window size of the table in mintues. Controls how much of the network is kept relative to the current timestamp")
   parser.add_argument("-summ_timewindow", required=True, help="Time window size of the summarization in seconds. Controls the the batch size in which the data is summarized")
   parser.add_argument("-log_table", required=True, help="Temporary table where the stream would be stored before being summarized")
@@ -194,11 +426,52 @@ def main():
   parser.add_argument("-database", required=True, help="Name of the database")
   parser.add_argument("-displayrate", required=True, help="Update rate, in seconds, at which the stream is displayed to the user")
   parser.add_argument("-displaysize", required=True, help="Size, in seconds, of the stream displayed to the user relative to the current timestamp")
+  parser.add_argument("-flush_workers", type=int, default=0, help="Number of background threads flushing batches to the database. 0 flushes inline on the capture loop")
+  parser.add_argument("-queue_size", type=int, default=50000, help="Max number of packets buffered between capture and the flush workers")
+  parser.add_argument("-backpressure", default="block", choices=flush_queue.BACKPRESSURE_POLICIES, help="What to do with new packets when the queue is full")
+  parser.add_argument("-queue_sample_rate", type=int, default=10, help="With -backpressure sample, keep 1 in this many packets while the queue is full")
+  parser.add_argument("-aggregate", default="sql", choices=("stream", "sql", "sketch"), help="Stage every packet in log_table and GROUP BY in Postgres (sql, fills log_table like before), summarize flows in-process as packets arrive (stream), or only summarize the heaviest flows in fixed memory (sketch)")
+  parser.add_argument("-sketch_flows", type=int, default=1000, help="With -aggregate sketch, number of heaviest flows summarized per window")
+  parser.add_argument("-hll_precision", type=int, default=12, choices=range(4, 17), metavar="[4-16]", help="With -aggregate sketch, distinct counts use 2^hll_precision registers, about 1.04/sqrt(2^hll_precision) relative error")
+  parser.add_argument("-shards", type=int, default=1, help="Number of processes capturing each interface, each parsing its share of the packets split by a hash of their addresses. With -pcap, needs -extractor raw")
+  parser.add_argument("-capture_filter", help="BPF filter, e.g. \"tcp or udp\", applied in the kernel so packets it drops are never copied to the monitor. Only when sniffing")
+  parser.add_argument("-sample_rate", type=int, default=1, help="Parse only 1 in this many packets, the counts are scaled back up and the dashboard shows their 95%% margin")
+  parser.add_argument("-sample_mode", default="count", choices=packet_extractor.SAMPLE_MODES, help="With -sample_rate, keep every sample_rate-th packet (count) or each packet with probability 1/sample_rate (random)")
+  parser.add_argument("-extractor", default="pyshark", choices=packet_extractor.EXTRACTORS, help="Packet field extraction backend: pyshark dissection, tshark fields mode, or raw pcap header parsing")
+  parser.add_argument("-copy_mode", default="memory", choices=copy_stream.COPY_MODES, help="How batches are fed to COPY: csv rows streamed from memory, PostgreSQL binary format for raw packets, or a csv file on disk for debugging")
+  parser.add_argument("-publish", help="host:port of worker_server's publish port, to push summaries to subscribed masters as soon as each window is flushed")
+  parser.add_argument("-audit_level", default="statement", choices=audit_log.AUDIT_LEVELS, help="How much of the SQL sent to the database is logged to sql_log.SQL, full and sampled fill in the parameters")
+  parser.add_argument("-audit_max_bytes", type=int, default=audit_log.MAX_BYTES, help="Bytes sql_log.SQL grows to before it is rotated")
+  parser.add_argument("-audit_max_age", type=float, default=audit_log.MAX_AGE, help="Seconds after which sql_log.SQL is rotated, 0 to only rotate on -audit_max_bytes")
+  parser.add_argument("-partition_size", type=int, help="Seconds of data in each partition of the tables. Defaults to a quarter of table_timewindow")
+  parser.add_argument("-detach_partitions", action="store_true", help="Detach partitions older than table_timewindow instead of dropping them, to archive them")
+  parser.add_argument("-archive_dir", help="Directory to archive summary rows to as compressed columnar segments before they're older than table_timewindow and dropped. query_process.py -archive_dir queries them")
+  parser.add_argument("-spool_dir", help="Directory to spool windows to while the database is down or too slow, they are written to it once it catches up")
+  parser.add_argument("-spool_max_mb", type=int, default=256, help="With -spool_dir, most MB the spool takes on disk. The oldest windows are dropped past that")
+  parser.add_argument("-flush_budget", type=float, help="With -spool_dir, seconds a window may take to be written before the next ones are spooled. Defaults to summ_timewindow")
+  parser.add_argument("-keep_raw", action="store_true", help="With -aggregate stream, also write raw packets to log_table, kept for table_timewindow")
+  parser.add_argument("-metrics_port", type=int, help="Local port to serve stage timings and counters on, in Prometheus text format at /metrics")
+  parser.add_argument("-stats_file", help="JSON file the stage timings and counters are written to every stats_interval seconds")
+  parser.add_argument("-stats_interval", type=float, default=10, help="Seconds between writes of -stats_file")
+  parser.add_argument("-headless", action="store_true", help="Run without the dashboard, e.g. as a service, and print its stats as one line of JSON every displayrate seconds instead")
   args = parser.parse_args()
+  if args.pcap is not None and args.shards > 1 and args.extractor != "raw":
+    parser.error("-shards with -pcap requires -extractor raw")
 
   # monitor = Monitor(args.interface, 20, None, "network_log", None, args.user, args.password, args.host, args.database)
-  monitor = Monitor(args.interface, float(args.table_timewindow), float(args.summ_timewindow), args.log_table, args.summ_table, args.user, args.password, args.host, args.database, float(args.displayrate), float(args.displaysize))
-  Screen.wrapper(monitor.run)
+  monitor = Monitor(args.interface, float(args.table_timewindow), float(args.summ_timewindow), args.log_table, args.summ_table, args.user, args.password, args.host, args.database, float(args.displayrate), float(args.displaysize),
+                    args.flush_workers, args.queue_size, args.backpressure, args.queue_sample_rate, args.aggregate, args.keep_raw, args.extractor,
+                    args.pcap, args.replay_speed, args.rebase_ts, args.copy_mode, args.publish,
+                    args.audit_level, args.partition_size, args.detach_partitions, args.sketch_flows, args.hll_precision,
+                    args.spool_dir, args.spool_max_mb, args.flush_budget, args.shards, args.capture_filter, args.sample_rate, args.sample_mode,
+                    args.archive_dir, args.audit_max_bytes, args.audit_max_age)
+  metrics.start_exporters(args.metrics_port, args.stats_file, args.stats_interval)
+  if args.headless:
+    monitor.run(dashboard.Renderer(monitor.dashboard_stats, None, float(args.displayrate)))
+    return
+  # only imported for the dashboard, so -headless doesn't need a terminal or asciimatics
+  from asciimatics.screen import Screen
+  Screen.wrapper(lambda screen: monitor.run(dashboard.Renderer(monitor.dashboard_stats, monitor.dashboard_lines, float(args.displayrate), screen)))
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
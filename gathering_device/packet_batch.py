@@ -0,0 +1,230 @@
+'''
+File:     packet_batch.py
+Author:   Quangtri Thai
+Contents: Columnar batch of packet logs backed by typed arrays, holding a window's raw packets until they are copied to the db.
+'''
+
+import array
+import bisect
+import csv
+import io
+import struct
+import sys
+
+import copy_stream
+
+NULL_INT = -1 # ports and lengths are never negative
+
+COLUMNS = ("ts", "src", "srcport", "dst", "dstport", "protocol", "length")
+TYPECODES = {"ts": "d", "src": "I", "srcport": "i", "dst": "I", "dstport": "i", "protocol": "I", "length": "i"}
+
+def to_int(value):
+  if value == None or value == "":
+    return NULL_INT
+  return int(value)
+
+# csv field the way copy_stream.csv_chunks' writer would write value, with None as an empty field
+def csv_field(value):
+  if value == None:
+    return ""
+  field = io.StringIO()
+  csv.writer(field, quoting=csv.QUOTE_MINIMAL, quotechar='"', delimiter=",", lineterminator="").writerow([value])
+  return field.getvalue()
+
+# Distinct values of the text columns of a batch, each stored once and referred to by its index.
+# Index 0 is NULL. The csv and binary COPY encodings of a value are made once, the first time the batch is encoded,
+# so batches that are never copied to the db (e.g. a capture shard's, see capture_shards) don't pay for them.
+class StringDictionary():
+  def __init__(self):
+    self.values = [None]
+    self.ids = {None: 0, "": 0}
+    self.csv_fields = [""]
+    self.binary_fields = [copy_stream.NULL_FIELD]
+
+  def encode(self, value):
+    index = self.ids.get(value)
+    if index is None:
+      index = self.ids[value] = len(self.values)
+      self.values.append(value)
+    return index
+
+  def encoded_csv(self):
+    for value in self.values[len(self.csv_fields):]:
+      self.csv_fields.append(csv_field(value))
+    return self.csv_fields
+
+  def encoded_binary(self):
+    for value in self.values[len(self.binary_fields):]:
+      self.binary_fields.append(copy_stream.encode_text(value))
+    return self.binary_fields
+
+  def nbytes(self):
+    return (sys.getsizeof(self.values) + sys.getsizeof(self.ids) + sys.getsizeof(self.csv_fields) + sys.getsizeof(self.binary_fields) +
+            sum(sys.getsizeof(value) for value in self.values[1:]) +
+            sum(sys.getsizeof(field) for field in self.csv_fields[1:]) +
+            sum(sys.getsizeof(field) for field in self.binary_fields[1:]))
+
+# Packet logs ([sniff_ts, src, srcport, dst, dstport, protocol, length], see packet_extractor) stored as columns:
+# float64 timestamps, int32 ports and lengths with -1 for NULL, and the addresses and protocol as uint32 indexes
+# into a StringDictionary, so a packet costs 28 bytes plus its share of the distinct values instead of a list of
+# seven objects. Iterating gives the logs back as tuples, and the batch is encoded for COPY straight from the columns.
+class PacketBatch():
+  def __init__(self, strings=None):
+    self.ts = array.array(TYPECODES["ts"])
+    self.src = array.array(TYPECODES["src"])
+    self.srcport = array.array(TYPECODES["srcport"])
+    self.dst = array.array(TYPECODES["dst"])
+    self.dstport = array.array(TYPECODES["dstport"])
+    self.protocol = array.array(TYPECODES["protocol"])
+    self.length = array.array(TYPECODES["length"])
+    # slices share the dictionary of the batch they were cut from
+    self.strings = strings if strings is not None else StringDictionary()
+    self.ordered = True # timestamps never went backwards, so time ranges can be found by bisection
+
+  def append(self, log):
+    ts = float(log[0])
+    if self.ordered and self.ts and ts < self.ts[-1]:
+      self.ordered = False
+    encode = self.strings.encode
+    self.ts.append(ts)
+    self.src.append(encode(log[1]))
+    self.srcport.append(to_int(log[2]))
+    self.dst.append(encode(log[3]))
+    self.dstport.append(to_int(log[4]))
+    self.protocol.append(encode(log[5]))
+    self.length.append(to_int(log[6]))
+
+  def __len__(self):
+    return len(self.ts)
+
+  def __getitem__(self, i):
+    values = self.strings.values
+    return (self.ts[i], values[self.src[i]], None if self.srcport[i] < 0 else self.srcport[i],
+            values[self.dst[i]], None if self.dstport[i] < 0 else self.dstport[i],
+            values[self.protocol[i]], None if self.length[i] < 0 else self.length[i])
+
+  def __iter__(self):
+    values = self.strings.values
+    for ts, src, srcport, dst, dstport, protocol, length in zip(self.ts, self.src, self.srcport, self.dst, self.dstport, self.protocol, self.length):
+      yield (ts, values[src], None if srcport < 0 else srcport, values[dst], None if dstport < 0 else dstport,
+             values[protocol], None if length < 0 else length)
+
+  # the packets with start_ts <= timestamp < end_ts, in a new batch sharing this one's dictionary
+  def slice(self, start_ts=None, end_ts=None):
+    if self.ordered:
+      start = 0 if start_ts is None else bisect.bisect_left(self.ts, start_ts)
+      end = len(self.ts) if end_ts is None else bisect.bisect_left(self.ts, end_ts)
+      indexes = range(start, max(start, end))
+    else:
+      indexes = [i for i, ts in enumerate(self.ts) if (start_ts is None or ts >= start_ts) and (end_ts is None or ts < end_ts)]
+    batch = PacketBatch(self.strings)
+    batch.ordered = self.ordered
+    if isinstance(indexes, range):
+      for column in COLUMNS:
+        setattr(batch, column, getattr(self, column)[indexes.start:indexes.stop])
+      return batch
+    for column in COLUMNS:
+      values = getattr(self, column)
+      getattr(batch, column).extend(values[i] for i in indexes)
+    return batch
+
+  # packet count, ordered, the columns as they are in memory, then the dictionary's strings.
+  # meant for the local spool, the columns are in the machine's byte order
+  def to_bytes(self):
+    parts = [struct.pack("!IB", len(self.ts), self.ordered)]
+    for column in COLUMNS:
+      parts.append(getattr(self, column).tobytes())
+    parts.append(struct.pack("!I", len(self.strings.values)-1))
+    for value in self.strings.values[1:]:
+      data = str(value).encode("utf-8")
+      parts.append(struct.pack("!I", len(data)) + data)
+    return b"".join(parts)
+
+  @classmethod
+  def from_bytes(cls, data):
+    count, ordered = struct.unpack_from("!IB", data, 0)
+    offset = 5
+    batch = cls()
+    batch.ordered = bool(ordered)
+    for column in COLUMNS:
+      values = getattr(batch, column)
+      values.frombytes(data[offset:offset+count*values.itemsize])
+      offset += count*values.itemsize
+    string_count = struct.unpack_from("!I", data, offset)[0]
+    offset += 4
+    for i in range(string_count):
+      length = struct.unpack_from("!I", data, offset)[0]
+      offset += 4
+      batch.strings.encode(data[offset:offset+length].decode("utf-8"))
+      offset += length
+    return batch
+
+  # the logs of a to_bytes encoding as lists, without building a batch and its COPY encodings
+  @staticmethod
+  def read_logs(data):
+    count = struct.unpack_from("!I", data, 0)[0]
+    offset = 5
+    columns = []
+    for column in COLUMNS:
+      values = array.array(TYPECODES[column])
+      values.frombytes(data[offset:offset+count*values.itemsize])
+      offset += count*values.itemsize
+      columns.append(values)
+    string_count = struct.unpack_from("!I", data, offset)[0]
+    offset += 4
+    strings = [None]
+    for i in range(string_count):
+      length = struct.unpack_from("!I", data, offset)[0]
+      offset += 4
+      strings.append(data[offset:offset+length].decode("utf-8"))
+      offset += length
+    for ts, src, srcport, dst, dstport, protocol, length in zip(*columns):
+      yield [ts, strings[src], None if srcport < 0 else srcport, strings[dst], None if dstport < 0 else dstport,
+             strings[protocol], None if length < 0 else length]
+
+  # bytes held by the columns and the dictionary
+  def nbytes(self):
+    columns = sum(column.itemsize*len(column) for column in (self.ts, self.src, self.srcport, self.dst, self.dstport, self.protocol, self.length))
+    return columns + self.strings.nbytes()
+
+  # csv chunks for COPY in the same format as copy_stream.csv_chunks, with the text fields already encoded
+  def csv_chunks(self, rows_per_chunk=1000):
+    fields = self.strings.encoded_csv()
+    def int_field(value):
+      return "" if value < 0 else str(value)
+    lines = []
+    for ts, src, srcport, dst, dstport, protocol, length in zip(self.ts, self.src, self.srcport, self.dst, self.dstport, self.protocol, self.length):
+      lines.append(f"{ts!r},{fields[src]},{int_field(srcport)},{fields[dst]},{int_field(dstport)},{fields[protocol]},{int_field(length)}\r\n")
+      if len(lines) == rows_per_chunk:
+        yield "".join(lines).encode("utf-8")
+        lines = []
+    if lines:
+      yield "".join(lines).encode("utf-8")
+
+  # PostgreSQL binary COPY of the batch for copy_stream.LOG_BATCH_TYPES columns, with the text fields already encoded
+  def binary_chunks(self, rows_per_chunk=1000):
+    fields = self.strings.encoded_binary()
+    row_start = struct.Struct("!hid") # field count, then the float8 timestamp's length and value
+    int_field = struct.Struct("!ii")
+    null_field = copy_stream.NULL_FIELD
+    yield copy_stream.BINARY_HEADER
+    chunk = []
+    for ts, src, srcport, dst, dstport, protocol, length in zip(self.ts, self.src, self.srcport, self.dst, self.dstport, self.protocol, self.length):
+      chunk.append(row_start.pack(7, 8, ts))
+      chunk.append(fields[src])
+      chunk.append(null_field if srcport < 0 else int_field.pack(4, srcport))
+      chunk.append(fields[dst])
+      chunk.append(null_field if dstport < 0 else int_field.pack(4, dstport))
+      chunk.append(fields[protocol])
+      chunk.append(null_field if length < 0 else int_field.pack(4, length))
+      if len(chunk) == rows_per_chunk*7:
+        yield b"".join(chunk)
+        chunk = []
+    chunk.append(copy_stream.BINARY_TRAILER)
+    yield b"".join(chunk)
+
+  def csv_reader(self):
+    return copy_stream.ChunkReader(self.csv_chunks())
+
+  def binary_reader(self):
+    return copy_stream.ChunkReader(self.binary_chunks())
@@ -0,0 +1,487 @@
+'''
+File:     packet_extractor.py
+Author:   Quangtri Thai
+Contents: Capture backends that turn sniffed packets into the monitor's log format.
+'''
+
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import time
+
+import metrics
+
+EXTRACTORS = ("pyshark", "tshark", "raw")
+SAMPLE_MODES = ("count", "random")
+
+CAPTURED_PACKETS = metrics.counter("captured_packets_total", "Packets read by the extractor")
+EXTRACT_SECONDS = metrics.histogram("extract_seconds", "Time to read and parse each packet, including waiting for it on a live interface")
+
+# Every extractor yields logs as [sniff_ts, src, srcport, dst, dstport, protocol, length],
+# with None for fields that are not found, and counts packets to report its throughput.
+# sniff_ts is parsed to a float here, once, so the rest of the pipeline doesn't parse it again.
+# Extractors sniff a live interface, or replay pcap_file when it is given:
+#   replay_speed 0 replays as fast as possible, 1 at the original timing, 2 twice as fast, ...
+#   rebase_ts shifts the packet timestamps so the first packet is stamped with the time replay started
+# capture_filter is a BPF filter applied by the capture tool when sniffing, e.g. to split an interface between processes.
+# sampler, a Sampler, picks the packets that are kept before their fields are extracted.
+class Extractor():
+  name = None
+
+  def __init__(self, interface=None, pcap_file=None, replay_speed=0, rebase_ts=False, capture_filter=None, sampler=None):
+    self.interface = interface
+    self.capture_filter = capture_filter
+    self.sampler = sampler
+    self.pcap_file = pcap_file
+    self.replay_speed = replay_speed
+    self.rebase_ts = rebase_ts
+    self.packet_count = 0
+    self.start_time = None
+    self.rate_count = 0
+    self.rate_time = None
+    self.first_ts = None
+    self.ts_offset = 0
+
+  def logs(self):
+    replaying = self.pcap_file is not None and (self.replay_speed > 0 or self.rebase_ts)
+    read_start = time.perf_counter()
+    for log in self.read_logs():
+      EXTRACT_SECONDS.observe(time.perf_counter()-read_start)
+      log[0] = float(log[0])
+      self.count_packet()
+      CAPTURED_PACKETS.inc()
+      if replaying:
+        self.replay(log)
+      yield log
+      read_start = time.perf_counter()
+
+  # implemented by each extractor
+  def read_logs(self):
+    raise NotImplementedError
+
+  def replay(self, log):
+    ts = float(log[0])
+    if self.first_ts is None:
+      self.first_ts = ts
+      self.ts_offset = self.start_time-ts
+    if self.replay_speed > 0:
+      wait = self.start_time+(ts-self.first_ts)/self.replay_speed-time.time()
+      if wait > 0:
+        time.sleep(wait)
+    if self.rebase_ts:
+      log[0] = ts+self.ts_offset
+
+  def count_packet(self):
+    if self.start_time is None:
+      self.start_time = time.time()
+      self.rate_time = self.start_time
+    self.packet_count += 1
+
+  # packets/sec since the previous call
+  def packets_per_sec(self):
+    cur_time = time.time()
+    if self.rate_time is None or cur_time <= self.rate_time:
+      return 0
+    pps = (self.packet_count-self.rate_count)/(cur_time-self.rate_time)
+    self.rate_count = self.packet_count
+    self.rate_time = cur_time
+    return pps
+
+  # packets/sec since the first packet
+  def avg_packets_per_sec(self):
+    if self.start_time is None or time.time() <= self.start_time:
+      return 0
+    return self.packet_count/(time.time()-self.start_time)
+
+  # whether the next packet is kept, called by read_logs before extracting it
+  def keep(self):
+    return self.sampler is None or self.sampler.keep()
+
+  # throughput and drops of each capture process, see capture_shards.ShardedExtractor. empty for a single capture
+  def shard_stats(self):
+    return []
+
+  def close(self):
+    pass
+
+# Full pyshark dissection. Slowest, but the reference the other extractors are matched against.
+class PysharkExtractor(Extractor):
+  name = "pyshark"
+
+  def __init__(self, interface=None, pcap_file=None, replay_speed=0, rebase_ts=False, capture_filter=None, sampler=None):
+    super().__init__(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
+    import pyshark
+    if pcap_file is not None:
+      self.capture = pyshark.FileCapture(pcap_file, keep_packets=False)
+    else:
+      self.capture = pyshark.LiveCapture(interface=interface, bpf_filter=capture_filter)
+
+  def read_logs(self):
+    packets = self.capture if self.pcap_file is not None else self.capture.sniff_continuously()
+    for packet in packets:
+      if self.keep():
+        yield self.extract(packet)
+
+  def extract(self, packet):
+    # layer names are looked up once per packet instead of once per field
+    layers = set([layer.layer_name for layer in packet.layers])
+    log = []
+    log.append(self.get_sniff_ts(packet))
+    log.append(self.get_src(packet, layers))
+    log.append(self.get_src_port(packet, layers))
+    log.append(self.get_dst(packet, layers))
+    log.append(self.get_dst_port(packet, layers))
+    log.append(self.get_protocol(packet))
+    log.append(self.get_length(packet))
+    return log
+
+  # Functions to get info from the packet, often returning None if not found
+
+  def get_sniff_ts(self, packet):
+    return packet.sniff_timestamp
+
+  def get_src(self, packet, layers):
+    if "ip" in layers:
+      return packet.ip.src
+    elif "ipv6" in layers:
+      return packet.ipv6.src
+    elif "eth" in layers:
+      return packet.eth.src
+    elif "wlan" in layers:
+      field_names = packet.wlan.field_names
+      if "sa" in field_names:
+        return packet.wlan.sa
+      elif "ta" in field_names:
+        return packet.wlan.ta + " (TA)"
+    return None
+
+  def get_dst(self, packet, layers):
+    if "ip" in layers:
+      return packet.ip.dst
+    elif "ipv6" in layers:
+      return packet.ipv6.dst
+    elif "eth" in layers:
+      return packet.eth.dst
+    elif "wlan" in layers:
+      field_names = packet.wlan.field_names
+      if "da" in field_names:
+        return packet.wlan.da
+      elif "ra" in field_names:
+        return packet.wlan.ra + " (RA)"
+    return None
+
+  def get_src_port(self, packet, layers):
+    if "tcp" in layers:
+      return packet.tcp.srcport
+    elif "udp" in layers:
+      return packet.udp.srcport
+    return None
+
+  def get_dst_port(self, packet, layers):
+    if "tcp" in layers:
+      return packet.tcp.dstport
+    elif "udp" in layers:
+      return packet.udp.dstport
+    return None
+
+  def get_protocol(self, packet):
+    return packet.highest_layer
+
+  def get_length(self, packet):
+    return packet.length
+
+  def close(self):
+    self.capture.close()
+
+# Runs tshark in fields mode and parses its tab separated output line by line,
+# so no per-packet Python object tree is ever built.
+class TsharkExtractor(Extractor):
+  name = "tshark"
+
+  # order matters, see extract
+  FIELDS = ("frame.time_epoch",
+            "ip.src", "ipv6.src", "eth.src", "wlan.sa", "wlan.ta",
+            "ip.dst", "ipv6.dst", "eth.dst", "wlan.da", "wlan.ra",
+            "tcp.srcport", "udp.srcport", "tcp.dstport", "udp.dstport",
+            "frame.protocols", "frame.len")
+
+  def __init__(self, interface=None, pcap_file=None, replay_speed=0, rebase_ts=False, capture_filter=None, sampler=None):
+    super().__init__(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
+    if shutil.which("tshark") is None:
+      raise RuntimeError("tshark is not installed")
+    self.process = None
+
+  def command(self):
+    source = ["-r", self.pcap_file] if self.pcap_file is not None else ["-i", self.interface]
+    if self.pcap_file is None and self.capture_filter is not None:
+      source += ["-f", self.capture_filter]
+    cmd = ["tshark", "-l", "-n", "-Q"] + source + ["-T", "fields", "-E", "separator=/t", "-E", "occurrence=f"]
+    for field in self.FIELDS:
+      cmd += ["-e", field]
+    return cmd
+
+  def read_logs(self):
+    self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    for line in self.process.stdout:
+      if self.keep():
+        yield self.extract(line)
+
+  def extract(self, line):
+    f = [value if value != "" else None for value in line.rstrip("\n").split("\t")]
+    if len(f) < len(self.FIELDS):
+      f += [None]*(len(self.FIELDS)-len(f))
+    ts, ip_src, ipv6_src, eth_src, wlan_sa, wlan_ta, ip_dst, ipv6_dst, eth_dst, wlan_da, wlan_ra = f[:11]
+    tcp_srcport, udp_srcport, tcp_dstport, udp_dstport, protocols, length = f[11:]
+
+    src = ip_src or ipv6_src or eth_src or wlan_sa or (wlan_ta + " (TA)" if wlan_ta else None)
+    dst = ip_dst or ipv6_dst or eth_dst or wlan_da or (wlan_ra + " (RA)" if wlan_ra else None)
+    srcport = tcp_srcport or udp_srcport
+    dstport = tcp_dstport or udp_dstport
+    # pyshark's highest_layer is the last dissected layer, which is the end of frame.protocols
+    protocol = protocols.rsplit(":", 1)[-1].upper() if protocols else None
+    return [ts, src, srcport, dst, dstport, protocol, length]
+
+  def close(self):
+    if self.process is not None:
+      self.process.terminate()
+
+# Reads raw pcap frames from dumpcap, or straight from a pcap (not pcapng) file, and decodes the
+# Ethernet/802.11/IPv4/IPv6/TCP/UDP headers directly.
+# The protocol column is the highest layer decoded here (e.g. TCP), not the application protocol tshark would report.
+class RawPcapExtractor(Extractor):
+  name = "raw"
+
+  LINKTYPE_ETHERNET = 1
+  LINKTYPE_IEEE802_11 = 105
+  LINKTYPE_IEEE802_11_RADIOTAP = 127
+
+  IP_PROTOCOLS = {1: "ICMP", 2: "IGMP", 6: "TCP", 17: "UDP", 58: "ICMPV6"}
+  # IPv6 extension headers walked to reach the upper layer header: hop-by-hop options, routing, fragment,
+  # destination options and authentication
+  IPV6_EXTENSION_HEADERS = (0, 43, 44, 60, 51)
+
+  def __init__(self, interface=None, pcap_file=None, replay_speed=0, rebase_ts=False, capture_filter=None, sampler=None):
+    super().__init__(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
+    if pcap_file is None and shutil.which("dumpcap") is None:
+      raise RuntimeError("dumpcap is not installed")
+    self.process = None
+    self.shard = None # (index, count) to only decode every count-th record of pcap_file from index, see capture_shards
+
+  def command(self):
+    cmd = ["dumpcap", "-q", "-P", "-i", self.interface, "-w", "-"]
+    if self.capture_filter is not None:
+      cmd += ["-f", self.capture_filter]
+    return cmd
+
+  def read_logs(self):
+    if self.pcap_file is not None:
+      with open(self.pcap_file, "rb") as pcap:
+        for log in self.read_pcap(pcap):
+          yield log
+      return
+    self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for log in self.read_pcap(self.process.stdout):
+      yield log
+
+  def read_pcap(self, stream):
+    header = read_exact(stream, 24)
+    if header is None:
+      return
+    magic = header[:4]
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+      endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+      endian = ">"
+    else:
+      raise ValueError("Not a pcap stream (pcapng is not supported by the raw extractor)")
+    nano = magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+    linktype = struct.unpack(endian + "I", header[20:24])[0]
+    record_header = struct.Struct(endian + "IIII")
+
+    record = -1
+    while True:
+      rec = read_exact(stream, 16)
+      if rec is None:
+        return
+      ts_sec, ts_frac, incl_len, orig_len = record_header.unpack(rec)
+      frame = read_exact(stream, incl_len)
+      if frame is None:
+        return
+      record += 1
+      if self.shard is not None and record % self.shard[1] != self.shard[0]:
+        continue
+      if not self.keep():
+        continue
+      ts = f"{ts_sec}.{ts_frac:09d}" if nano else f"{ts_sec}.{ts_frac:06d}"
+      yield self.extract(ts, linktype, frame, orig_len)
+
+  def extract(self, ts, linktype, frame, length):
+    log = [ts, None, None, None, None, None, length]
+    try:
+      if linktype == self.LINKTYPE_ETHERNET:
+        self.decode_ethernet(log, frame)
+      elif linktype == self.LINKTYPE_IEEE802_11:
+        self.decode_wlan(log, frame)
+      elif linktype == self.LINKTYPE_IEEE802_11_RADIOTAP:
+        radiotap_len = struct.unpack("<H", frame[2:4])[0]
+        self.decode_wlan(log, frame[radiotap_len:])
+    except (IndexError, struct.error):
+      # truncated frame, keep whatever was decoded so far
+      pass
+    return log
+
+  def decode_ethernet(self, log, frame):
+    log[1] = format_mac(frame[6:12])
+    log[3] = format_mac(frame[0:6])
+    log[5] = "ETH"
+    ethertype = struct.unpack("!H", frame[12:14])[0]
+    offset = 14
+    while ethertype in (0x8100, 0x88a8):
+      ethertype = struct.unpack("!H", frame[offset+2:offset+4])[0]
+      offset += 4
+    self.decode_ethertype(log, ethertype, frame, offset)
+
+  def decode_wlan(self, log, frame):
+    fc0, fc1 = frame[0], frame[1]
+    frame_type = (fc0 >> 2) & 0x3
+    subtype = (fc0 >> 4) & 0xf
+    to_ds, from_ds = fc1 & 0x1, (fc1 >> 1) & 0x1
+    log[5] = "WLAN"
+    if frame_type == 1:
+      # control frames only carry receiver/transmitter addresses, and ACK/CTS have no transmitter
+      log[3] = format_mac(frame[4:10]) + " (RA)"
+      if len(frame) >= 16 and subtype not in (12, 13):
+        log[1] = format_mac(frame[10:16]) + " (TA)"
+      return
+    addr1, addr2, addr3 = format_mac(frame[4:10]), format_mac(frame[10:16]), format_mac(frame[16:22])
+    if frame_type == 0 or (not to_ds and not from_ds):
+      log[1], log[3] = addr2, addr1
+    elif not to_ds and from_ds:
+      log[1], log[3] = addr3, addr1
+    elif to_ds and not from_ds:
+      log[1], log[3] = addr2, addr3
+    else:
+      log[1], log[3] = format_mac(frame[24:30]), addr3
+    if frame_type != 2 or fc1 & 0x40:
+      # management frame, or a protected data frame whose payload can't be read
+      return
+    offset = 24
+    if to_ds and from_ds:
+      offset += 6
+    if subtype & 0x8:
+      offset += 2
+      if fc1 & 0x80:
+        offset += 4
+    # LLC/SNAP header carries the ethertype
+    if frame[offset:offset+3] == b"\xaa\xaa\x03":
+      ethertype = struct.unpack("!H", frame[offset+6:offset+8])[0]
+      self.decode_ethertype(log, ethertype, frame, offset+8)
+
+  def decode_ethertype(self, log, ethertype, frame, offset):
+    if ethertype == 0x0806:
+      log[5] = "ARP"
+    elif ethertype == 0x86dd:
+      self.decode_ipv6(log, frame, offset)
+    elif ethertype == 0x0800:
+      self.decode_ipv4(log, frame, offset)
+
+  # a header cut off by the snaplen, or with a header length shorter than its fixed part, keeps the MAC addresses
+  def decode_ipv4(self, log, frame, offset):
+    log[5] = "IP"
+    if len(frame) < offset+20:
+      return
+    ihl = (frame[offset] & 0xf)*4
+    if ihl < 20:
+      return
+    protocol = frame[offset+9]
+    log[1] = ".".join(str(b) for b in frame[offset+12:offset+16])
+    log[3] = ".".join(str(b) for b in frame[offset+16:offset+20])
+    log[5] = self.IP_PROTOCOLS.get(protocol, "IP")
+    fragment_offset = struct.unpack("!H", frame[offset+6:offset+8])[0] & 0x1fff
+    if fragment_offset == 0:
+      self.decode_ports(log, protocol, frame, offset+ihl)
+
+  def decode_ipv6(self, log, frame, offset):
+    log[5] = "IPV6"
+    if len(frame) < offset+40:
+      return
+    log[1] = socket.inet_ntop(socket.AF_INET6, frame[offset+8:offset+24])
+    log[3] = socket.inet_ntop(socket.AF_INET6, frame[offset+24:offset+40])
+    next_header = frame[offset+6]
+    offset += 40
+    first_fragment = True
+    while next_header in self.IPV6_EXTENSION_HEADERS:
+      header = frame[offset:offset+8]
+      if len(header) < 8:
+        return
+      if next_header == 44:
+        first_fragment = first_fragment and struct.unpack("!H", header[2:4])[0] & 0xfff8 == 0
+        length = 8
+      elif next_header == 51:
+        length = (header[1]+2)*4
+      else:
+        length = (header[1]+1)*8
+      next_header = header[0]
+      offset += length
+    if next_header == 59:
+      # no next header
+      return
+    log[5] = self.IP_PROTOCOLS.get(next_header, "IPV6")
+    if first_fragment:
+      self.decode_ports(log, next_header, frame, offset)
+
+  # ports of a TCP or UDP header at offset, left as None for other protocols or a header cut off by the snaplen
+  def decode_ports(self, log, protocol, frame, offset):
+    if protocol in (6, 17) and len(frame) >= offset+4:
+      log[2], log[4] = struct.unpack("!HH", frame[offset:offset+4])
+
+# Keeps 1 in rate packets, every rate-th one ("count") or each one with probability 1/rate ("random"), so a Pi
+# that can't dissect every packet measures a known share of them. Counts are scaled back up by rate, see
+# flow_tracker.FlowTracker and rollup.rollup_rows. Random sampling doesn't alias with periodic traffic.
+class Sampler():
+  def __init__(self, rate, mode="count", seed=None):
+    self.rate = rate
+    self.mode = mode
+    self.random = random.Random(seed)
+    self.seen = 0
+    self.kept = 0
+
+  def keep(self):
+    self.seen += 1
+    if self.mode == "random":
+      kept = self.random.random()*self.rate < 1
+    else:
+      kept = self.seen % self.rate == 0
+    if kept:
+      self.kept += 1
+    return kept
+
+def make_sampler(rate, mode="count"):
+  return Sampler(rate, mode) if rate > 1 else None
+
+def format_mac(addr):
+  return ":".join("%02x" % b for b in addr)
+
+def read_exact(stream, size):
+  data = b""
+  while len(data) < size:
+    chunk = stream.read(size-len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return data
+
+# falls back to pyshark when the external capture tool for the requested extractor is missing
+# sample_rate > 1 keeps 1 in sample_rate packets, see Sampler
+def make_extractor(name, interface=None, pcap_file=None, replay_speed=0, rebase_ts=False, capture_filter=None, sample_rate=1, sample_mode="count"):
+  sampler = make_sampler(sample_rate, sample_mode)
+  try:
+    if name == "tshark":
+      return TsharkExtractor(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
+    elif name == "raw":
+      return RawPcapExtractor(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
+  except RuntimeError as e:
+    print(f"{name} extractor unavailable ({e}), falling back to pyshark")
+  return PysharkExtractor(interface, pcap_file, replay_speed, rebase_ts, capture_filter, sampler)
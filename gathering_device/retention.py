@@ -0,0 +1,92 @@
+'''
+File:     retention.py
+Author:   Quangtri Thai
+Contents: Keeps a table to its time window by creating and dropping whole time range partitions instead of deleting rows.
+'''
+
+import math
+import threading
+
+# table is range partitioned on column (a timestamp in seconds) into partitions of partition_size seconds,
+# named <table>_p<lower bound>. Partitions are created before rows for them are inserted, precreate of them ahead
+# of the newest row, and a partition is dropped (or only detached with detach) once all of it is older than
+# window_size seconds before the newest row, so rows live up to partition_size longer than window_size.
+# When table isn't partitioned, e.g. made by an older version from the README, old rows are deleted like before.
+# Shared by every db_manager of a program, the state only lives here and each call does its sql on the db_manager given.
+# With shared, other programs also create partitions in table (the master's table with worker_server -transport db),
+# so the partitions are read from the db again before each enforce to drop theirs too.
+# With archiver (summary_archive.SummaryArchiver), rows are archived to disk as they are removed.
+class RetentionManager():
+  def __init__(self, table, column, window_size, partition_size=None, precreate=2, detach=False, unlogged=False, shared=False,
+               archiver=None):
+    self.table = table
+    self.column = column
+    self.window_size = window_size
+    # a few partitions per window by default, so at most a quarter window is kept past table_timewindow
+    self.partition_size = partition_size if partition_size else max(60, int(window_size/4))
+    self.precreate = precreate
+    self.detach = detach
+    self.unlogged = unlogged
+    self.shared = shared
+    self.archiver = archiver
+    self.partitioned = None # unknown until the first call
+    self.partitions = None # lower bounds of the partitions that exist
+    self.lock = threading.Lock()
+    self.dropped = 0
+
+  def load(self, db_manager):
+    if self.partitioned is not None:
+      return
+    self.partitioned = db_manager.is_partitioned(self.table)
+    self.partitions = set()
+    if self.partitioned:
+      # a table keeps the partition size it was made with, whoever made it
+      prefix = self.table + "_p"
+      for partition, lower, upper in db_manager.get_partitions(self.table):
+        if partition.startswith(prefix) and partition[len(prefix):].isdigit() and lower is not None:
+          self.partitions.add(int(partition[len(prefix):]))
+          self.partition_size = int(upper-lower)
+
+  def partition_name(self, lower):
+    return f"{self.table}_p{lower}"
+
+  def bucket(self, ts):
+    return int(math.floor(ts/self.partition_size))*self.partition_size
+
+  # makes sure rows with min_ts <= column <= max_ts have a partition to go to
+  def prepare(self, db_manager, min_ts, max_ts):
+    with self.lock:
+      self.load(db_manager)
+      if not self.partitioned or min_ts is None:
+        return
+      lower = self.bucket(min_ts)
+      last = self.bucket(max_ts)+self.precreate*self.partition_size
+      while lower <= last:
+        if lower not in self.partitions:
+          db_manager.create_partition(self.table, self.partition_name(lower), lower, lower+self.partition_size, self.unlogged)
+          self.partitions.add(lower)
+        lower += self.partition_size
+
+  # removes what is older than window_size before latest_ts
+  def enforce(self, db_manager, latest_ts):
+    if latest_ts is None:
+      return
+    clear_ts = latest_ts-self.window_size
+    with self.lock:
+      if self.shared:
+        self.partitioned = None
+      self.load(db_manager)
+      if not self.partitioned:
+        if self.archiver is not None:
+          self.archiver.archive_older_rows(db_manager, self.table, self.column, clear_ts)
+        else:
+          db_manager.delete_older_rows(self.table, self.column, clear_ts)
+        return
+      for lower in sorted(self.partitions):
+        if lower+self.partition_size > clear_ts:
+          break
+        if self.archiver is not None:
+          self.archiver.archive(db_manager, self.partition_name(lower))
+        db_manager.drop_partition(self.table, self.partition_name(lower), self.detach)
+        self.partitions.discard(lower)
+        self.dropped += 1
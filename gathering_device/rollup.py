@@ -0,0 +1,70 @@
+'''
+File:     rollup.py
+Author:   Quangtri Thai
+Contents: Per flow packet counts pre-aggregated into 1, 10 and 60 second buckets, so the dashboard's pps query doesn't scan the summary table.
+'''
+
+import math
+
+import retention
+
+# bucket sizes in seconds, finest first
+ROLLUP_SIZES = (1, 10, 60)
+
+def rollup_table(summ_table, size):
+  return f"{summ_table}_rollup_{size}s"
+
+# the coarsest rollup that still has at least 10 buckets in timewindow, buckets at the edge of the window are counted
+# when most of them is inside it, so the pps is off by at most about 5%
+def rollup_size(timewindow):
+  size = ROLLUP_SIZES[0]
+  for rollup_size in ROLLUP_SIZES:
+    if timewindow >= 10*rollup_size:
+      size = rollup_size
+  return size
+
+# Groups summary rows by the bucket of their max_timestamp and their flow, returns sorted
+# [(bucket, src, srcport, dst, dstport, packets, last timestamp, variance), ...]. NULL ports are -1 so they can be part of the
+# rollup's primary key, and the rows are sorted so concurrent flushers lock them in the same order.
+# Sampled rows count summ_size*sample_rate packets, an unbiased estimate whose variance, summ_size*sample_rate*(sample_rate-1)
+# for packets kept with probability 1/sample_rate, is summed alongside so the dashboard can show how far off the pps may be
+def rollup_rows(summ_rows, size):
+  buckets = {}
+  for row in summ_rows:
+    max_ts = float(row[1])
+    key = (float(math.floor(max_ts/size)*size), row[2], -1 if row[3] == None else int(row[3]),
+           row[4], -1 if row[5] == None else int(row[5]))
+    packets, last_ts, variance = buckets.get(key, (0, max_ts, 0))
+    summ_size, sample_rate = int(row[10]), int(row[11])
+    buckets[key] = (packets+summ_size*sample_rate, max(last_ts, max_ts), variance+summ_size*sample_rate*(sample_rate-1))
+  return sorted(key+value for key, value in buckets.items())
+
+# half width of the 95% confidence interval of a pps estimate with the given variance of its packet count
+def pps_margin(variance, timewindow):
+  return 1.96*math.sqrt(variance)/timewindow
+
+# The rollup tables of a summary table. They are partitioned on bucket and aged out with it like the summary table.
+class Rollups():
+  def __init__(self, summ_table, window_size, partition_size=None, detach=False):
+    self.summ_table = summ_table
+    self.retentions = {}
+    for size in ROLLUP_SIZES:
+      self.retentions[size] = retention.RetentionManager(rollup_table(summ_table, size), "bucket", window_size, partition_size,
+                                                         detach=detach)
+
+  # summ_rows are summary rows that were just inserted into summ_table. with until_id the master's watermark of
+  # the rows already rolled up is moved to until_id in the same transaction.
+  def add(self, db_manager, summ_rows, until_id=None):
+    if not summ_rows:
+      return
+    min_ts = min(float(row[1]) for row in summ_rows)
+    max_ts = max(float(row[1]) for row in summ_rows)
+    rows = {}
+    for size in ROLLUP_SIZES:
+      self.retentions[size].prepare(db_manager, min_ts-size, max_ts)
+      rows[size] = rollup_rows(summ_rows, size)
+    db_manager.insert_rollups(self.summ_table, rows, until_id)
+
+  def enforce(self, db_manager, latest_ts):
+    for size in ROLLUP_SIZES:
+      self.retentions[size].enforce(db_manager, latest_ts)
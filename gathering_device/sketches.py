@@ -0,0 +1,217 @@
+'''
+File:     sketches.py
+Author:   Quangtri Thai
+Contents: Fixed size Space-Saving and HyperLogLog sketches of the packet stream, which can be serialized and merged across gathering devices.
+'''
+
+import hashlib
+import heapq
+import itertools
+import math
+import struct
+
+import flow_aggregator
+
+def sketch_table(summ_table):
+  return f"{summ_table}_sketch"
+
+# stable across processes and machines, unlike hash(), so sketches of different Pis can be merged
+def hash64(value):
+  return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+
+def encode_string(value):
+  if value == None:
+    return struct.pack("!H", 0xffff)
+  data = str(value).encode("utf-8")[:0xfffe]
+  return struct.pack("!H", len(data)) + data
+
+def decode_string(data, offset):
+  length = struct.unpack_from("!H", data, offset)[0]
+  offset += 2
+  if length == 0xffff:
+    return None, offset
+  return data[offset:offset+length].decode("utf-8"), offset+length
+
+# HyperLogLog distinct count with 2^precision one byte registers, about 1.04/sqrt(2^precision) relative error
+class HyperLogLog():
+  def __init__(self, precision=12):
+    self.precision = precision
+    self.registers = bytearray(1 << precision)
+
+  def add(self, value):
+    x = hash64(value)
+    index = x >> (64-self.precision)
+    rest = x & ((1 << (64-self.precision))-1)
+    rank = (64-self.precision)-rest.bit_length()+1
+    if rank > self.registers[index]:
+      self.registers[index] = rank
+
+  def count(self):
+    m = len(self.registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213/(1+1.079/m))
+    estimate = alpha*m*m/sum(2.0**-rank for rank in self.registers)
+    zeros = self.registers.count(0)
+    if estimate <= 2.5*m and zeros > 0:
+      # linear counting is more accurate while few registers are set
+      estimate = m*math.log(m/zeros)
+    return int(round(estimate))
+
+  def merge(self, other):
+    if other.precision != self.precision:
+      raise ValueError("can't merge HyperLogLogs of different precisions")
+    self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+# Space-Saving top-k: at most capacity counters, a new key takes over the smallest counter and its count as error.
+# count-error <= true count <= count for every kept key, and every key with more than total/capacity packets is kept.
+# The smallest counter is found with a heap whose entries are only brought up to date when they reach the top.
+class SpaceSaving():
+  def __init__(self, capacity=1000):
+    self.capacity = capacity
+    self.counters = {} # key -> [count, error]
+    self.heap = [] # [(count when pushed, order, key), ...], one per key in counters
+    self.order = itertools.count()
+
+  # returns the key that was evicted to make room for key, if any
+  def add(self, key, count=1):
+    counter = self.counters.get(key)
+    if counter is not None:
+      counter[0] += count
+      return None
+    evicted = None
+    error = 0
+    if len(self.counters) >= self.capacity:
+      evicted, error = self.pop_min()
+    self.counters[key] = [error+count, error]
+    heapq.heappush(self.heap, (error+count, next(self.order), key))
+    return evicted
+
+  def pop_min(self):
+    while True:
+      count, order, key = heapq.heappop(self.heap)
+      counter = self.counters[key]
+      if counter[0] == count:
+        del self.counters[key]
+        return key, count
+      heapq.heappush(self.heap, (counter[0], next(self.order), key))
+
+  def min_count(self):
+    if len(self.counters) < self.capacity:
+      return 0
+    return min(counter[0] for counter in self.counters.values())
+
+  # [(key, count, error), ...] with the highest counts first
+  def top(self, k=None):
+    items = [(key, counter[0], counter[1]) for key, counter in self.counters.items()]
+    if k is None:
+      return sorted(items, key=lambda item: -item[1])
+    return heapq.nlargest(k, items, key=lambda item: item[1])
+
+  # a key missing from one of the sketches could have had up to its smallest count there
+  def merge(self, other):
+    self_min = self.min_count()
+    other_min = other.min_count()
+    merged = {}
+    for key in set(self.counters) | set(other.counters):
+      count, error = self.counters.get(key, (self_min, self_min))
+      other_count, other_error = other.counters.get(key, (other_min, other_min))
+      merged[key] = [count+other_count, error+other_error]
+    kept = heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0])
+    self.counters = dict(kept)
+    self.heap = [(counter[0], next(self.order), key) for key, counter in kept]
+    heapq.heapify(self.heap)
+
+# Summarizes a window of packets in fixed memory instead of one row per flow like FlowAggregator: the capacity
+# heaviest (src, srcport, dst, dstport, protocol) flows with their FlowAggregator stats, and the distinct number of
+# sources, destinations and destination ports. A flow's stats start over when it takes over an evicted counter.
+# With sampling the counts are of the 1 in sample_rate packets that were kept, and distinct counts only see those.
+class FlowSketch():
+  def __init__(self, capacity=1000, precision=12, sample_rate=1):
+    self.sample_rate = sample_rate
+    self.top = SpaceSaving(capacity)
+    self.flows = flow_aggregator.FlowAggregator(sample_rate)
+    self.distinct_src = HyperLogLog(precision)
+    self.distinct_dst = HyperLogLog(precision)
+    self.distinct_dstport = HyperLogLog(precision)
+    self.min_ts = None
+    self.max_ts = None
+    self.packets = 0
+
+  def add(self, log):
+    ts = float(log[0])
+    key = (log[1], flow_aggregator.to_int(log[2]), log[3], flow_aggregator.to_int(log[4]), log[5])
+    evicted = self.top.add(key)
+    if evicted is not None:
+      del self.flows.flows[evicted]
+    if key not in self.flows.flows:
+      # a flow that is already tracked has been added to the HyperLogLogs before
+      self.distinct_src.add(key[0])
+      self.distinct_dst.add(key[2])
+      self.distinct_dstport.add(key[3])
+    self.flows.add(log)
+    if self.min_ts is None or ts < self.min_ts: self.min_ts = ts
+    if self.max_ts is None or ts > self.max_ts: self.max_ts = ts
+    self.packets += 1
+
+  def __len__(self):
+    return len(self.top.counters)
+
+  # summary rows of the tracked flows in flow_aggregator.SUMMARY_COLUMNS order, summ_size is the Space-Saving count
+  def rows(self):
+    rows = []
+    for row in self.flows.rows():
+      rows.append(row[:10] + (self.top.counters[tuple(row[2:7])][0], self.sample_rate))
+    return rows
+
+  def distinct_counts(self):
+    return self.distinct_src.count(), self.distinct_dst.count(), self.distinct_dstport.count()
+
+  def merge(self, other):
+    if other.sample_rate != self.sample_rate:
+      raise ValueError("can't merge sketches of packets sampled at different rates")
+    self.top.merge(other.top)
+    self.distinct_src.merge(other.distinct_src)
+    self.distinct_dst.merge(other.distinct_dst)
+    self.distinct_dstport.merge(other.distinct_dstport)
+    if other.min_ts is not None:
+      self.min_ts = other.min_ts if self.min_ts is None else min(self.min_ts, other.min_ts)
+      self.max_ts = other.max_ts if self.max_ts is None else max(self.max_ts, other.max_ts)
+    self.packets += other.packets
+    # per flow stats aren't shipped, a merged sketch only has counts
+    self.flows = flow_aggregator.FlowAggregator(self.sample_rate)
+
+  # min_ts, max_ts, packets, capacity, precision, sample rate, counters, then the counters and the three register arrays.
+  # per flow stats are left out, they're already in the summary rows.
+  HEADER = struct.Struct("!ddQIBII")
+  COUNTER = struct.Struct("!iiqq")
+
+  def to_bytes(self):
+    parts = [self.HEADER.pack(self.min_ts or 0, self.max_ts or 0, self.packets, self.top.capacity,
+                              self.distinct_src.precision, self.sample_rate, len(self.top.counters))]
+    for key, (count, error) in self.top.counters.items():
+      src, srcport, dst, dstport, protocol = key
+      parts.append(encode_string(src) + encode_string(dst) + encode_string(protocol) +
+                   self.COUNTER.pack(-1 if srcport == None else srcport, -1 if dstport == None else dstport, count, error))
+    parts += [bytes(self.distinct_src.registers), bytes(self.distinct_dst.registers), bytes(self.distinct_dstport.registers)]
+    return b"".join(parts)
+
+  @classmethod
+  def from_bytes(cls, data):
+    min_ts, max_ts, packets, capacity, precision, sample_rate, counter_count = cls.HEADER.unpack_from(data, 0)
+    sketch = cls(capacity, precision, sample_rate)
+    sketch.min_ts, sketch.max_ts, sketch.packets = min_ts, max_ts, packets
+    offset = cls.HEADER.size
+    for i in range(counter_count):
+      src, offset = decode_string(data, offset)
+      dst, offset = decode_string(data, offset)
+      protocol, offset = decode_string(data, offset)
+      srcport, dstport, count, error = cls.COUNTER.unpack_from(data, offset)
+      offset += cls.COUNTER.size
+      key = (src, None if srcport < 0 else srcport, dst, None if dstport < 0 else dstport, protocol)
+      sketch.top.counters[key] = [count, error]
+      sketch.top.heap.append((count, next(sketch.top.order), key))
+    heapq.heapify(sketch.top.heap)
+    size = 1 << precision
+    for hll in (sketch.distinct_src, sketch.distinct_dst, sketch.distinct_dstport):
+      hll.registers = bytearray(data[offset:offset+size])
+      offset += size
+    return sketch
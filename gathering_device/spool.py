@@ -0,0 +1,344 @@
+'''
+File:     spool.py
+Author:   Quangtri Thai
+Contents: Append-only, memory-mapped spool of the windows that couldn't be written to the db, replayed in order by a background thread.
+'''
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import flow_aggregator
+import packet_batch
+import sketches
+import wire_protocol
+
+# db work of one window, done in this order. each step is one commit, so a window that fails part way
+# is spooled with only the steps that are left
+STEP_LOGS = 0x1 # raw packets into log_table (with -aggregate sql, staged and summarized along with STEP_SUMMARY)
+STEP_SUMMARY = 0x2 # summary rows into summ_table
+STEP_ROLLUPS = 0x4 # summary rows into the rollup tables, then published
+STEP_SKETCH = 0x8 # the window's sketch into the sketch table
+
+# What flush_batch writes for one window: its raw packets (packet_batch.PacketBatch), summary rows
+# (flow_aggregator.SUMMARY_COLUMNS, followed by id once they are inserted) and sketch, each None when not needed.
+# steps are the STEP_ flags still to be done.
+class WindowBatch():
+  def __init__(self, steps, min_ts, max_ts, end_ts, logs=None, summ_rows=None, sketch=None):
+    self.steps = steps
+    self.min_ts = min_ts
+    self.max_ts = max_ts
+    self.end_ts = end_ts
+    self.logs = logs
+    self.summ_rows = summ_rows
+    self.sketch = sketch
+
+  def done(self, steps):
+    self.steps &= ~steps
+
+  # steps, timestamps, then the logs, summary rows and sketch, each with an int32 length (-1 for None).
+  # summary rows use the wire encoding, which always carries an id, rows that don't have one yet get 0 and the HAS_IDS flag is left out
+  HEADER = struct.Struct("!BBddd")
+  HAS_IDS = 0x1
+
+  def to_bytes(self):
+    flags = 0
+    sections = [None if self.logs is None else self.logs.to_bytes(), None, None if self.sketch is None else self.sketch.to_bytes()]
+    if self.summ_rows is not None:
+      if self.summ_rows and len(self.summ_rows[0]) > len(flow_aggregator.SUMMARY_COLUMNS):
+        flags |= self.HAS_IDS
+        rows = self.summ_rows
+      else:
+        rows = [tuple(row) + (0,) for row in self.summ_rows]
+      sections[1] = wire_protocol.encode_summary("", rows)
+    parts = [self.HEADER.pack(self.steps, flags, self.min_ts, self.max_ts, self.end_ts)]
+    for section in sections:
+      parts.append(struct.pack("!i", -1 if section is None else len(section)))
+      if section is not None:
+        parts.append(section)
+    return b"".join(parts)
+
+  @classmethod
+  def from_bytes(cls, data):
+    steps, flags, min_ts, max_ts, end_ts = cls.HEADER.unpack_from(data, 0)
+    offset = cls.HEADER.size
+    sections = []
+    for i in range(3):
+      length = struct.unpack_from("!i", data, offset)[0]
+      offset += 4
+      sections.append(None if length < 0 else data[offset:offset+length])
+      offset += max(0, length)
+    batch = cls(steps, min_ts, max_ts, end_ts)
+    if sections[0] is not None:
+      batch.logs = packet_batch.PacketBatch.from_bytes(sections[0])
+    if sections[1] is not None:
+      sensor, rows = wire_protocol.decode_summary(sections[1], with_ids=True)
+      batch.summ_rows = rows if flags & cls.HAS_IDS else [row[:-1] for row in rows]
+    if sections[2] is not None:
+      batch.sketch = sketches.FlowSketch.from_bytes(sections[2])
+    return batch
+
+# record header: magic, flags, payload length, crc32 of the payload, time it was spooled.
+# the payload is written before the header, so a record cut short by a crash ends the segment there
+RECORD = struct.Struct("!4sBxxxIId")
+RECORD_MAGIC = b"ENSR"
+FLAG_REPLAYED = 0x1
+
+# One segment file of the spool, created at its full size and mapped into memory.
+# Records are only ever appended, and marked replayed in place once they are in the db.
+class Segment():
+  def __init__(self, path, size=None):
+    self.path = path
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+      if size is not None:
+        os.ftruncate(fd, size)
+      self.size = os.fstat(fd).st_size
+      self.map = mmap.mmap(fd, self.size)
+    finally:
+      os.close(fd)
+    self.end = 0 # where the next record goes
+    self.pending = 0 # records not replayed yet
+
+  # [(offset, flags, payload length, spooled time), ...] of the records already in the file
+  def scan(self):
+    records = []
+    offset = 0
+    while offset+RECORD.size <= self.size:
+      magic, flags, length, crc, spooled_time = RECORD.unpack_from(self.map, offset)
+      if magic != RECORD_MAGIC or offset+RECORD.size+length > self.size:
+        break
+      records.append((offset, flags, length, spooled_time))
+      offset += RECORD.size+length
+    self.end = offset
+    return records
+
+  def fits(self, length):
+    return self.end+RECORD.size+length <= self.size
+
+  def append(self, payload, spooled_time):
+    offset = self.end
+    self.map[offset+RECORD.size:offset+RECORD.size+len(payload)] = payload
+    self.map[offset:offset+RECORD.size] = RECORD.pack(RECORD_MAGIC, 0, len(payload), zlib.crc32(payload), spooled_time)
+    self.sync(offset, RECORD.size+len(payload))
+    self.end = offset+RECORD.size+len(payload)
+    self.pending += 1
+    return offset
+
+  # the payload of the record at offset, None if it doesn't match its checksum
+  def read(self, offset):
+    magic, flags, length, crc, spooled_time = RECORD.unpack_from(self.map, offset)
+    payload = self.map[offset+RECORD.size:offset+RECORD.size+length]
+    if magic != RECORD_MAGIC or zlib.crc32(payload) != crc:
+      return None
+    return payload
+
+  def mark_replayed(self, offset):
+    self.map[offset+4] = self.map[offset+4] | FLAG_REPLAYED
+    self.sync(offset, RECORD.size)
+
+  # msync only takes page aligned offsets
+  def sync(self, offset, length):
+    start = offset - offset%mmap.PAGESIZE
+    self.map.flush(start, offset+length-start)
+
+  def remove(self):
+    self.map.close()
+    os.remove(self.path)
+
+# Write-ahead spool of windows in directory, as segment_<n>.spool files of segment_size bytes (or one record, if bigger).
+# Records still waiting to be replayed are found again when the monitor restarts, replayed ones are skipped.
+# The files take at most max_bytes, past that the oldest segments are dropped along with the records left in them.
+# A record whose checksum doesn't match when it is read back is skipped and counted as corrupt.
+class Spool():
+  def __init__(self, directory, max_bytes=256*1024*1024, segment_size=16*1024*1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.segment_size = segment_size
+    self.segments = [] # oldest first
+    self.active = None # segment appended to. segments left by an earlier run are only replayed, never appended to
+    self.pending = collections.deque() # (segment, offset, payload length, spooled time) of the records to replay, oldest first
+    self.lock = threading.Lock()
+    self.condition = threading.Condition(self.lock)
+    self.next_seq = 0
+    self.spooled = 0
+    self.replayed = 0
+    self.dropped = 0
+    self.corrupt = 0
+    self.failed = 0
+    os.makedirs(directory, exist_ok=True)
+    self.load()
+
+  def load(self):
+    names = sorted(name for name in os.listdir(self.directory) if name.startswith("segment_") and name.endswith(".spool"))
+    for name in names:
+      self.next_seq = max(self.next_seq, int(name[len("segment_"):-len(".spool")])+1)
+      segment = Segment(os.path.join(self.directory, name))
+      for offset, flags, length, spooled_time in segment.scan():
+        if not flags & FLAG_REPLAYED:
+          self.pending.append((segment, offset, length, spooled_time))
+          segment.pending += 1
+      if segment.pending == 0:
+        segment.remove()
+      else:
+        self.segments.append(segment)
+
+  def append(self, payload):
+    with self.lock:
+      if self.active is None or not self.active.fits(len(payload)):
+        size = max(self.segment_size, RECORD.size+len(payload))
+        # the oldest records go first when the spool is full
+        while self.size()+size > self.max_bytes and self.segments and self.segments[0] is not self.active:
+          self.drop(self.segments[0])
+        if self.size()+size > self.max_bytes:
+          self.dropped += 1
+          return False
+        if self.active is not None and self.active.pending == 0:
+          self.segments.remove(self.active)
+          self.active.remove()
+        self.active = Segment(os.path.join(self.directory, f"segment_{self.next_seq:010d}.spool"), size)
+        self.next_seq += 1
+        self.segments.append(self.active)
+      spooled_time = time.time()
+      offset = self.active.append(payload, spooled_time)
+      self.pending.append((self.active, offset, len(payload), spooled_time))
+      self.spooled += 1
+      self.condition.notify_all()
+      return True
+
+  def drop(self, segment):
+    kept = collections.deque(entry for entry in self.pending if entry[0] is not segment)
+    self.dropped += len(self.pending)-len(kept)
+    self.pending = kept
+    self.segments.remove(segment)
+    segment.remove()
+
+  # the oldest record to replay as (entry, payload), waiting up to timeout seconds for one. None if there is none
+  def head(self, timeout=None):
+    with self.lock:
+      if not self.pending:
+        self.condition.wait(timeout)
+      while self.pending:
+        entry = self.pending[0]
+        payload = entry[0].read(entry[1])
+        if payload is not None:
+          return entry, payload
+        self.corrupt += 1
+        self.release(entry)
+      return None
+
+  # entry was written to the db
+  def done(self, entry):
+    with self.lock:
+      if self.pending and self.pending[0] is entry:
+        entry[0].mark_replayed(entry[1])
+        self.replayed += 1
+        self.release(entry)
+
+  # entry couldn't be written while the db was up, it's given up on so the records behind it can go
+  def skip(self, entry):
+    with self.lock:
+      if self.pending and self.pending[0] is entry:
+        entry[0].mark_replayed(entry[1])
+        self.failed += 1
+        self.release(entry)
+
+  def release(self, entry):
+    self.pending.popleft()
+    segment = entry[0]
+    segment.pending -= 1
+    if segment.pending == 0 and segment is not self.active:
+      self.segments.remove(segment)
+      segment.remove()
+    if not self.pending:
+      self.condition.notify_all()
+
+  # number of records waiting to be replayed
+  def depth(self):
+    return len(self.pending)
+
+  # seconds the oldest record has been waiting
+  def age(self):
+    with self.lock:
+      return time.time()-self.pending[0][3] if self.pending else 0
+
+  # bytes taken by the segment files
+  def size(self):
+    return sum(segment.size for segment in self.segments)
+
+# Replays the spool's records in order on its own connection made by make_db_manager. decode turns a record into
+# what replay(db_manager, decoded) writes, and a record is only decoded once, so the steps it finished aren't redone
+# when it is retried. While the db is down the connection is retried with exponential backoff. A record that fails
+# max_attempts times while the db is up is skipped.
+class Replayer():
+  def __init__(self, spool, decode, replay, make_db_manager, min_backoff=1, max_backoff=30, max_attempts=3):
+    self.spool = spool
+    self.decode = decode
+    self.replay = replay
+    self.make_db_manager = make_db_manager
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    self.max_attempts = max_attempts
+    self.stopped = threading.Event()
+    self.thread = None
+    self.error = None # why the last replay failed
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="spool-replayer", daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def run(self):
+    db_manager = None
+    entry = None
+    backoff = 0
+    while not self.stopped.is_set():
+      if entry is None:
+        head = self.spool.head(timeout=1)
+        if head is None:
+          continue
+        entry, payload = head
+        try:
+          decoded = self.decode(payload)
+        except Exception as e:
+          self.error = f"can't decode spooled record ({e})"
+          self.spool.skip(entry)
+          entry = None
+          continue
+        attempts = 0
+      try:
+        if db_manager is None:
+          db_manager = self.make_db_manager()
+        elif not db_manager.is_alive():
+          db_manager.reconnect()
+        self.replay(db_manager, decoded)
+      except Exception as e:
+        self.error = str(e)
+        if db_manager is not None and self.db_is_up(db_manager):
+          attempts += 1
+          if attempts >= self.max_attempts:
+            self.spool.skip(entry)
+            entry = None
+            continue
+        backoff = min(self.max_backoff, backoff*2 if backoff else self.min_backoff)
+        self.stopped.wait(backoff)
+        continue
+      self.spool.done(entry)
+      entry = None
+      backoff = 0
+      self.error = None
+
+  def db_is_up(self, db_manager):
+    try:
+      db_manager.db_conn.rollback()
+    except Exception:
+      return False
+    return db_manager.is_alive()
@@ -0,0 +1,209 @@
+'''
+File:     summary_archive.py
+Author:   Quangtri Thai
+Contents: Compressed, time-sorted columnar segment files of the summary rows that age out of the db, and a memory-mapped reader for them.
+'''
+
+import array
+import bisect
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# how each summary column is stored: float64 with NaN for NULL, int32 or int64 with -1 for NULL,
+# or (s)trings as uint32 indexes into the column's own dictionary with 0 for NULL
+COLUMN_TYPES = {"min_timestamp": "d", "max_timestamp": "d", "src": "s", "srcport": "i", "dst": "s", "dstport": "i", "protocol": "s",
+                "min_length": "i", "max_length": "i", "avg_length": "d", "summ_size": "q", "sample_rate": "i", "sensor": "s", "sensor_id": "q"}
+
+MAGIC = b"ENMA"
+VERSION = 1
+# magic, version, row count, min of min_timestamp, max of max_timestamp, column count
+HEADER = struct.Struct("!4sBxxxIddI")
+# name, type, offset of the compressed column in the file, its length
+COLUMN = struct.Struct("!16scQI")
+# arrays are stored little endian whatever machine wrote them
+SWAP = sys.byteorder != "little"
+
+def encode_column(kind, values):
+  if kind == "s":
+    ids = {None: 0}
+    codes = array.array("I")
+    parts = []
+    for value in values:
+      index = ids.get(value)
+      if index is None:
+        index = ids[value] = len(ids)
+        data = str(value).encode("utf-8")
+        parts.append(struct.pack("!I", len(data)) + data)
+      codes.append(index)
+    if SWAP:
+      codes.byteswap()
+    return struct.pack("!I", len(parts)) + b"".join(parts) + codes.tobytes()
+  if kind == "d":
+    column = array.array(kind, (math.nan if value == None else float(value) for value in values))
+  else:
+    column = array.array(kind, (-1 if value == None else int(value) for value in values))
+  if SWAP:
+    column.byteswap()
+  return column.tobytes()
+
+# the values of a column as a list, NULLs as None
+def decode_column(kind, data):
+  if kind == "s":
+    count = struct.unpack_from("!I", data, 0)[0]
+    offset = 4
+    strings = [None]
+    for i in range(count):
+      length = struct.unpack_from("!I", data, offset)[0]
+      strings.append(data[offset+4:offset+4+length].decode("utf-8"))
+      offset += 4+length
+    codes = array.array("I")
+    codes.frombytes(data[offset:])
+    if SWAP:
+      codes.byteswap()
+    return [strings[code] for code in codes]
+  column = array.array(kind)
+  column.frombytes(data)
+  if SWAP:
+    column.byteswap()
+  if kind == "d":
+    return [None if value != value else value for value in column]
+  return [None if value < 0 else value for value in column]
+
+# Writes rows (tuples in columns order, which has to include min_timestamp and max_timestamp) to path as one segment,
+# sorted on min_timestamp so a time range is found by bisection. Each column is compressed on its own, so a query
+# only reads and decompresses the columns it uses. The file is written under a temporary name and renamed,
+# so a segment is either whole or missing. Returns the size of the file
+def write_segment(path, columns, rows, level=6):
+  start = columns.index("min_timestamp")
+  end = columns.index("max_timestamp")
+  rows = sorted(rows, key=lambda row: row[start])
+  blobs = [zlib.compress(encode_column(COLUMN_TYPES[name], [row[i] for row in rows]), level) for i, name in enumerate(columns)]
+  offset = HEADER.size+COLUMN.size*len(columns)
+  parts = [HEADER.pack(MAGIC, VERSION, len(rows), float(rows[0][start]), max(float(row[end]) for row in rows), len(columns))]
+  for name, blob in zip(columns, blobs):
+    parts.append(COLUMN.pack(name.encode("utf-8"), COLUMN_TYPES[name].encode("utf-8"), offset, len(blob)))
+    offset += len(blob)
+  temp_path = path + ".tmp"
+  with open(temp_path, "wb") as segment_file:
+    segment_file.write(b"".join(parts))
+    for blob in blobs:
+      segment_file.write(blob)
+    segment_file.flush()
+    os.fsync(segment_file.fileno())
+  os.replace(temp_path, path)
+  return offset
+
+# One segment file, mapped read-only. Only the header and column directory are read until a column is asked for
+class Segment():
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as segment_file:
+      self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.row_count, self.min_ts, self.max_ts, column_count = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != VERSION:
+      self.map.close()
+      raise ValueError(f"{path} is not a summary archive segment")
+    self.columns = {}
+    for i in range(column_count):
+      name, kind, offset, length = COLUMN.unpack_from(self.map, HEADER.size+i*COLUMN.size)
+      self.columns[name.rstrip(b"\0").decode("utf-8")] = (kind.decode("utf-8"), offset, length)
+
+  def column(self, name):
+    kind, offset, length = self.columns[name]
+    return decode_column(kind, zlib.decompress(self.map[offset:offset+length]))
+
+  # the given columns of the rows with start_ts <= min_timestamp and max_timestamp < end_ts, as one list per column
+  def scan(self, start_ts, end_ts, columns):
+    min_ts = self.column("min_timestamp")
+    first = 0 if start_ts is None else bisect.bisect_left(min_ts, start_ts)
+    last = len(min_ts) if end_ts is None else bisect.bisect_left(min_ts, end_ts)
+    if first >= last:
+      return [[] for name in columns]
+    keep = range(first, last)
+    if end_ts is not None:
+      max_ts = self.column("max_timestamp")
+      keep = [i for i in keep if max_ts[i] < end_ts]
+    values = []
+    for name in columns:
+      column = min_ts if name == "min_timestamp" else self.column(name)
+      values.append([column[i] for i in keep])
+    return values
+
+  def close(self):
+    self.map.close()
+
+# The segments in directory. Each one's time range is read from its header once, and a scan only maps the
+# columns of the segments that overlap the range asked for
+class Archive():
+  def __init__(self, directory):
+    self.directory = directory
+    self.segments = {} # path -> Segment
+
+  def load(self):
+    paths = set(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".seg"))
+    for path in list(self.segments):
+      if path not in paths:
+        self.segments.pop(path).close()
+    for path in sorted(paths-set(self.segments)):
+      self.segments[path] = Segment(path)
+    return sorted(self.segments.values(), key=lambda segment: segment.min_ts)
+
+  def max_timestamp(self):
+    segments = self.load()
+    return max(segment.max_ts for segment in segments) if segments else None
+
+  # yields Segment.scan of every segment with rows in start_ts <= min_timestamp and max_timestamp < end_ts, skipping the others
+  def scan(self, start_ts, end_ts, columns):
+    for segment in self.load():
+      if end_ts is not None and segment.min_ts >= end_ts:
+        continue
+      if start_ts is not None and segment.max_ts < start_ts:
+        continue
+      yield segment.scan(start_ts, end_ts, columns)
+
+  def close(self):
+    for segment in self.segments.values():
+      segment.close()
+    self.segments = {}
+
+# Called by retention.RetentionManager to remove rows: the rows of a partition before it is dropped, or those up to
+# clear_ts in a table that isn't partitioned as they are deleted, are written to directory as one segment.
+# A partition's segment is named after it, so archiving it again after a crash only rewrites the same file.
+# The rows deleted from a table that isn't partitioned are a new segment each time, named after their time range
+# and never written over.
+class SummaryArchiver():
+  def __init__(self, directory, columns, level=6):
+    self.directory = directory
+    self.columns = tuple(columns)
+    self.level = level
+    self.archived_rows = 0
+    self.archived_bytes = 0
+    os.makedirs(directory, exist_ok=True)
+
+  def archive(self, db_manager, table):
+    rows = db_manager.get_archive_rows(table, self.columns)
+    if rows:
+      self.write(os.path.join(self.directory, table + ".seg"), rows)
+
+  def archive_older_rows(self, db_manager, table, column, clear_ts):
+    db_manager.delete_archive_rows(table, self.columns, column, clear_ts, lambda rows: self.write(self.range_path(table, rows), rows))
+
+  # <table>_<min of min_timestamp>_<max of max_timestamp>.seg, with a count after it if an earlier segment has the same range
+  def range_path(self, table, rows):
+    start = self.columns.index("min_timestamp")
+    end = self.columns.index("max_timestamp")
+    name = f"{table}_{min(float(row[start]) for row in rows)!r}_{max(float(row[end]) for row in rows)!r}"
+    path = os.path.join(self.directory, name + ".seg")
+    count = 1
+    while os.path.exists(path):
+      path = os.path.join(self.directory, f"{name}_{count}.seg")
+      count += 1
+    return path
+
+  def write(self, path, rows):
+    self.archived_bytes += write_segment(path, self.columns, rows, self.level)
+    self.archived_rows += len(rows)
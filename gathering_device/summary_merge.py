@@ -0,0 +1,80 @@
+'''
+File:     summary_merge.py
+Author:   Quangtri Thai
+Contents: Merges the summary rows of sensors with overlapping coverage into one deduplicated per flow view on the master.
+'''
+
+import math
+
+import retention
+
+def sensor_table(summ_table):
+  return f"{summ_table}_merged_sensors"
+
+def merged_table(summ_table):
+  return f"{summ_table}_merged"
+
+# Spreads each summary row's packets evenly over the size second buckets its min_timestamp..max_timestamp spans,
+# then adds them up per bucket, flow and sensor. Returns sorted
+# [(bucket, src, srcport, dst, dstport, protocol, sensor, min_ts, max_ts, min_length, max_length, length_sum, length_weight,
+#   packets, variance), ...], length_sum/length_weight being the average length.
+# summ_rows are flow_aggregator.SUMMARY_COLUMNS followed by the sensor. Packets are scaled by the row's sample_rate like
+# rollup.rollup_rows, and NULL ports and protocols are -1 and "" so they can be part of the primary keys.
+def sensor_bucket_rows(summ_rows, size):
+  buckets = {}
+  for row in summ_rows:
+    min_ts, max_ts = float(row[0]), float(row[1])
+    summ_size, sample_rate = int(row[10]), int(row[11])
+    flow = (row[2], -1 if row[3] == None else int(row[3]), row[4], -1 if row[5] == None else int(row[5]),
+            "" if row[6] == None else row[6], row[12])
+    first = math.floor(min_ts/size)
+    last = max(first, math.ceil(max_ts/size)-1) # a row ending on a bucket's lower bound has nothing in it
+    for i in range(first, last+1):
+      bucket = float(i*size)
+      if first == last:
+        share = 1
+      else:
+        share = (min(max_ts, bucket+size)-max(min_ts, bucket))/(max_ts-min_ts)
+      key = (bucket,) + flow
+      stats = buckets.get(key)
+      if stats == None:
+        stats = buckets[key] = [min_ts, max_ts, row[7], row[8], 0, 0, 0, 0]
+      else:
+        stats[0] = min(stats[0], min_ts)
+        stats[1] = max(stats[1], max_ts)
+        if row[7] != None: stats[2] = row[7] if stats[2] == None else min(stats[2], row[7])
+        if row[8] != None: stats[3] = row[8] if stats[3] == None else max(stats[3], row[8])
+      if row[9] != None:
+        stats[4] += float(row[9])*summ_size*share
+        stats[5] += summ_size*share
+      stats[6] += summ_size*sample_rate*share
+      stats[7] += summ_size*sample_rate*(sample_rate-1)*share
+  return sorted(key+tuple(stats) for key, stats in buckets.items())
+
+# The sensors' contributions to each bucket and flow, and the global rows merged from them, both partitioned on
+# bucket and aged out with it like the rollups. Sensors that saw the same flow in the same bucket saw the same
+# packets, so a global row counts the packets of the sensor that saw the most of them instead of adding them up,
+# see DBManager.merge_summary. Only the buckets and flows that new rows touched are merged again.
+class SummaryMerger():
+  def __init__(self, summ_table, window_size, bucket_size=1, partition_size=None, detach=False):
+    self.summ_table = summ_table
+    self.bucket_size = bucket_size
+    self.retentions = [retention.RetentionManager(table, "bucket", window_size, partition_size, detach=detach)
+                       for table in (sensor_table(summ_table), merged_table(summ_table))]
+    self.merged = 0 # summary rows merged
+
+  # summ_rows are new rows of the summary table with their sensor, until_id the watermark of the rows already merged,
+  # moved in the same transaction
+  def add(self, db_manager, summ_rows, until_id=None):
+    if not summ_rows:
+      return
+    min_ts = min(float(row[0]) for row in summ_rows)
+    max_ts = max(float(row[1]) for row in summ_rows)
+    for table_retention in self.retentions:
+      table_retention.prepare(db_manager, min_ts-self.bucket_size, max_ts)
+    db_manager.merge_summary(self.summ_table, sensor_bucket_rows(summ_rows, self.bucket_size), until_id)
+    self.merged += len(summ_rows)
+
+  def enforce(self, db_manager, latest_ts):
+    for table_retention in self.retentions:
+      table_retention.enforce(db_manager, latest_ts)
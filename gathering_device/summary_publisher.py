@@ -0,0 +1,143 @@
+'''
+File:     summary_publisher.py
+Author:   Quangtri Thai
+Contents: Pushes freshly flushed summary rows from monitor.py through worker_server.py to subscribed masters.
+'''
+
+import collections
+import socket
+import struct
+import threading
+import time
+
+import wire_protocol
+
+# monitor side: sends each flushed window's summary rows (with their ids) to worker_server's publish port.
+# publishing never blocks the monitor for long and never raises, rows that can't be sent are counted as dropped
+# and subscribers pick them up from the db instead.
+class Publisher():
+  def __init__(self, address, timeout=0.5, retry_interval=5):
+    host, port = address.rsplit(":", 1)
+    self.address = (host, int(port))
+    self.timeout = timeout
+    self.retry_interval = retry_interval
+    self.sock = None
+    self.retry_time = 0
+    self.lock = threading.Lock()
+    self.published_rows = 0
+    self.dropped_rows = 0
+
+  def publish(self, summ_rows):
+    if not summ_rows:
+      return
+    with self.lock:
+      if self.sock is None and not self.connect():
+        self.dropped_rows += len(summ_rows)
+        return
+      try:
+        wire_protocol.send_message(self.sock, wire_protocol.PUBLISH, wire_protocol.encode_summary("", summ_rows))
+        self.published_rows += len(summ_rows)
+      except OSError:
+        self.close()
+        self.dropped_rows += len(summ_rows)
+
+  def connect(self):
+    if time.time() < self.retry_time:
+      return False
+    try:
+      self.sock = socket.create_connection(self.address, timeout=self.timeout)
+      return True
+    except OSError:
+      self.retry_time = time.time()+self.retry_interval
+      return False
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+    self.sock = None
+    self.retry_time = time.time()+self.retry_interval
+
+# worker side: one subscribed master. published rows wait in a bounded send buffer until the session
+# thread sends them. when the master can't keep up the buffer is dropped and the subscriber is marked
+# lagging, so the session catches up from the db instead.
+class Subscriber():
+  def __init__(self, max_batches):
+    self.batches = collections.deque()
+    self.max_batches = max_batches
+    self.cond = threading.Condition()
+    self.lagging = True # start with a catch-up from the db
+    self.dropped_batches = 0
+
+  def push(self, summ_rows):
+    with self.cond:
+      if len(self.batches) >= self.max_batches:
+        self.batches.clear()
+        self.lagging = True
+        self.dropped_batches += 1
+      self.batches.append(summ_rows)
+      self.cond.notify()
+
+  # waits up to timeout for published rows. returns (rows, lagging), rows is None if nothing arrived
+  def next_rows(self, timeout):
+    with self.cond:
+      if not self.batches and not self.lagging:
+        self.cond.wait(timeout)
+      lagging = self.lagging
+      self.lagging = False
+      summ_rows = None
+      if self.batches:
+        summ_rows = []
+        while self.batches:
+          summ_rows += self.batches.popleft()
+      return summ_rows, lagging
+
+  def depth(self):
+    return len(self.batches)
+
+# worker side: fans published rows out to every subscriber
+class SubscriberHub():
+  def __init__(self, max_batches=64):
+    self.max_batches = max_batches
+    self.subscribers = []
+    self.lock = threading.Lock()
+    self.published_rows = 0
+
+  def subscribe(self):
+    subscriber = Subscriber(self.max_batches)
+    with self.lock:
+      self.subscribers.append(subscriber)
+    return subscriber
+
+  def unsubscribe(self, subscriber):
+    with self.lock:
+      self.subscribers.remove(subscriber)
+
+  def publish(self, summ_rows):
+    with self.lock:
+      subscribers = list(self.subscribers)
+      self.published_rows += len(summ_rows)
+    for subscriber in subscribers:
+      subscriber.push(summ_rows)
+
+  # accepts monitor connections on the publish port and publishes the rows they send, runs in its own thread
+  def serve_publishers(self, host, port):
+    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    soc.bind((host, port))
+    soc.listen(5)
+    while True:
+      connection, address = soc.accept()
+      threading.Thread(target=self.receive_publisher, args=(connection,), daemon=True).start()
+
+  def receive_publisher(self, connection):
+    try:
+      while True:
+        msg_type, payload = wire_protocol.recv_message(connection)
+        if msg_type == wire_protocol.PUBLISH:
+          sensor, summ_rows = wire_protocol.decode_summary(payload, with_ids=True)
+          self.publish(summ_rows)
+    except (OSError, struct.error, wire_protocol.ProtocolError):
+      connection.close()
+
+  def start(self, host, port):
+    threading.Thread(target=self.serve_publishers, args=(host, port), name="publish-listener", daemon=True).start()
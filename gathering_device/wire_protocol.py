@@ -0,0 +1,219 @@
+'''
+File:     wire_protocol.py
+Author:   Quangtri Thai
+Contents: Length-prefixed, versioned messages between worker_server.py and master_client.py, and a compact summary row encoding.
+'''
+
+import math
+import struct
+import zlib
+
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
+
+MAGIC = b"ENMP"
+VERSION = 2 # 2 added sample_rate to the summary rows
+
+# frame header: magic, version, message type, flags, payload length
+HEADER = struct.Struct("!4sBBBxI")
+MAX_PAYLOAD_SIZE = 64*1024*1024
+
+# message types
+POLL = 1 # master -> worker, payload: poll flags and acknowledged id
+SUMMARY = 2 # worker -> master, payload: encoded summary rows
+SHIPPED = 3 # worker -> master, payload: rows and bytes the worker copied into the master's db itself
+PUBLISH = 4 # monitor -> worker, payload: encoded summary rows of a window that was just flushed
+SUBSCRIBE = 5 # master -> worker, payload: poll flags and acknowledged id. the worker then pushes SUMMARY messages as windows close
+HEARTBEAT = 6 # worker -> master, no payload. sent to subscribers while there is nothing to push
+SKETCH = 7 # worker -> master, payload: the newest serialized sketches.FlowSketch. sent before the SUMMARY or SHIPPED reply
+
+# flags
+FLAG_ZLIB = 0x1
+FLAG_LZ4 = 0x2
+
+# poll flags
+POLL_RESYNC = 0x1 # resend everything still in the table
+
+COMPRESSIONS = ("none", "zlib", "lz4")
+
+class ProtocolError(Exception):
+  pass
+
+def compress(payload, compression):
+  if compression == "zlib":
+    return zlib.compress(payload, 1), FLAG_ZLIB
+  if compression == "lz4":
+    if lz4 is None:
+      raise ProtocolError("lz4 compression requested but the lz4 module is not installed")
+    return lz4.frame.compress(payload), FLAG_LZ4
+  return payload, 0
+
+def decompress(payload, flags):
+  if flags & FLAG_ZLIB:
+    return zlib.decompress(payload)
+  if flags & FLAG_LZ4:
+    if lz4 is None:
+      raise ProtocolError("received an lz4 compressed message but the lz4 module is not installed")
+    return lz4.frame.decompress(payload)
+  return payload
+
+# payloads smaller than min_compress_size are sent as is
+def encode_frame(msg_type, payload=b"", compression="none", min_compress_size=512):
+  flags = 0
+  if compression != "none" and len(payload) >= min_compress_size:
+    payload, flags = compress(payload, compression)
+  return HEADER.pack(MAGIC, VERSION, msg_type, flags, len(payload)) + payload
+
+def decode_header(header):
+  magic, version, msg_type, flags, length = HEADER.unpack(header)
+  if magic != MAGIC:
+    raise ProtocolError("bad frame magic")
+  if version != VERSION:
+    raise ProtocolError(f"unsupported protocol version {version}")
+  if length > MAX_PAYLOAD_SIZE:
+    raise ProtocolError(f"frame of {length} bytes is too large")
+  return msg_type, flags, length
+
+# returns the number of bytes put on the wire
+def send_message(sock, msg_type, payload=b"", compression="none"):
+  frame = encode_frame(msg_type, payload, compression)
+  sock.sendall(frame)
+  return len(frame)
+
+def recv_exact(sock, size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = sock.recv(min(size-len(data), 65536))
+    if not chunk:
+      raise ConnectionError("connection closed")
+    data += chunk
+  return bytes(data)
+
+# blocking read of one whole message, however it was split by the network
+def recv_message(sock):
+  msg_type, flags, length = decode_header(recv_exact(sock, HEADER.size))
+  return msg_type, decompress(recv_exact(sock, length), flags)
+
+# Reassembles frames from whatever chunks a non-blocking socket returns
+class FrameBuffer():
+  def __init__(self):
+    self.buffer = bytearray()
+
+  # returns [(msg_type, payload, frame size), ...] for every frame completed by data
+  def feed(self, data):
+    self.buffer += data
+    messages = []
+    while len(self.buffer) >= HEADER.size:
+      msg_type, flags, length = decode_header(bytes(self.buffer[:HEADER.size]))
+      if len(self.buffer) < HEADER.size+length:
+        break
+      payload = bytes(self.buffer[HEADER.size:HEADER.size+length])
+      del self.buffer[:HEADER.size+length]
+      messages.append((msg_type, decompress(payload, flags), HEADER.size+length))
+    return messages
+
+# poll flags, then the id of the newest summary row the master has received from the worker over the socket,
+# -1 when it doesn't keep track (the rows were copied into its db by the worker)
+def encode_poll(resync=False, ack_id=None):
+  return struct.pack("!Bq", POLL_RESYNC if resync else 0, -1 if ack_id is None else ack_id)
+
+# returns (resync, ack_id), ack_id is None when the master didn't send one
+def decode_poll(payload):
+  resync = bool(struct.unpack("!B", payload[:1])[0] & POLL_RESYNC)
+  if len(payload) < 9:
+    return resync, None
+  ack_id = struct.unpack_from("!q", payload, 1)[0]
+  return resync, None if ack_id < 0 else ack_id
+
+def encode_shipped(rows, byte_count):
+  return struct.pack("!QQ", rows, byte_count)
+
+def decode_shipped(payload):
+  return struct.unpack("!QQ", payload)
+
+# sensor, the sketch's id in the worker's sketch table, then the sketch as sketches.FlowSketch.to_bytes made it
+def encode_sketch(sensor, sketch_id, sketch):
+  return encode_string(sensor) + struct.pack("!q", sketch_id) + sketch
+
+def decode_sketch(payload):
+  sensor, offset = decode_string(payload, 0)
+  sketch_id = struct.unpack_from("!q", payload, offset)[0]
+  return sensor, sketch_id, payload[offset+8:]
+
+# Summary rows are (min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length,
+# avg_length, summ_size, sample_rate, id). Strings go in a table at the front of the payload and rows refer to them by index,
+# since the same addresses and protocols repeat across rows. NULL integers are sent as -1 and a NULL avg as NaN.
+ROW = struct.Struct("!ddIiIiIiidIIq")
+NULL_STRING = 0xffffffff
+
+def encode_summary(sensor, rows):
+  strings = {}
+  def string_index(value):
+    if value == None:
+      return NULL_STRING
+    index = strings.get(value)
+    if index is None:
+      index = strings[value] = len(strings)
+    return index
+  def int_or_null(value):
+    return -1 if value == None else int(value)
+
+  packed_rows = []
+  for row in rows:
+    packed_rows.append(ROW.pack(float(row[0]), float(row[1]), string_index(row[2]), int_or_null(row[3]),
+                                string_index(row[4]), int_or_null(row[5]), string_index(row[6]),
+                                int_or_null(row[7]), int_or_null(row[8]),
+                                math.nan if row[9] == None else float(row[9]), int(row[10]), int(row[11]), int(row[12])))
+
+  parts = [encode_string(sensor), struct.pack("!I", len(strings))]
+  for value in strings:
+    parts.append(encode_string(value))
+  parts.append(struct.pack("!I", len(packed_rows)))
+  parts += packed_rows
+  return b"".join(parts)
+
+# returns (sensor, rows) with rows in the column order of the master's staging table:
+# the summary columns followed by sensor and sensor_id
+# with_ids returns the rows as they were encoded instead: the summary columns followed by id
+# a payload that is cut short or doesn't add up raises ProtocolError instead of returning part of the rows
+def decode_summary(payload, with_ids=False):
+  try:
+    return decode_summary_rows(payload, with_ids)
+  except (struct.error, IndexError, UnicodeDecodeError) as e:
+    raise ProtocolError(f"bad summary payload ({e})")
+
+def decode_summary_rows(payload, with_ids):
+  sensor, offset = decode_string(payload, 0)
+  string_count = struct.unpack_from("!I", payload, offset)[0]
+  offset += 4
+  strings = []
+  for i in range(string_count):
+    value, offset = decode_string(payload, offset)
+    strings.append(value)
+  row_count = struct.unpack_from("!I", payload, offset)[0]
+  offset += 4
+  if len(payload)-offset != row_count*ROW.size:
+    raise ProtocolError(f"summary of {row_count} rows has {len(payload)-offset} bytes of rows")
+
+  rows = []
+  for fields in ROW.iter_unpack(payload[offset:offset+row_count*ROW.size]):
+    min_ts, max_ts, src, srcport, dst, dstport, protocol, min_len, max_len, avg_len, summ_size, sample_rate, sensor_id = fields
+    row = (min_ts, max_ts, strings[src], None if srcport < 0 else srcport,
+           strings[dst], None if dstport < 0 else dstport, None if protocol == NULL_STRING else strings[protocol],
+           None if min_len < 0 else min_len, None if max_len < 0 else max_len,
+           None if math.isnan(avg_len) else avg_len, summ_size, sample_rate)
+    rows.append(row + (sensor_id,) if with_ids else row + (sensor, sensor_id))
+  return sensor, rows
+
+def encode_string(value):
+  data = value.encode("utf-8")
+  return struct.pack("!H", len(data)) + data
+
+def decode_string(payload, offset):
+  length = struct.unpack_from("!H", payload, offset)[0]
+  offset += 2
+  if offset+length > len(payload):
+    raise ProtocolError("string cut short")
+  return payload[offset:offset+length].decode("utf-8"), offset+length
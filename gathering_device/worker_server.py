@@ -6,44 +6,223 @@ Contents: Program to recieve and send messages through sockets as a worker serve
 
 import socket, sys
 import argparse
+import threading
+import time
 
 import psycopg2
 
+import audit_log
 import db_manager
+import db_pool
+import metrics
+import retention
+import summary_publisher
+import wire_protocol
 
-def receive_master(connection, local_dbmanager, remote_dbmanager, summ_table, max_buffer_size):
+REQUEST_SECONDS = metrics.histogram("worker_request_seconds", "Time to answer a master's poll or push it a window's summary, db work included", ("mode",))
+SHIPPED_ROWS = metrics.counter("worker_shipped_rows_total", "Summary rows shipped to masters")
+SHIPPED_BYTES = metrics.counter("worker_shipped_bytes_total", "Bytes shipped to masters, by message", ("message",))
+
+# The master sends a POLL message, with the resync flag set to reset its high-water mark and resend everything still in the table.
+# With the socket transport it also acknowledges the newest row it received, which becomes the high-water mark: a reply
+# the master never got whole, because it timed out or the connection dropped, is sent again on the next request.
+# With the socket transport the summary rows the master hasn't been sent yet are returned in a SUMMARY message.
+# With the db transport they are copied straight into the master's db and a SHIPPED message returns the counts,
+# after remote_retention made sure the master's table has partitions for them.
+# ship_state is kept per master across reconnects: {"id": high-water mark (the rows' ids become visible in order even with
+# several flushers, see DBManager.lock_summary_ids), "rows": rows shipped, "bytes": bytes shipped,
+# "sketch_id": id of the last sketch sent}. With ship_sketches the newest window sketch the master hasn't been sent yet
+# goes in a SKETCH message ahead of the reply, for master_client to merge with the other gathering devices'.
+# Connections are borrowed from the pools for one request at a time, so sessions only hold one while they use it.
+# A SUBSCRIBE message switches the connection to push mode for good, see serve_subscriber.
+def receive_master(connection, session, local_pool, remote_pool, remote_retention, summ_table, ship_state, sensor, compression="none", hub=None,
+                   ship_sketches=False):
   while True:
-    master_cmd = connection.recv(max_buffer_size)
-    if int(master_cmd) == 1:
-      local_dbmanager.copy_summary_to_csv(summ_table)
-      remote_dbmanager.copy_summary_from_csv(summ_table)
-      connection.send(b"1")
-      print("Summary sent!")
+    msg_type, payload = wire_protocol.recv_message(connection)
+    if msg_type == wire_protocol.SUBSCRIBE and hub is not None:
+      resync, ack_id = wire_protocol.decode_poll(payload)
+      if resync:
+        ship_state["id"] = 0
+        ship_state["sketch_id"] = 0
+      elif ack_id is not None:
+        ship_state["id"] = ack_id
+      serve_subscriber(connection, session, local_pool, summ_table, ship_state, sensor, compression, hub, ship_sketches)
+      return
+    if msg_type != wire_protocol.POLL:
+      raise wire_protocol.ProtocolError(f"unexpected message type {msg_type}")
+    resync, ack_id = wire_protocol.decode_poll(payload)
+    if resync:
+      ship_state["id"] = 0
+      ship_state["sketch_id"] = 0
+    elif ack_id is not None and remote_pool is None:
+      ship_state["id"] = ack_id
+
+    start_time = time.time()
+    sketch = None
+    with local_pool.connection() as local_dbmanager:
+      if ship_sketches:
+        sketch = local_dbmanager.get_latest_sketch(summ_table, ship_state["sketch_id"])
+      until_id, row_count = local_dbmanager.get_new_summary_range(summ_table, ship_state["id"])
+      if remote_pool is None:
+        summ_rows = []
+        if row_count > 0:
+          summ_rows = local_dbmanager.get_new_summary_rows(summ_table, ship_state["id"], until_id)
+      else:
+        byte_count = 0
+        if row_count > 0:
+          min_ts, max_ts = local_dbmanager.get_summary_time_range(summ_table, ship_state["id"], until_id)
+          with remote_pool.connection() as remote_dbmanager:
+            remote_retention.prepare(remote_dbmanager, min_ts, max_ts)
+            byte_count = local_dbmanager.copy_summary_to_db(remote_dbmanager, summ_table, ship_state["id"], until_id, sensor)
+    if sketch is not None:
+      send_sketch(connection, session, ship_state, sensor, compression, sketch)
+    if remote_pool is None:
+      byte_count = wire_protocol.send_message(connection, wire_protocol.SUMMARY, wire_protocol.encode_summary(sensor, summ_rows), compression)
+    else:
+      wire_protocol.send_message(connection, wire_protocol.SHIPPED, wire_protocol.encode_shipped(row_count, byte_count))
+    ship_state["id"] = until_id
+    ship_state["rows"] += row_count
+    ship_state["bytes"] += byte_count
+    SHIPPED_ROWS.inc(row_count)
+    SHIPPED_BYTES.labels("summary" if remote_pool is None else "copy").inc(byte_count)
+    latency = session.add_request(time.time()-start_time)
+    REQUEST_SECONDS.labels("poll").observe(latency)
+    print(f"[{session.name}] Summary sent! {row_count} rows, {byte_count} bytes in {latency*1000:0.1f} ms (total {ship_state['rows']} rows, {ship_state['bytes']} bytes)")
+
+# Pushes summary rows to a subscribed master as monitor.py publishes them. The db is read instead when the
+# subscriber fell behind, when published rows skip ids (a publish was lost), and every heartbeat_interval
+# while nothing is published, which then also sends a HEARTBEAT so the master knows the worker is alive.
+# A master that lost a push disconnects and subscribes again, acknowledging the newest row it got, and the
+# subscription starts by catching up from the db after it.
+def serve_subscriber(connection, session, local_pool, summ_table, ship_state, sensor, compression, hub, ship_sketches=False, heartbeat_interval=1):
+  subscriber = hub.subscribe()
+  print(f"[{session.name}] Master subscribed!")
+  try:
+    while True:
+      summ_rows, lagging = subscriber.next_rows(heartbeat_interval)
+      start_time = time.time()
+      if summ_rows is not None and not lagging:
+        summ_rows = [row for row in summ_rows if row[12] > ship_state["id"]]
+        if summ_rows and summ_rows[0][12] != ship_state["id"]+1:
+          lagging = True
+      if summ_rows is None or lagging:
+        with local_pool.connection() as local_dbmanager:
+          until_id, row_count = local_dbmanager.get_new_summary_range(summ_table, ship_state["id"])
+          summ_rows = local_dbmanager.get_new_summary_rows(summ_table, ship_state["id"], until_id) if row_count > 0 else []
+      if ship_sketches:
+        with local_pool.connection() as local_dbmanager:
+          sketch = local_dbmanager.get_latest_sketch(summ_table, ship_state["sketch_id"])
+        if sketch is not None:
+          send_sketch(connection, session, ship_state, sensor, compression, sketch)
+      if not summ_rows:
+        wire_protocol.send_message(connection, wire_protocol.HEARTBEAT)
+        continue
+      byte_count = wire_protocol.send_message(connection, wire_protocol.SUMMARY, wire_protocol.encode_summary(sensor, summ_rows), compression)
+      ship_state["id"] = max(ship_state["id"], max(row[12] for row in summ_rows))
+      ship_state["rows"] += len(summ_rows)
+      ship_state["bytes"] += byte_count
+      SHIPPED_ROWS.inc(len(summ_rows))
+      SHIPPED_BYTES.labels("summary").inc(byte_count)
+      latency = session.add_request(time.time()-start_time)
+      REQUEST_SECONDS.labels("push").observe(latency)
+      print(f"[{session.name}] Summary pushed! {len(summ_rows)} rows, {byte_count} bytes in {latency*1000:0.1f} ms (total {ship_state['rows']} rows, {ship_state['bytes']} bytes, {subscriber.dropped_batches} dropped batches)")
+  finally:
+    hub.unsubscribe(subscriber)
+
+# sketch is (id, serialized sketches.FlowSketch) as DBManager.get_latest_sketch returns it
+def send_sketch(connection, session, ship_state, sensor, compression, sketch):
+  byte_count = wire_protocol.send_message(connection, wire_protocol.SKETCH, wire_protocol.encode_sketch(sensor, sketch[0], sketch[1]), compression)
+  ship_state["sketch_id"] = sketch[0]
+  ship_state["bytes"] += byte_count
+  SHIPPED_BYTES.labels("sketch").inc(byte_count)
+  print(f"[{session.name}] Sketch sent! id {sketch[0]}, {byte_count} bytes")
+
+# Request latency of one master's session
+class Session():
+  def __init__(self, ip, port):
+    self.name = f"{ip}:{port}"
+    self.start_time = time.time()
+    self.requests = 0
+    self.total_latency = 0
+    self.max_latency = 0
+
+  def add_request(self, latency):
+    self.requests += 1
+    self.total_latency += latency
+    self.max_latency = max(self.max_latency, latency)
+    return latency
+
+  def summary(self):
+    avg_latency = self.total_latency/self.requests if self.requests > 0 else 0
+    return (f"{self.requests} requests in {time.time()-self.start_time:0.0f} secs, "
+            f"latency avg {avg_latency*1000:0.1f} ms, max {self.max_latency*1000:0.1f} ms")
+
+# Runs in its own thread for each accepted master, until the master disconnects.
+# Two sessions from the same master at once don't share a high-water mark.
+def serve_master(connection, address, local_pool, remote_pool, remote_retention, summ_table, ship_states, ship_states_lock, sensor, compression, hub,
+                 ship_sketches=False):
+  ip, port = str(address[0]), str(address[1])
+  session = Session(ip, port)
+  with ship_states_lock:
+    ship_state = ship_states.setdefault(ip, {"id": 0, "rows": 0, "bytes": 0, "sketch_id": 0, "active": False})
+    if ship_state["active"]:
+      ship_state = ship_states[session.name] = {"id": 0, "rows": 0, "bytes": 0, "sketch_id": 0, "active": False}
+    ship_state["active"] = True
+  print(f"[{session.name}] Connection Accepted!")
+  try:
+    receive_master(connection, session, local_pool, remote_pool, remote_retention, summ_table, ship_state, sensor, compression, hub, ship_sketches)
+  except Exception as e:
+    print(f"[{session.name}] Master disconnected! ({e})")
+  finally:
+    with ship_states_lock:
+      ship_state["active"] = False
+    try:
+      connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    connection.close()
+    print(f"[{session.name}] Session closed: {session.summary()}")
 
 def main():
   parser = argparse.ArgumentParser()
-  parser.add_argument("-master", required=True, nargs="+", help="Host address of the master node")
+  parser.add_argument("-master", required=True, nargs="+", help="Host addresses of the master nodes allowed to connect")
   parser.add_argument("-port", required=True, help="Port to communicate with the master node")
+  parser.add_argument("-bind", default="0.0.0.0", help="Local address to listen on")
+  parser.add_argument("-pool_size", type=int, default=4, help="Max number of connections to each database shared by all the masters")
   parser.add_argument("-local_user", required=True, help="User of the local database")
   parser.add_argument("-local_password", required=True, help="User's local access password")
   parser.add_argument("-local_host", required=True, help="Host local database is located on")
   parser.add_argument("-local_database", required=True, help="Name of the local database")
-  parser.add_argument("-remote_user", required=True, help="User of the remote database")
-  parser.add_argument("-remote_password", required=True, help="User's remote access password")
-  parser.add_argument("-remote_host", required=True, help="Host remote database is located on")
-  parser.add_argument("-remote_database", required=True, help="Name of the remote database")
+  parser.add_argument("-transport", default="socket", choices=("socket", "db"), help="Send summaries to the master over the socket, or copy them into the master's database directly")
+  parser.add_argument("-compression", default="none", choices=wire_protocol.COMPRESSIONS, help="Compression of the summaries sent over the socket")
+  parser.add_argument("-remote_user", help="User of the remote database, with -transport db")
+  parser.add_argument("-remote_password", help="User's remote access password, with -transport db")
+  parser.add_argument("-remote_host", help="Host remote database is located on, with -transport db")
+  parser.add_argument("-remote_database", help="Name of the remote database, with -transport db")
   parser.add_argument("-summ_table", required=True, help="Table the stream is summarized to")
+  parser.add_argument("-sensor", default=socket.gethostname(), help="Name this gathering device's rows are tagged with on the master")
+  parser.add_argument("-audit_level", default="statement", choices=audit_log.AUDIT_LEVELS, help="How much of the SQL sent to the databases is logged to sql_log_worker_server.SQL, full and sampled fill in the parameters")
+  parser.add_argument("-audit_max_bytes", type=int, default=audit_log.MAX_BYTES, help="Bytes sql_log_worker_server.SQL grows to before it is rotated")
+  parser.add_argument("-audit_max_age", type=float, default=audit_log.MAX_AGE, help="Seconds after which sql_log_worker_server.SQL is rotated, 0 to only rotate on -audit_max_bytes")
+  parser.add_argument("-publish_port", type=int, help="Local port monitor.py publishes flushed summaries to, for masters that subscribe instead of polling")
+  parser.add_argument("-ship_sketches", action="store_true", help="Also send the newest window sketch of monitor.py -aggregate sketch to the master, to merge across the raspberry pis")
+  parser.add_argument("-subscriber_buffer", type=int, default=64, help="Published batches buffered per subscribed master before it is treated as a slow consumer")
+  parser.add_argument("-metrics_port", type=int, help="Local port to serve request timings and counters on, in Prometheus text format at /metrics")
+  parser.add_argument("-stats_file", help="JSON file the request timings and counters are written to every stats_interval seconds")
+  parser.add_argument("-stats_interval", type=float, default=10, help="Seconds between writes of -stats_file")
   args = parser.parse_args()
+  if args.transport == "db" and None in (args.remote_user, args.remote_password, args.remote_host, args.remote_database):
+    parser.error("-transport db requires -remote_user, -remote_password, -remote_host and -remote_database")
 
-  host = args.master
-  port = args.port
+  masters = set(socket.gethostbyname(master) for master in args.master)
+  port = int(args.port)
 
   soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
   soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
   print("Socket created!")
 
   try:
-    soc.bind((host,port))
+    soc.bind((args.bind,port))
   except:
     print(f"Bind failed. Error: {str(sys.exc_info())}")
     sys.exit(1)
@@ -51,31 +230,53 @@ def main():
   soc.listen(5)
   print("Socket now listening!")
 
-  max_buffer_size = 5120
+  # monitor.py pushes each flushed window here and it is forwarded to the subscribed masters
+  hub = None
+  if args.publish_port is not None:
+    hub = summary_publisher.SubscriberHub(args.subscriber_buffer)
+    hub.start("127.0.0.1", args.publish_port)
+
+  # every session shares these connections instead of opening its own
+  local_pool = db_pool.DBManagerPool(lambda: db_manager.DBManager(user=args.local_user,
+                                                                 password=args.local_password,
+                                                                 host=args.local_host,
+                                                                 database=args.local_database,
+                                                                 sql_log_file="sql_log_worker_server.SQL",
+                                                                 csv_file="summary.csv",
+                                                                 audit_level=args.audit_level,
+                                                                 audit_max_bytes=args.audit_max_bytes,
+                                                                 audit_max_age=args.audit_max_age),
+                                     args.pool_size)
+  remote_pool = None
+  remote_retention = None
+  if args.transport == "db":
+    remote_pool = db_pool.DBManagerPool(lambda: db_manager.DBManager(user=args.remote_user,
+                                                                    password=args.remote_password,
+                                                                    host=args.remote_host,
+                                                                    database=args.remote_database,
+                                                                    sql_log_file="sql_log_worker_server.SQL",
+                                                                    csv_file="summary.csv",
+                                                                    audit_level=args.audit_level,
+                                                                    audit_max_bytes=args.audit_max_bytes,
+                                                                    audit_max_age=args.audit_max_age),
+                                        args.pool_size)
+    # only creates the master's partitions, with the size master_client made its table with. the master drops them
+    remote_retention = retention.RetentionManager(args.summ_table, "min_timestamp", 0)
+
+  ship_states = {}
+  ship_states_lock = threading.Lock()
+  metrics.gauge("worker_sessions", "Masters connected", function=lambda: sum(state["active"] for state in list(ship_states.values())))
+  metrics.start_exporters(args.metrics_port, args.stats_file, args.stats_interval)
   while True:
     connection, address = soc.accept()
-    ip, port = str(address[0]), str(address[1])
-    print(f"Connection Accepted!")
-    try:
-      local_dbmanager = db_manager.DBManager(user=args.local_user,
-                                         password=args.local_password,
-                                         host=args.local_host,
-                                         database=args.local_database,
-                                         sql_log_file="sql_log_worker_server.SQL",
-                                         csv_file="summary.csv")
-      remote_dbmanager = db_manager.DBManager(user=args.remote_user,
-                                       password=args.remote_password,
-                                       host=args.remote_host,
-                                       database=args.remote_database,
-                                       sql_log_file="sql_log_worker_server.SQL",
-                                       csv_file="summary.csv",
-                                       clear_log=False)
-      summ_table = args.summ_table
-      receive_master(connection, local_dbmanager, remote_dbmanager, summ_table, max_buffer_size)
-    except:
-      connection.shutdown(socket.SHUT_RDWR)
+    if str(address[0]) not in masters:
+      print(f"Connection from {address[0]} refused, not a master!")
       connection.close()
-      print("Master disconnected!")
+      continue
+    threading.Thread(target=serve_master,
+                     args=(connection, address, local_pool, remote_pool, remote_retention, args.summ_table, ship_states, ship_states_lock,
+                           args.sensor, args.compression, hub, args.ship_sketches),
+                     daemon=True).start()
 
 if __name__ == "__main__":
   main()
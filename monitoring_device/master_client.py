@@ -4,15 +4,117 @@ Author:   Quangtri Thai
 Contents: Program to recieve and send messages through sockets to communicate with multiple worker servers. Displaying information about the data recieved.
 '''
 
-import socket, sys
 import argparse
+import threading
 import time
 
-from asciimatics.screen import Screen
-
+import audit_log
+import dashboard
 import db_manager
+import metrics
+import retention
+import rollup
+import flow_aggregator
+import sketches
+import summary_archive
+import summary_merge
+import worker_poller
+
+# one round of the poll loop: poll the workers, insert the rows that came over the sockets, roll them up,
+# merge them across sensors, age out old rows and query the dashboard's flows. dashboard redraws are in render_seconds
+STAGE_SECONDS = metrics.histogram("master_stage_seconds", "Duration of each stage of the poll loop", ("stage",))
+LOOP_SECONDS = metrics.histogram("master_loop_seconds", "Duration of a whole round of the poll loop, without the sleep")
+SHIPPED_ROWS = metrics.counter("master_shipped_rows_total", "Summary rows received from the workers")
+SHIPPED_BYTES = metrics.counter("master_shipped_bytes_total", "Bytes received from the workers, or copied by them with -transport db")
+
+# merges the newest window sketch of each worker into one, skipping ones that can't be merged with the first
+# (a different monitor.py -hll_precision). returns the merged sketch and how many were merged
+def merge_sketches(shipped_sketches):
+  merged = None
+  merged_count = 0
+  for sensor, sketch_id, data in shipped_sketches:
+    sketch = sketches.FlowSketch.from_bytes(data)
+    if merged is None:
+      merged = sketch
+    elif sketch.distinct_src.precision != merged.distinct_src.precision or sketch.sample_rate != merged.sample_rate:
+      continue
+    else:
+      merged.merge(sketch)
+    merged_count += 1
+  return merged, merged_count
+
+def flow_str(src, srcport, dst, dstport):
+  src_str = src if srcport is None else f"{src}:{srcport}"
+  dst_str = dst if dstport is None else f"{dst}:{dstport}"
+  return f"{src_str}->{dst_str}"
+
+# What the dashboard shows. The poll loop hands it each round's results and the renderer reads them from its
+# own thread, along with the workers' status and the merged sketch, so drawing never holds up a poll
+class MasterDashboard():
+  def __init__(self, poller, mode, merged=False):
+    self.poller = poller
+    self.mode = mode
+    self.merged = merged
+    self.lock = threading.Lock()
+    self.poll_interval = 0
+    self.shipped_rows = 0
+    self.shipped_bytes = 0
+    self.log_window = 1
+    self.pps_info = []
+
+  def update(self, poll_interval, shipped_rows, shipped_bytes, log_window, pps_info):
+    with self.lock:
+      self.poll_interval = poll_interval
+      self.shipped_rows = shipped_rows
+      self.shipped_bytes = shipped_bytes
+      self.log_window = log_window
+      self.pps_info = pps_info
+
+  def stats(self, max_rows):
+    with self.lock:
+      stats = {"time": time.time(), "mode": self.mode, "poll_interval": self.poll_interval, "shipped_rows": self.shipped_rows,
+               "shipped_bytes": self.shipped_bytes, "window": self.log_window, "merged": self.merged}
+      pps_info = self.pps_info
+    # per worker status, data from down or slow workers is still shown
+    stats["workers"] = []
+    for worker in list(self.poller.workers):
+      stats["workers"].append({"name": worker.name(), "state": worker.state, "rtt": worker.rtt, "staleness": worker.staleness(),
+                               "shipped_rows": worker.shipped_rows,
+                               "error": worker.error if worker.state == "down" else None,
+                               "retry": max(0, worker.retry_time-time.time()) if worker.state == "down" else None})
+    # heavy hitters and distinct counts of the newest window across the pis, with worker_server -ship_sketches
+    merged_sketch, sketch_count = merge_sketches(self.poller.sketches())
+    if merged_sketch is not None:
+      distinct_src, distinct_dst, distinct_dstport = merged_sketch.distinct_counts()
+      # counts of sampled packets are scaled back up, distinct counts can only be of the packets that were kept
+      rate = merged_sketch.sample_rate
+      stats["sketch"] = {"pis": sketch_count, "packets": merged_sketch.packets*rate, "distinct_src": distinct_src, "distinct_dst": distinct_dst,
+                         "distinct_dstport": distinct_dstport, "sample_rate": rate,
+                         "heavy_hitters": [{"flow": flow_str(*key[:4]), "min_count": (count-error)*rate, "max_count": count*rate}
+                                           for key, count, error in merged_sketch.top.top(3)]}
+    stats["flows"] = dashboard.flow_dicts(sorted(pps_info, key=lambda info: (-info[5], info[4]))[:max_rows])
+    return stats
+
+  def lines(self, stats, width):
+    interval_str = f"Poll interval: {stats['poll_interval']:0.2f} secs" if stats["mode"] == "poll" else "Subscribed"
+    lines = [f"Shipped: {stats['shipped_rows']} rows, {stats['shipped_bytes']} bytes | {interval_str}",
+             f"Window: {stats['window']} secs" + (" | flows seen by several pis counted once" if stats["merged"] else "")]
+    for worker in stats["workers"]:
+      rtt = f"{worker['rtt']*1000:0.0f} ms" if worker["rtt"] is not None else "-"
+      staleness = f"{worker['staleness']:0.1f} secs" if worker["staleness"] is not None else "never"
+      status_str = f"{worker['name']:21s} | {worker['state']:10s} | rtt {rtt:8s} | last reply {staleness:12s} | {worker['shipped_rows']} rows"
+      if worker["error"] is not None:
+        status_str += f" | {worker['error']}, retry in {worker['retry']:0.0f} secs"
+      lines.append(status_str)
+    if "sketch" in stats:
+      sketch = stats["sketch"]
+      lines.append(f"Sketch of {sketch['pis']} pis: {sketch['packets']} packets | ~{sketch['distinct_src']} srcs, ~{sketch['distinct_dst']} dsts, ~{sketch['distinct_dstport']} dst ports")
+      heavy_hitters = ", ".join(f"{hitter['flow']} {hitter['min_count']}-{hitter['max_count']}" for hitter in sketch["heavy_hitters"])
+      lines.append(f"Heavy hitters: {heavy_hitters}")
+    col_info = ["src:port", 21, "dst:port", 21, "last occurrence(secs)", 21, "pps", 8] # header follow by max width
+    return lines + dashboard.flow_table_lines(col_info, stats["flows"])
 
-def main(screen):
+def main():
   parser = argparse.ArgumentParser()
   parser.add_argument("-pi_hosts", required=True, nargs="+", help="List of host addresses of each raspberry pi")
   parser.add_argument("-port", required=True, help="Port to communicate with each raspberry pi")
@@ -21,63 +123,143 @@ def main(screen):
   parser.add_argument("-host", required=True, help="Host database is located on")
   parser.add_argument("-database", required=True, help="Name of the database")
   parser.add_argument("-summ_table", required=True, help="Table the stream is summarized to")
+  parser.add_argument("-table_timewindow", type=float, default=20, help="Time window size of the table in mintues. Older summary rows are removed")
+  parser.add_argument("-partition_size", type=int, help="Seconds of data in each partition of the summary table. Defaults to a quarter of table_timewindow")
+  parser.add_argument("-detach_partitions", action="store_true", help="Detach partitions older than table_timewindow instead of dropping them, to archive them")
+  parser.add_argument("-timeout", type=float, default=2, help="Seconds to wait for each raspberry pi to answer before marking it down")
+  parser.add_argument("-min_interval", type=float, default=0.5, help="Shortest time, in seconds, between polls")
+  parser.add_argument("-max_interval", type=float, default=5, help="Longest time, in seconds, between polls")
+  parser.add_argument("-audit_level", default="statement", choices=audit_log.AUDIT_LEVELS, help="How much of the SQL sent to the database is logged to sql_log.SQL, full and sampled fill in the parameters")
+  parser.add_argument("-audit_max_bytes", type=int, default=audit_log.MAX_BYTES, help="Bytes sql_log.SQL grows to before it is rotated")
+  parser.add_argument("-audit_max_age", type=float, default=audit_log.MAX_AGE, help="Seconds after which sql_log.SQL is rotated, 0 to only rotate on -audit_max_bytes")
+  parser.add_argument("-mode", default="poll", choices=("poll", "subscribe"), help="Poll the raspberry pis, or subscribe and have them push summaries as windows close (needs worker_server -publish_port)")
+  parser.add_argument("-archive_dir", help="Directory to archive summary rows to as compressed columnar segments before they're older than table_timewindow and dropped. query_process.py -archive_dir queries them")
+  parser.add_argument("-merge_bucket", type=float, default=1, help="Seconds of each bucket of the merged view. Pis that saw the same flow in the same bucket are counted once")
+  parser.add_argument("-no_merge", action="store_true", help="Don't merge the pis' summaries, the dashboard adds up what each pi saw")
+  parser.add_argument("-metrics_port", type=int, help="Local port to serve poll loop timings and counters on, in Prometheus text format at /metrics")
+  parser.add_argument("-stats_file", help="JSON file the poll loop timings and counters are written to every stats_interval seconds")
+  parser.add_argument("-stats_interval", type=float, default=10, help="Seconds between writes of -stats_file")
+  parser.add_argument("-headless", action="store_true", help="Run without the dashboard, e.g. as a service, and print its stats as one line of JSON every min_interval seconds instead")
   args = parser.parse_args()
+  if args.headless:
+    run(args, None)
+    return
+  # only imported for the dashboard, so -headless doesn't need a terminal or asciimatics
+  from asciimatics.screen import Screen
+  Screen.wrapper(lambda screen: run(args, screen))
 
+# screen is None with -headless
+def run(args, screen):
   hosts = args.pi_hosts
   port = args.port
 
-  socks = []
-  for i in range(len(hosts)):
-    try:
-      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      sock.connect((hosts[i],port))
-      socks.append(sock)
-    except ConnectionRefusedError:
-      print(f"Connection failed for {hosts[i]}:{port}")
-      sys.exit(1)
+  # workers are polled in parallel, unreachable ones are retried in the background
+  poller = worker_poller.WorkerPoller(hosts, port, args.timeout, mode=args.mode)
+  metrics.gauge("master_workers_up", "Workers that are not down", function=lambda: sum(worker.state != "down" for worker in poller.workers))
+  metrics.gauge("master_max_rtt_seconds", "Round-trip time of the slowest worker", function=poller.max_rtt)
+  metrics.start_exporters(args.metrics_port, args.stats_file, args.stats_interval)
 
   dbmanager = db_manager.DBManager(user=args.user,
                                    password=args.password,
                                    host=args.host,
-                                   database=args.database)
+                                   database=args.database,
+                                   audit_level=args.audit_level,
+                                   audit_max_bytes=args.audit_max_bytes,
+                                   audit_max_age=args.audit_max_age)
   summ_table = args.summ_table
-  max_buffer_size=5120
+  # rows are aged out by dropping whole min_timestamp partitions instead of deleting them
+  dbmanager.create_summary_table(summ_table, master=True)
+  # with worker_server -transport db the workers add partitions to this table too, using the partition size
+  # of the ones made here before any worker is polled
+  # with -archive_dir the rows are archived with their sensor before they're dropped
+  archiver = None
+  if args.archive_dir is not None:
+    archiver = summary_archive.SummaryArchiver(args.archive_dir, flow_aggregator.SUMMARY_COLUMNS + ("sensor", "sensor_id"))
+  summ_retention = retention.RetentionManager(summ_table, "min_timestamp", args.table_timewindow*60, args.partition_size,
+                                              detach=args.detach_partitions, shared=True, archiver=archiver)
+  summ_retention.prepare(dbmanager, time.time()-args.table_timewindow*60, time.time())
+  # the dashboard reads pps from the rollups. rows get here over the sockets and straight from the workers with
+  # -transport db, so they're rolled up from the table by id, and rollup_state keeps the watermark across restarts.
+  # every insert takes DBManager.lock_summary_ids, so a row can't become visible below the watermark and each row is
+  # rolled up exactly once
+  dbmanager.create_rollup_tables(summ_table)
+  rollups = rollup.Rollups(summ_table, args.table_timewindow*60, args.partition_size, args.detach_partitions)
+  rollup_id = dbmanager.get_rollup_watermark(summ_table)
+  # pis with overlapping coverage send the same flows, the merged view counts them once and the dashboard reads it.
+  # it is updated from the new rows by id like the rollups, with its own watermark, which lock_summary_ids keeps from
+  # passing rows that aren't visible yet either. merging adds the sensors' packets up, so each row is merged exactly once
+  merger = None
+  if not args.no_merge:
+    dbmanager.create_merge_tables(summ_table)
+    merger = summary_merge.SummaryMerger(summ_table, args.table_timewindow*60, args.merge_bucket, args.partition_size, args.detach_partitions)
+    merge_id = dbmanager.get_rollup_watermark(summary_merge.merged_table(summ_table))
+  # redrawn every min_interval seconds on its own thread
+  display = MasterDashboard(poller, args.mode, merger is not None)
+  renderer = dashboard.Renderer(display.stats, display.lines, args.min_interval, screen)
+  renderer.start()
+  # workers only send rows we haven't been sent yet, the first request to each asks it to resend
+  # everything it still has since this table may have been aged out while we were down.
+  # rows are applied idempotently, so resent rows are skipped.
+  poll_interval = args.min_interval
   while True:
-    dbmanager.clear_summ_table(summ_table)
-    for sock in socks:
-      sock.send(b"1")
-    for sock in socks:
-      sock.recv(max_buffer_size)
+    poll_ts = time.time()
+    loop_start = time.perf_counter()
+    shipped_before, shipped_bytes_before = poller.shipped()
+    # subscribed workers push rows on their own, so just collect them for one refresh interval
+    with STAGE_SECONDS.labels("poll").time():
+      poller.poll(wait=args.min_interval if args.mode == "subscribe" else 0)
+    shipped_rows, shipped_bytes = poller.shipped()
+    SHIPPED_ROWS.inc(shipped_rows-shipped_before)
+    SHIPPED_BYTES.inc(shipped_bytes-shipped_bytes_before)
 
-    log_window = 1
-    pps_info = dbmanager.get_summ_pps_info(summ_table, log_window)
-    sorted_pps_info = sorted(pps_info, key=lambda info: (-info[5], info[4]))
-    
-    screen.clear()
-    screen.print_at(f"Window: {log_window} secs", 0, 1)
+    # summaries that came over the sockets go into the db with one bulk COPY
+    summ_rows = poller.take_summary_rows()
+    if summ_rows:
+      with STAGE_SECONDS.labels("insert").time():
+        summ_retention.prepare(dbmanager, min(row[0] for row in summ_rows), max(row[0] for row in summ_rows))
+        dbmanager.insert_shipped_summary(summ_table, summ_rows)
 
-    col_info = ["src:port", 21, "dst:port", 21, "last occurrence(secs)", 21, "pps", 8] # header follow by max width
-    header_str = ""
-    for i in range(0, len(col_info), 2):
-      header_str += "{0:{1}s} | ".format(col_info[i], col_info[i+1])
-    header_str = header_str[:-3]
-    screen.print_at(header_str, 0, 2)
-    screen.print_at("-"*len(header_str), 0, 3)
-
-    data_offset = 4
-    for row in range(len(sorted_pps_info)):
-      info = sorted_pps_info[row]
-      data_str = ""
-      data_str += "{0:{1}s} | ".format(info[0], col_info[1]) if info[1] is None else "{0:{1}s} | ".format(info[0]+":"+str(info[1]), col_info[1])
-      data_str += "{0:{1}s} | ".format(info[2], col_info[3]) if info[3] is None else "{0:{1}s} | ".format(info[2]+":"+str(info[3]), col_info[3])
-      for i in range(4, len(info)):
-        j = (i-2)*2+1
-        data = "{:0.2f}".format(info[i]) if isinstance(info[i], int) or isinstance(info[i], float) else str(info[i])
-        data_str += "{0:{1}s} | ".format(data, col_info[j]) if i == 4 else "{0:{1}s} | ".format(data, col_info[j])
-      data_str = data_str[:-3]
-      screen.print_at(data_str, 0, row+data_offset)
-    screen.refresh()
-    time.sleep(3)
+    # poll faster while workers have new rows, back off while they don't,
+    # and never faster than the slowest worker answers
+    if args.mode == "poll":
+      if shipped_rows > shipped_before:
+        poll_interval = poll_interval/2
+      else:
+        poll_interval = poll_interval*1.5
+      poll_interval = min(args.max_interval, max(args.min_interval, poller.max_rtt(), poll_interval))
+
+    with STAGE_SECONDS.labels("rollup").time():
+      until_id, row_count = dbmanager.get_new_summary_range(summ_table, rollup_id)
+      if row_count > 0:
+        rollups.add(dbmanager, dbmanager.get_new_summary_rows(summ_table, rollup_id, until_id), until_id)
+        rollup_id = until_id
+
+    if merger is not None:
+      with STAGE_SECONDS.labels("merge").time():
+        until_id, row_count = dbmanager.get_new_summary_range(summ_table, merge_id)
+        if row_count > 0:
+          merger.add(dbmanager, dbmanager.get_new_summary_rows(summ_table, merge_id, until_id, with_sensor=True), until_id)
+          merge_id = until_id
+
+    # age out old rows by time instead of truncating the table every poll
+    with STAGE_SECONDS.labels("retention").time():
+      latest_ts = dbmanager.get_max_timestamp(summ_table)
+      summ_retention.enforce(dbmanager, latest_ts)
+      rollups.enforce(dbmanager, latest_ts)
+      if merger is not None:
+        merger.enforce(dbmanager, latest_ts)
+
+    log_window = 1
+    with STAGE_SECONDS.labels("query").time():
+      if merger is not None:
+        pps_info = dbmanager.get_merged_pps_info(summ_table, log_window, args.merge_bucket)
+      else:
+        pps_info = dbmanager.get_summ_pps_info(summ_table, log_window)
+    display.update(poll_interval, shipped_rows, shipped_bytes, log_window, pps_info)
+    if renderer.error is not None:
+      raise renderer.error
+    LOOP_SECONDS.observe(time.perf_counter()-loop_start)
+    time.sleep(max(0, poll_interval-(time.time()-poll_ts)))
 
 if __name__ == "__main__":
-  Screen.wrapper(main)
\ No newline at end of file
+  main()
\ No newline at end of file
@@ -0,0 +1,218 @@
+'''
+File:     worker_poller.py
+Author:   Quangtri Thai
+Contents: Polls every worker server in parallel with per-host timeouts, reconnecting dead hosts with backoff.
+'''
+
+import errno
+import selectors
+import socket
+import struct
+import time
+
+import wire_protocol
+
+# State of the connection to one worker server
+class WorkerConnection():
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self.sock = None
+    self.state = "down" # down, connecting, idle, waiting, subscribed
+    self.retry_time = 0 # when to try connecting again while down
+    self.backoff = 0
+    self.deadline = 0 # when the pending connect or request times out
+    self.sent_time = None
+    self.resync = True # ask for a full resend on the first request
+    self.received_id = None # id of the newest summary row received from the worker, acknowledged with each request
+    self.rtt = None # round-trip time of the last request
+    self.last_reply_time = None
+    self.shipped_rows = 0
+    self.shipped_bytes = 0
+    self.frames = wire_protocol.FrameBuffer()
+    self.summary_rows = [] # rows received over the socket and not yet written to the db
+    self.sketch = None # newest (sensor, sketch id, serialized sketch) received, with worker_server -ship_sketches
+    self.failures = 0
+    self.error = None # why the connection last went down
+
+  def name(self):
+    return f"{self.host}:{self.port}"
+
+  # seconds since the last reply, None if it never replied
+  def staleness(self):
+    if self.last_reply_time is None:
+      return None
+    return time.time()-self.last_reply_time
+
+# Sends the poll request to all workers at once and waits for the replies with one selector,
+# so a slow or dead worker only costs its own timeout and is retried with exponential backoff.
+# Each request acknowledges the newest row received from the worker, and the worker sends the rows after it,
+# so the rows of a reply that was cut short or timed out are sent again once the worker is reconnected.
+# In subscribe mode each worker is sent one SUBSCRIBE request and then pushes summaries as its windows close,
+# a worker that sends nothing, not even a heartbeat, for timeout seconds is treated as down.
+class WorkerPoller():
+  def __init__(self, hosts, port, timeout=2, min_backoff=1, max_backoff=30, max_buffer_size=65536, mode="poll"):
+    self.workers = [WorkerConnection(host, int(port)) for host in hosts]
+    self.mode = mode
+    self.timeout = timeout
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    self.max_buffer_size = max_buffer_size
+    self.selector = selectors.DefaultSelector()
+
+  # one poll round, returns the workers that replied in this round.
+  # in subscribe mode it instead receives whatever the workers push during the next wait seconds
+  def poll(self, wait=0):
+    cur_time = time.time()
+    end_time = cur_time+wait
+    for worker in self.workers:
+      if worker.state == "down" and cur_time >= worker.retry_time:
+        self.connect(worker)
+    for worker in self.workers:
+      if worker.state == "idle":
+        self.send_request(worker)
+
+    replied = []
+    while self.pending() or (self.mode == "subscribe" and time.time() < end_time and self.subscribed()):
+      deadlines = [worker.deadline for worker in self.workers if worker.state in ("connecting", "waiting", "subscribed")]
+      if self.mode == "subscribe":
+        deadlines.append(end_time)
+      for key, events in self.selector.select(timeout=max(0, min(deadlines)-time.time())):
+        worker = key.data
+        if worker.state == "connecting":
+          self.finish_connect(worker)
+        elif worker.state in ("waiting", "subscribed"):
+          if self.receive_reply(worker) and worker not in replied:
+            replied.append(worker)
+      cur_time = time.time()
+      for worker in self.workers:
+        if worker.state in ("connecting", "waiting", "subscribed") and cur_time >= worker.deadline:
+          self.disconnect(worker, "timed out")
+    return replied
+
+  def pending(self):
+    return any(worker.state in ("connecting", "waiting") for worker in self.workers)
+
+  def subscribed(self):
+    return any(worker.state == "subscribed" for worker in self.workers)
+
+  def connect(self, worker):
+    worker.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    worker.sock.setblocking(False)
+    err = worker.sock.connect_ex((worker.host, worker.port))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self.disconnect(worker, f"connect failed ({errno.errorcode.get(err, err)})", registered=False)
+      return
+    worker.state = "connecting"
+    worker.deadline = time.time()+self.timeout
+    self.selector.register(worker.sock, selectors.EVENT_WRITE, worker)
+
+  def finish_connect(self, worker):
+    err = worker.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err != 0:
+      self.disconnect(worker, f"connect failed ({errno.errorcode.get(err, err)})")
+      return
+    worker.backoff = 0
+    worker.state = "idle"
+    self.send_request(worker)
+
+  def send_request(self, worker):
+    msg_type = wire_protocol.SUBSCRIBE if self.mode == "subscribe" else wire_protocol.POLL
+    try:
+      wire_protocol.send_message(worker.sock, msg_type, wire_protocol.encode_poll(worker.resync, worker.received_id))
+    except OSError as e:
+      self.disconnect(worker, str(e))
+      return
+    worker.state = "subscribed" if self.mode == "subscribe" else "waiting"
+    worker.sent_time = time.time()
+    worker.deadline = worker.sent_time+self.timeout
+    self.selector.modify(worker.sock, selectors.EVENT_READ, worker)
+
+  # the reply is a SUMMARY message carrying the rows, or a SHIPPED message when the worker
+  # copied the rows into the db itself. it may arrive split over several reads.
+  # subscribed workers keep sending SUMMARY messages, and HEARTBEAT messages while there is nothing new.
+  # a SKETCH message can come ahead of the reply, it doesn't end the request by itself.
+  def receive_reply(self, worker):
+    try:
+      data = worker.sock.recv(self.max_buffer_size)
+    except BlockingIOError:
+      return False
+    except OSError as e:
+      self.disconnect(worker, str(e))
+      return False
+    if not data:
+      self.disconnect(worker, "closed by worker")
+      return False
+    try:
+      messages = worker.frames.feed(data)
+    except wire_protocol.ProtocolError as e:
+      self.disconnect(worker, str(e))
+      return False
+    if not messages:
+      return False
+    worker.last_reply_time = time.time()
+    if worker.state == "subscribed":
+      # a subscription stays open, the deadline only bounds the silence between two messages
+      worker.deadline = worker.last_reply_time+self.timeout
+      worker.rtt = None
+    received = False
+    try:
+      for msg_type, payload, frame_size in messages:
+        if msg_type == wire_protocol.SUMMARY:
+          sensor, rows = wire_protocol.decode_summary(payload)
+          worker.received_id = max([worker.received_id or 0] + [row[-1] for row in rows])
+          worker.summary_rows += rows
+          worker.shipped_rows += len(rows)
+          worker.shipped_bytes += frame_size
+          received = True
+        elif msg_type == wire_protocol.SHIPPED:
+          rows, byte_count = wire_protocol.decode_shipped(payload)
+          worker.shipped_rows += rows
+          worker.shipped_bytes += byte_count
+          received = True
+        elif msg_type == wire_protocol.SKETCH:
+          worker.sketch = wire_protocol.decode_sketch(payload)
+          worker.shipped_bytes += frame_size
+    except (wire_protocol.ProtocolError, struct.error) as e:
+      self.disconnect(worker, str(e))
+      return False
+    if worker.state == "subscribed":
+      worker.resync = False
+      return received
+    if not received:
+      return False
+    worker.resync = False
+    worker.rtt = worker.last_reply_time-worker.sent_time
+    worker.state = "idle"
+    return True
+
+  def disconnect(self, worker, reason, registered=True):
+    if registered:
+      self.selector.unregister(worker.sock)
+    worker.sock.close()
+    worker.sock = None
+    worker.frames = wire_protocol.FrameBuffer()
+    worker.state = "down"
+    worker.failures += 1
+    worker.backoff = min(self.max_backoff, worker.backoff*2 if worker.backoff else self.min_backoff)
+    worker.retry_time = time.time()+worker.backoff
+    worker.error = reason
+
+  # summary rows received from every worker since the last call, merged into one batch
+  def take_summary_rows(self):
+    rows = []
+    for worker in self.workers:
+      rows += worker.summary_rows
+      worker.summary_rows = []
+    return rows
+
+  # the newest sketch of each worker that is up, [(sensor, sketch id, serialized sketch), ...]
+  def sketches(self):
+    return [worker.sketch for worker in self.workers if worker.sketch is not None and worker.state != "down"]
+
+  def shipped(self):
+    return sum(worker.shipped_rows for worker in self.workers), sum(worker.shipped_bytes for worker in self.workers)
+
+  def max_rtt(self):
+    rtts = [worker.rtt for worker in self.workers if worker.rtt is not None and worker.state != "down"]
+    return max(rtts) if rtts else 0
@@ -0,0 +1,111 @@
+'''
+File:     local_engine.py
+Author:   Quangtri Thai
+Contents: query_process.py's queries computed with NumPy over a window of network_log pulled in one COPY, as an alternative to running them in Postgres.
+'''
+
+import csv
+import io
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# The rows of network_log in a query window as columns: float64 timestamps, and src and dst as int64 indexes into
+# one dictionary shared by both columns, so a pair and its reverse can be compared by index. NULL is -1
+class Window():
+  def __init__(self, ts, src, dst, strings):
+    self.ts = ts
+    self.src = src
+    self.dst = dst
+    self.strings = strings
+
+  # text is COPY ... TO STDOUT WITH (FORMAT csv, NULL '\N') of timestamp, src, dst
+  @classmethod
+  def from_csv(cls, text):
+    if numpy is None:
+      raise RuntimeError("-engine local needs numpy, install it with pip3 install numpy")
+    ids = {}
+    strings = []
+    def encode(value):
+      if value == "\\N":
+        return -1
+      index = ids.get(value)
+      if index is None:
+        index = ids[value] = len(strings)
+        strings.append(value)
+      return index
+    ts = []
+    src = []
+    dst = []
+    for row in csv.reader(io.StringIO(text)):
+      ts.append(float(row[0]))
+      src.append(encode(row[1]))
+      dst.append(encode(row[2]))
+    return cls(numpy.array(ts, dtype=numpy.float64), numpy.array(src, dtype=numpy.int64), numpy.array(dst, dtype=numpy.int64), strings)
+
+  def __len__(self):
+    return len(self.ts)
+
+  def value(self, index):
+    return None if index < 0 else self.strings[index]
+
+  # one int64 per (src, dst) pair, NULLs included, and the number the dst part is multiplied by
+  def pair_keys(self):
+    n = len(self.strings)+1
+    return (self.src+1)*n + (self.dst+1), n
+
+# [(src, dst, count), ...] like SELECT src, dst, count(*) ... GROUP BY src, dst
+def group_by(window):
+  if len(window) == 0:
+    return []
+  keys, n = window.pair_keys()
+  unique, counts = numpy.unique(keys, return_counts=True)
+  return [(window.value(key//n-1), window.value(key%n-1), count) for key, count in zip(unique.tolist(), counts.tolist())]
+
+# [(src, dst, max(timestamp)-min(timestamp)), ...], with the rows sorted on their pair and reduced per run of equal pairs
+def sess_dur(window):
+  if len(window) == 0:
+    return []
+  keys, n = window.pair_keys()
+  order = numpy.argsort(keys, kind="stable")
+  keys = keys[order]
+  ts = window.ts[order]
+  starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+  durations = numpy.maximum.reduceat(ts, starts) - numpy.minimum.reduceat(ts, starts)
+  return [(window.value(key//n-1), window.value(key%n-1), duration) for key, duration in zip(keys[starts].tolist(), durations.tolist())]
+
+# number of (L1, L2) pairs, a row with itself included, with L1.timestamp-join_range <= L2.timestamp <= L1.timestamp+join_range,
+# found with two binary searches per row over the sorted timestamps instead of comparing every pair
+def pairs_within(sorted_ts, join_range):
+  lower = numpy.searchsorted(sorted_ts, sorted_ts-join_range, side="left")
+  upper = numpy.searchsorted(sorted_ts, sorted_ts+join_range, side="right")
+  return int((upper-lower).sum())
+
+# the band join's sum of joined rows: the pairs within join_range of each other, minus the pairs with the same src.
+# NULL srcs never satisfy L1.src != L2.src, so they are left out. None when nothing joins, like SQL's sum
+def band_join(window, join_range):
+  has_src = window.src >= 0
+  ts = window.ts[has_src]
+  src = window.src[has_src]
+  if len(ts) == 0:
+    return None
+  joined = pairs_within(numpy.sort(ts), join_range)
+  order = numpy.lexsort((ts, src))
+  src = src[order]
+  bounds = numpy.flatnonzero(src[1:] != src[:-1])+1
+  for group in numpy.split(ts[order], bounds):
+    joined -= pairs_within(group, join_range)
+  return joined if joined > 0 else None
+
+# [(src, dst), ...] of the rows whose reverse pair (dst, src) is in no row of the window, duplicates included.
+# rows with a NULL src or dst never match a reverse pair
+def req_res(window):
+  if len(window) == 0:
+    return []
+  keys, n = window.pair_keys()
+  reverse = (window.dst+1)*n + (window.src+1)
+  has_pair = (window.src >= 0) & (window.dst >= 0)
+  answered = has_pair & numpy.isin(reverse, numpy.unique(keys[has_pair]))
+  return [(window.value(src), window.value(dst)) for src, dst in zip(window.src[~answered].tolist(), window.dst[~answered].tolist())]
@@ -1,33 +1,47 @@
 '''
 File:     query_process.py
 Author:   Quangtri Thai
-Contents: Program to run each query on a Postgres table and find the average runtime.
+Contents: Program to run each query on a Postgres table, with NumPy over the same rows, or on the summary archive, and find the average runtime.
 '''
 
 import psycopg2
 import time
 import sys
 import argparse
+import collections
+import io
+
+import audit_log
+import local_engine
+import summary_archive
 
 sql_log_file = "sql_log.SQL"
+sql_log = None # audit_log.AuditLog, written in the background so it stays out of the timings
 results_file = "results"
 raw_table = "network_log"
 
 # ---General Functions---
 
 def raw_get_end_timestamp(conn):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   cmd = """SELECT max(timestamp) FROM {raw_table}""".format(raw_table=raw_table)
   curs = conn.cursor()
   curs.execute(cmd)
-  sql_log.write(cmd + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd)
   return curs.fetchone()[0]
 
+# floats are sent with all their digits instead of rounded to 15, so the local engine reads the timestamps
+# exactly as they are stored and the results of both engines can be compared
+def raw_set_exact_floats(conn):
+  global sql_log
+  cmd = """SET extra_float_digits = 3"""
+  curs = conn.cursor()
+  curs.execute(cmd)
+  sql_log.log(curs, cmd)
+  conn.commit()
+
 def raw_get_random_row(conn, end_ts, time_window):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   start_ts = end_ts - time_window
   cmd = """
   SELECT * FROM (SELECT * FROM {raw_table} WHERE timestamp >= %(start_ts)s) as T
@@ -36,18 +50,20 @@ def raw_get_random_row(conn, end_ts, time_window):
   curs = conn.cursor()
   cmd_formats = {'start_ts': start_ts}
   curs.execute(cmd, cmd_formats)
-  sql_log.write(curs.mogrify(cmd, cmd_formats).decode('utf-8') + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd, cmd_formats)
   return curs.fetchone()
 
 
 # ---Band Join---
 
-def raw_time_band_join_query(conn, end_ts, time_window, join_range):
+# run is raw_run_band_join_query on conn, or local_run_band_join_query with conn a local_engine.Window.
+# returns the runtime and the query's result
+def raw_time_band_join_query(conn, end_ts, time_window, join_range, run=None):
   global results_file
+  if run == None: run = raw_run_band_join_query
   results = open(results_file, 'a')
   start_time = time.time()
-  joined_rows = raw_run_band_join_query(conn, end_ts, time_window, join_range)
+  joined_rows = run(conn, end_ts, time_window, join_range)
   end_time = time.time()
 
   print("# of joined rows: " + str(joined_rows))
@@ -57,14 +73,13 @@ def raw_time_band_join_query(conn, end_ts, time_window, join_range):
   print("band join query runtime: " + str(runtime) + " seconds")
   results.write("band join query runtime: " + str(runtime) + " seconds\n")
   results.close()
-  return runtime
+  return runtime, joined_rows
 
 # end_ts is the most recent timestamp currectly in the database.
 # time_window is the window of data, in seconds, to preform the band join.
 # join_range is the max range, in seconds, one row can be from another if joining.
 def raw_run_band_join_query(conn, end_ts, time_window, join_range):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   start_ts = end_ts - time_window
 
   cmd = """
@@ -82,19 +97,21 @@ def raw_run_band_join_query(conn, end_ts, time_window, join_range):
   curs = conn.cursor()
   cmd_formats = {'start_ts': start_ts, 'end_ts': end_ts, 'join_range': join_range}
   curs.execute(cmd, cmd_formats)
-  sql_log.write(curs.mogrify(cmd, cmd_formats).decode('utf-8') + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd, cmd_formats)
   conn.commit()
   return curs.fetchone()[0]
 
 
 # ---Group By---
 
-def raw_time_group_by_query(conn, end_ts, time_window):
+# run is raw_run_group_by_query on conn, or local_run_group_by_query or archive_run_group_by_query with conn a
+# local_engine.Window or a summary_archive.Archive. returns the runtime and the query's rows
+def raw_time_group_by_query(conn, end_ts, time_window, run=None):
   global results_file
+  if run == None: run = raw_run_group_by_query
   results = open(results_file, 'a')
   start_time = time.time()
-  grouped_rows = raw_run_group_by_query(conn, end_ts, time_window)
+  grouped_rows = run(conn, end_ts, time_window)
   end_time = time.time()
 
   print("# of grouped rows: " + str(len(grouped_rows)))
@@ -104,11 +121,10 @@ def raw_time_group_by_query(conn, end_ts, time_window):
   print("group by query runtime: " + str(runtime) + " seconds")
   results.write("group by query runtime: " + str(runtime) + " seconds\n")
   results.close()
-  return runtime
+  return runtime, grouped_rows
 
 def raw_run_group_by_query(conn, end_ts, time_window):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   start_ts = end_ts - time_window
 
   cmd = """
@@ -120,19 +136,29 @@ def raw_run_group_by_query(conn, end_ts, time_window):
   curs = conn.cursor()
   cmd_formats = {'start_ts': start_ts, 'end_ts': end_ts}
   curs.execute(cmd, cmd_formats)
-  sql_log.write(curs.mogrify(cmd, cmd_formats).decode('utf-8') + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd, cmd_formats)
   conn.commit()
   return curs.fetchall()
 
+# group by over the summary archive: the summary rows in the window, counted as the packets they stand for
+def archive_run_group_by_query(archive, end_ts, time_window):
+  start_ts = end_ts - time_window
+  counts = {}
+  for src, dst, summ_size, sample_rate in archive_scan(archive, start_ts, end_ts, ("src", "dst", "summ_size", "sample_rate")):
+    counts[(src, dst)] = counts.get((src, dst), 0) + summ_size*sample_rate
+  return [key + (count,) for key, count in counts.items()]
+
 
 # ---Session Duration---
 
-def raw_time_sess_dur_query(conn, end_ts, time_window):
+# run is raw_run_sess_dur_query on conn, or local_run_sess_dur_query or archive_run_sess_dur_query with conn a
+# local_engine.Window or a summary_archive.Archive. returns the runtime and the query's rows
+def raw_time_sess_dur_query(conn, end_ts, time_window, run=None):
   global results_file
+  if run == None: run = raw_run_sess_dur_query
   results = open(results_file, 'a')
   start_time = time.time()
-  sessions = raw_run_sess_dur_query(conn, end_ts, time_window)
+  sessions = run(conn, end_ts, time_window)
   end_time = time.time()
 
   print("# of sessions: " + str(len(sessions)))
@@ -142,11 +168,10 @@ def raw_time_sess_dur_query(conn, end_ts, time_window):
   print("session duration query runtime: " + str(runtime) + " seconds")
   results.write("session duration query runtime: " + str(runtime) + " seconds\n")
   results.close()
-  return runtime
+  return runtime, sessions
 
 def raw_run_sess_dur_query(conn, end_ts, time_window):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   start_ts = end_ts - time_window
 
   cmd = """
@@ -158,19 +183,36 @@ def raw_run_sess_dur_query(conn, end_ts, time_window):
   curs = conn.cursor()
   cmd_formats = {'start_ts': start_ts, 'end_ts': end_ts}
   curs.execute(cmd, cmd_formats)
-  sql_log.write(curs.mogrify(cmd, cmd_formats).decode('utf-8') + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd, cmd_formats)
   conn.commit()
   return curs.fetchall()
 
+def archive_run_sess_dur_query(archive, end_ts, time_window):
+  start_ts = end_ts - time_window
+  sessions = {}
+  for src, dst, min_ts, max_ts in archive_scan(archive, start_ts, end_ts, ("src", "dst", "min_timestamp", "max_timestamp")):
+    session = sessions.get((src, dst))
+    sessions[(src, dst)] = (min_ts, max_ts) if session == None else (min(session[0], min_ts), max(session[1], max_ts))
+  return [key + (session[1]-session[0],) for key, session in sessions.items()]
+
+# the columns of the archived summary rows that lie within start_ts <= timestamp < end_ts, row by row.
+# segments outside the window are skipped without being read
+def archive_scan(archive, start_ts, end_ts, columns):
+  for values in archive.scan(start_ts, end_ts, columns):
+    for row in zip(*values):
+      yield row
+
 
 # ---Request/Response Protocol
 
-def raw_time_req_res_query(conn, end_ts, time_window):
+# run is raw_run_req_res_query on conn, or local_run_req_res_query with conn a local_engine.Window.
+# returns the runtime and the query's rows
+def raw_time_req_res_query(conn, end_ts, time_window, run=None):
   global results_file
+  if run == None: run = raw_run_req_res_query
   results = open(results_file, 'a')
   start_time = time.time()
-  req_res = raw_run_req_res_query(conn, end_ts, time_window)
+  req_res = run(conn, end_ts, time_window)
   end_time = time.time()
 
   print("# of request/response: " + str(len(req_res)))
@@ -180,11 +222,10 @@ def raw_time_req_res_query(conn, end_ts, time_window):
   print("request/response query runtime: " + str(runtime) + " seconds")
   results.write("request/response query runtime: " + str(runtime) + " seconds\n")
   results.close()
-  return runtime
+  return runtime, req_res
 
 def raw_run_req_res_query(conn, end_ts, time_window):
-  global sql_log_file, raw_table
-  sql_log = open(sql_log_file, 'a')
+  global sql_log, raw_table
   start_ts = end_ts - time_window
 
   cmd = """
@@ -203,91 +244,196 @@ def raw_run_req_res_query(conn, end_ts, time_window):
   curs = conn.cursor()
   cmd_formats = {'start_ts': start_ts, 'end_ts': end_ts}
   curs.execute(cmd, cmd_formats)
-  sql_log.write(curs.mogrify(cmd, cmd_formats).decode('utf-8') + "\n\n")
-  sql_log.close()
+  sql_log.log(curs, cmd, cmd_formats)
   conn.commit()
   return curs.fetchall()
 
+
+# ---Local Engine---
+
+def local_time_load_window(conn, end_ts, time_window):
+  global results_file
+  results = open(results_file, 'a')
+  start_time = time.time()
+  window = local_load_window(conn, end_ts, time_window)
+  end_time = time.time()
+
+  print("# of rows loaded: " + str(len(window)))
+  results.write("# of rows loaded: " + str(len(window)) + "\n")
+
+  runtime = end_time - start_time
+  print("local load runtime: " + str(runtime) + " seconds")
+  results.write("local load runtime: " + str(runtime) + " seconds\n")
+  results.close()
+  return runtime, window
+
+# the rows every query reads, pulled with one COPY into the columns of a local_engine.Window
+def local_load_window(conn, end_ts, time_window):
+  global sql_log, raw_table
+  start_ts = end_ts - time_window
+
+  cmd = """
+  COPY (
+    SELECT timestamp, src, dst
+    FROM {raw_table}
+    WHERE %(start_ts)s <= timestamp AND timestamp < %(end_ts)s
+  ) TO STDOUT WITH (FORMAT csv, NULL '\\N')
+  """.format(raw_table=raw_table)
+  curs = conn.cursor()
+  cmd_formats = {'start_ts': start_ts, 'end_ts': end_ts}
+  cmd = curs.mogrify(cmd, cmd_formats).decode("utf-8")
+  rows = io.StringIO()
+  curs.copy_expert(cmd, rows)
+  sql_log.log(curs, cmd)
+  conn.commit()
+  return local_engine.Window.from_csv(rows.getvalue())
+
+# the window is already cut to end_ts and time_window when it is loaded
+def local_run_band_join_query(window, end_ts, time_window, join_range):
+  return local_engine.band_join(window, join_range)
+
+def local_run_group_by_query(window, end_ts, time_window):
+  return local_engine.group_by(window)
+
+def local_run_sess_dur_query(window, end_ts, time_window):
+  return local_engine.sess_dur(window)
+
+def local_run_req_res_query(window, end_ts, time_window):
+  return local_engine.req_res(window)
+
+# the rows of two engines are the same when they hold the same rows, in any order
+def same_results(rows, other_rows):
+  if not isinstance(rows, list):
+    return rows == other_rows
+  return collections.Counter(map(tuple, rows)) == collections.Counter(map(tuple, other_rows))
+
 def main():
-  global results_file, sql_log_file
+  global results_file, sql_log_file, sql_log
   results = open(results_file, 'w')
   results.close()
-  sql_log = open(sql_log_file, 'w')
-  sql_log.close()
 
   parser = argparse.ArgumentParser()
   parser.add_argument("-timewindow", required=True, help="Window size in seconds relative to the largest timestamp in the table")
   parser.add_argument("-join_range", required=True, help="Join range used in the band join query")
   parser.add_argument("-num_runs", required=True, help="Number of runs for each query to get the average time")
-  parser.add_argument("-user", required=True, help="User of the database")
-  parser.add_argument("-password", required=True, help="User's access password")
-  parser.add_argument("-host", required=True, help="Host database is located on")
-  parser.add_argument("-database", required=True, help="Name of the database")
+  parser.add_argument("-user", help="User of the database")
+  parser.add_argument("-password", help="User's access password")
+  parser.add_argument("-host", help="Host database is located on")
+  parser.add_argument("-database", help="Name of the database")
+  parser.add_argument("-audit_level", default="statement", choices=audit_log.AUDIT_LEVELS, help="How much of the SQL sent to the database is logged to sql_log.SQL, full and sampled fill in the parameters")
+  parser.add_argument("-audit_max_bytes", type=int, default=audit_log.MAX_BYTES, help="Bytes sql_log.SQL grows to before it is rotated")
+  parser.add_argument("-audit_max_age", type=float, default=audit_log.MAX_AGE, help="Seconds after which sql_log.SQL is rotated, 0 to only rotate on -audit_max_bytes")
+  parser.add_argument("-archive_dir", help="Run the group by and session duration queries over the summary archive written by monitor.py or master_client.py -archive_dir instead of the database. The band join and request/response queries need the raw packets and are skipped")
+  parser.add_argument("-engine", default="sql", choices=("sql", "local", "both"), help="Run the queries in Postgres (sql), with NumPy over the window pulled in one COPY (local, needs numpy), or both, checking that their results match and showing their runtimes side by side")
   args = parser.parse_args()
-
-  conn = psycopg2.connect(user=args.user,
-                          password=args.password,
-                          host=args.host,
-                          database=args.database)
-
-  end_ts = raw_get_end_timestamp(conn)
+  if args.archive_dir == None and None in (args.user, args.password, args.host, args.database):
+    parser.error("-user, -password, -host and -database are required unless -archive_dir is given")
+  if args.archive_dir != None and args.engine != "sql":
+    parser.error("-engine local and both read network_log, not the archive")
+  if args.engine != "sql" and local_engine.numpy == None:
+    parser.error("-engine " + args.engine + " needs numpy, install it with pip3 install numpy")
+
+  sql_log = audit_log.open_audit_log(sql_log_file, args.audit_level, clear=True, max_bytes=args.audit_max_bytes, max_age=args.audit_max_age)
+
+  # the archive is read from its files, the database isn't touched
+  archive = None
+  conn = None
+  if args.archive_dir != None:
+    archive = summary_archive.Archive(args.archive_dir)
+    end_ts = archive.max_timestamp()
+    if end_ts == None:
+      parser.error(f"no archive segments in {args.archive_dir}")
+  else:
+    conn = psycopg2.connect(user=args.user,
+                            password=args.password,
+                            host=args.host,
+                            database=args.database)
+    raw_set_exact_floats(conn)
+    end_ts = raw_get_end_timestamp(conn)
   time_window = float(args.timewindow) # seconds
   join_range = float(args.join_range) # second
 
   print("last timestamp:", end_ts)
 
+  if archive != None:
+    engines = ["archive"]
+  elif args.engine == "both":
+    engines = ["sql", "local"]
+  else:
+    engines = [args.engine]
+  # each query's name, timing function and run function for each engine that can run it
+  queries = [("bandjoin", raw_time_band_join_query, {"sql": raw_run_band_join_query, "local": local_run_band_join_query}),
+             ("groupby", raw_time_group_by_query, {"sql": raw_run_group_by_query, "local": local_run_group_by_query,
+                                                   "archive": archive_run_group_by_query}),
+             ("session duration", raw_time_sess_dur_query, {"sql": raw_run_sess_dur_query, "local": local_run_sess_dur_query,
+                                                            "archive": archive_run_sess_dur_query}),
+             ("request/response", raw_time_req_res_query, {"sql": raw_run_req_res_query, "local": local_run_req_res_query})]
+  queries = [query for query in queries if engines[0] in query[2]]
+
   num_runs = abs(int(args.num_runs))
-  avg_bandjoin_runtime = 0
-  avg_groupby_runtime = 0
-  avg_sess_dur_runtime = 0
-  avg_req_res_runtime = 0
+  avg_runtimes = {} # (query, engine) -> average runtime
+  avg_load_runtime = 0
+  mismatches = []
+  source = raw_table if archive == None else args.archive_dir
   for i in range(1, num_runs+1):
-    # Band Join: Co-occuring Events
-    print("table: " + str(raw_table))
-    results = open(results_file, 'a')
-    results.write("table: " + str(raw_table) + "\n")
-    results.close()
-    runtime = raw_time_band_join_query(conn, end_ts, time_window, join_range)
-    avg_bandjoin_runtime = avg_bandjoin_runtime * ((i-1)/i) + runtime * (1/i)
-
-    # Group By
-    print("\n")
-    results = open(results_file, 'a')
-    results.write("\n\n")
-    results.close()
-    runtime = raw_time_group_by_query(conn, end_ts, time_window)
-    avg_groupby_runtime = avg_groupby_runtime * ((i-1)/i) + runtime * (1/i)
-
-    # Session Duration
-    print("\n")
-    results = open(results_file, 'a')
-    results.write("\n\n")
-    results.close()
-    runtime = raw_time_sess_dur_query(conn, end_ts, time_window)
-    avg_sess_dur_runtime = avg_sess_dur_runtime * ((i-1)/i) + runtime * (1/i)
-
-    # Request Response Protocol
-    print("\n")
+    print("table: " + str(source))
     results = open(results_file, 'a')
-    results.write("\n\n")
+    results.write("table: " + str(source) + "\n")
     results.close()
-    runtime = raw_time_req_res_query(conn, end_ts, time_window)
-    avg_req_res_runtime = avg_req_res_runtime * ((i-1)/i) + runtime * (1/i)
+    targets = {"sql": conn, "archive": archive}
+    if "local" in engines:
+      runtime, targets["local"] = local_time_load_window(conn, end_ts, time_window)
+      avg_load_runtime = avg_load_runtime * ((i-1)/i) + runtime * (1/i)
+
+    # Band Join: Co-occuring Events, Group By, Session Duration, Request Response Protocol
+    for name, time_query, runs in queries:
+      print("\n")
+      results = open(results_file, 'a')
+      results.write("\n\n")
+      results.close()
+      rows = {}
+      for engine in engines:
+        if len(engines) > 1:
+          print("engine: " + engine)
+          results = open(results_file, 'a')
+          results.write("engine: " + engine + "\n")
+          results.close()
+        if name == "bandjoin":
+          runtime, rows[engine] = time_query(targets[engine], end_ts, time_window, join_range, run=runs[engine])
+        else:
+          runtime, rows[engine] = time_query(targets[engine], end_ts, time_window, run=runs[engine])
+        avg_runtimes[(name, engine)] = avg_runtimes.get((name, engine), 0) * ((i-1)/i) + runtime * (1/i)
+      if len(engines) > 1 and not same_results(rows["sql"], rows["local"]):
+        print("results of the " + name + " query differ between the sql and local engines")
+        results = open(results_file, 'a')
+        results.write("results of the " + name + " query differ between the sql and local engines\n")
+        results.close()
+        mismatches.append(name)
 
     print("\n---------------------------------------------------------------------------------------------\n")
     results = open(results_file, 'a')
     results.write("\n---------------------------------------------------------------------------------------------\n\n")
     results.close()
 
+  # with both engines, each query's runtimes are side by side, the local engine's without and with loading the window
   results = open(results_file, 'a')
-  print("average bandjoin query runtime overall: " + str(avg_bandjoin_runtime) + " seconds")
-  results.write("average bandjoin query runtime overall: " + str(avg_bandjoin_runtime) + " seconds\n")
-  print("average groupby query runtime overall: " + str(avg_groupby_runtime) + " seconds")
-  results.write("average groupby query runtime overall: " + str(avg_groupby_runtime) + " seconds\n")
-  print("average session duration query runtime overall: " + str(avg_sess_dur_runtime) + " seconds")
-  results.write("average session duration query runtime overall: " + str(avg_sess_dur_runtime) + " seconds\n")
-  print("average request/response query runtime overall: " + str(avg_req_res_runtime) + " seconds")
-  results.write("average request/response query runtime overall: " + str(avg_req_res_runtime) + " seconds\n")
+  for name, time_query, runs in queries:
+    if len(engines) == 1:
+      line = "average " + name + " query runtime overall: " + str(avg_runtimes[(name, engines[0])]) + " seconds"
+    else:
+      sql_runtime = avg_runtimes[(name, "sql")]
+      local_runtime = avg_runtimes[(name, "local")]
+      line = ("average " + name + " query runtime overall: sql " + str(sql_runtime) + " seconds | local " + str(local_runtime) + " seconds" +
+              " (" + str(local_runtime + avg_load_runtime) + " seconds with the load, " + "{:0.1f}".format(sql_runtime/max(local_runtime, 1e-9)) + "x)")
+    print(line)
+    results.write(line + "\n")
+  if "local" in engines:
+    print("average local load runtime overall: " + str(avg_load_runtime) + " seconds")
+    results.write("average local load runtime overall: " + str(avg_load_runtime) + " seconds\n")
+  if len(engines) > 1:
+    line = "results match between the sql and local engines" if not mismatches else "results differ between the sql and local engines for: " + ", ".join(sorted(set(mismatches)))
+    print(line)
+    results.write(line + "\n")
   results.close()
 
 if __name__ == '__main__':
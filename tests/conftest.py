@@ -0,0 +1,58 @@
+# The monitor's modules import each other as siblings (they are run from their own directory, or copied next to
+# master_client.py), so the tests put those directories on the path the same way
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("gathering_device", "monitoring_device", "query_timer"):
+  path = os.path.join(ROOT, directory)
+  if path not in sys.path:
+    sys.path.insert(0, path)
+
+import itertools
+
+import pytest
+
+table_ids = itertools.count()
+
+# DBManagers on the database named by ENM_TEST_DATABASE (with ENM_TEST_HOST, ENM_TEST_USER and ENM_TEST_PASSWORD),
+# the tests that use them are skipped without one
+@pytest.fixture
+def make_db_manager(tmp_path):
+  pytest.importorskip("psycopg2")
+  if "ENM_TEST_DATABASE" not in os.environ:
+    pytest.skip("ENM_TEST_DATABASE is not set")
+  import db_manager
+  managers = []
+  def make():
+    manager = db_manager.DBManager(user=os.environ.get("ENM_TEST_USER", "postgres"),
+                                   password=os.environ.get("ENM_TEST_PASSWORD", ""),
+                                   host=os.environ.get("ENM_TEST_HOST", "localhost"),
+                                   database=os.environ["ENM_TEST_DATABASE"],
+                                   sql_log_file=str(tmp_path / "sql_log.SQL"),
+                                   audit_level="off")
+    managers.append(manager)
+    return manager
+  make.managers = managers
+  yield make
+  for manager in managers:
+    manager.db_conn.rollback()
+    manager.close()
+
+# a name for the test's summary table, whose tables are dropped afterwards
+@pytest.fixture
+def summ_table(make_db_manager):
+  table = f"test_summary_{os.getpid()}_{next(table_ids)}"
+  yield table
+  # a failed test can leave a transaction open that would block the DROP
+  for manager in make_db_manager.managers:
+    manager.db_conn.rollback()
+  manager = make_db_manager()
+  curs = manager.db_conn.cursor()
+  curs.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %(table)s", {"table": table + "%"})
+  for (name,) in curs.fetchall():
+    curs.execute(f"DROP TABLE IF EXISTS {name} CASCADE")
+  curs.execute("SELECT to_regclass('rollup_state')")
+  if curs.fetchone()[0] is not None:
+    curs.execute("DELETE FROM rollup_state WHERE summ_table LIKE %(table)s", {"table": table + "%"})
+  manager.db_conn.commit()
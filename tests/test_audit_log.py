@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+import audit_log
+
+# stands in for a psycopg2 connection, recording the thread each statement is rendered on
+class Connection():
+  def __init__(self, closed=False):
+    self.closed = closed
+    self.threads = []
+
+  def cursor(self):
+    if self.closed:
+      raise RuntimeError("connection already closed")
+    return self
+
+  def mogrify(self, cmd, cmd_formats):
+    self.threads.append(threading.current_thread().name)
+    return (cmd % {key: repr(value) for key, value in cmd_formats.items()}).encode("utf-8")
+
+class Cursor():
+  def __init__(self, connection):
+    self.connection = connection
+
+def read(path):
+  with open(path) as log_file:
+    return log_file.read()
+
+def test_statement_level_is_the_default(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path)
+  connection = Connection()
+  log.log(Cursor(connection), "SELECT %(id)s", {"id": 1})
+  log.close()
+  assert log.level == "statement"
+  assert read(path) == "SELECT %(id)s\n\n"
+  assert connection.threads == []
+
+def test_full_level_renders_on_the_writer_thread(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path, "full")
+  connection = Connection()
+  cmd_formats = {"id": 1}
+  log.log(Cursor(connection), "SELECT %(id)s", cmd_formats)
+  cmd_formats["id"] = 2 # the statement keeps the parameters it ran with
+  log.log(Cursor(connection), "SELECT 3")
+  log.close()
+  assert read(path) == "SELECT 1\n\nSELECT 3\n\n"
+  assert connection.threads == ["audit-log"]
+
+def test_closed_connection_keeps_the_parameters(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path, "full")
+  log.log(Cursor(Connection(closed=True)), "SELECT %(id)s", {"id": 1})
+  log.close()
+  assert read(path) == "SELECT %(id)s-- parameters: {'id': 1}\n\n"
+
+def test_sampled_level(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path, "sampled", sample_rate=3)
+  connection = Connection()
+  for i in range(9):
+    log.log(Cursor(connection), "SELECT %(i)s", {"i": i})
+  log.close()
+  assert read(path) == "SELECT 2\n\nSELECT 5\n\nSELECT 8\n\n"
+
+def test_rotates_on_age(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path, max_age=0.2, flush_interval=0.05)
+  log.log(None, "SELECT 1")
+  time.sleep(0.3)
+  log.log(None, "SELECT 2")
+  log.close()
+  assert read(path + ".1") == "SELECT 1\n\n"
+  assert read(path) == "SELECT 2\n\n"
+
+def test_rotates_on_size(tmp_path):
+  path = str(tmp_path / "sql_log.SQL")
+  log = audit_log.AuditLog(path, max_bytes=10, max_age=0, backups=2, flush_interval=0.05)
+  for i in range(4):
+    log.log(None, f"SELECT {i}")
+    time.sleep(0.15)
+  log.close()
+  assert read(path) == "SELECT 3\n\n"
+  assert read(path + ".1") == "SELECT 2\n\n"
+  assert read(path + ".2") == "SELECT 1\n\n"
+  assert not os.path.exists(path + ".3")
@@ -0,0 +1,52 @@
+import os
+import socket
+import struct
+
+import pytest
+
+TS = 1600000000
+
+def udp_frame(i):
+  payload = struct.pack("!HHHH", 1000+i % 5, 53, 8, 0)
+  ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20+len(payload), i, 0, 64, 17, 0,
+                   socket.inet_aton(f"10.0.0.{i % 5}"), socket.inet_aton("10.0.1.1"))
+  return bytes.fromhex("020000000002020000000001") + struct.pack("!H", 0x0800) + ip + payload
+
+# count packets, 10 a second
+def write_pcap(path, count):
+  with open(path, "wb") as pcap:
+    pcap.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+    for i in range(count):
+      frame = udp_frame(i)
+      pcap.write(struct.pack("<IIII", TS+i//10, (i % 10)*100000, len(frame), len(frame)))
+      pcap.write(frame)
+
+def test_percentile():
+  benchmark = pytest.importorskip("benchmark")
+  assert benchmark.percentile([], 50) == 0
+  values = [5, 1, 4, 2, 3]
+  assert [benchmark.percentile(values, p) for p in (0, 50, 100)] == [1, 3, 5]
+
+@pytest.mark.parametrize("flush_workers", [0, 2])
+def test_replay_flushes_every_packet(make_db_manager, summ_table, tmp_path, monkeypatch, flush_workers):
+  benchmark = pytest.importorskip("benchmark")
+  monkeypatch.chdir(tmp_path)
+  pcap = str(tmp_path / "bench.pcap")
+  write_pcap(pcap, 100)
+  bench = benchmark.BenchmarkMonitor(None, 20.0, 1.0, f"{summ_table}_log", summ_table,
+                                     os.environ.get("ENM_TEST_USER", "postgres"), os.environ.get("ENM_TEST_PASSWORD", ""),
+                                     os.environ.get("ENM_TEST_HOST", "localhost"), os.environ["ENM_TEST_DATABASE"], 0, 1,
+                                     flush_workers, 50000, "block", 10, "stream", False, "raw", pcap, 0, True, "memory", None, "off")
+  try:
+    bench.run()
+  finally:
+    bench.db_manager.close()
+  assert bench.extractor.packet_count == 100
+  assert bench.flushed_packets == 100
+  assert len(bench.flush_latencies) == len(bench.queue_delays) == len(bench.capture_delays) > 1
+  assert all(latency >= 0 for latency in bench.flush_latencies)
+  db_manager = make_db_manager()
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT sum(summ_size) FROM {summ_table}")
+  assert curs.fetchone()[0] == 100
+  db_manager.db_conn.commit()
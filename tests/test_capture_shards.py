@@ -0,0 +1,84 @@
+import random
+import re
+import socket
+
+import capture_shards
+
+# a 32 bit BPF word, whose sums wrap around like they do in the kernel
+class Word(int):
+  def __add__(self, other):
+    return Word((int(self)+int(other)) & 0xffffffff)
+
+# evaluates the BPF filters shard_filter makes on a packet: (kind, network header), kind being "ip", "ip6" or the
+# name of something else. capture_filter names are looked up in names
+def matches(bpf_filter, packet, names={}):
+  kind, header = packet
+  expr = re.sub(r"\b(ip6?)\[(\d+):4\]", r"word('\1', \2)", bpf_filter)
+  expr = re.sub(r"\bip6\b(?!')", "is_ip6", expr)
+  expr = re.sub(r"\bip\b(?!')", "is_ip", expr)
+  expr = re.sub(r"(?<![=!<>])=(?!=)", "==", expr)
+  def word(layer, offset):
+    assert layer == kind
+    return Word(int.from_bytes(header[offset:offset+4], "big"))
+  return eval(expr, {"word": word, "is_ip": kind == "ip", "is_ip6": kind == "ip6", **names})
+
+def ipv4(src, dst):
+  return ("ip", bytes(12) + socket.inet_pton(socket.AF_INET, src) + socket.inet_pton(socket.AF_INET, dst))
+
+def ipv6(src, dst):
+  return ("ip6", bytes(8) + socket.inet_pton(socket.AF_INET6, src) + socket.inet_pton(socket.AF_INET6, dst))
+
+def random_packets(rng, count):
+  packets = []
+  for i in range(count):
+    kind = rng.choice(["ip", "ip6", "arp"])
+    if kind == "ip":
+      addrs = [socket.inet_ntop(socket.AF_INET, rng.randbytes(4)) for j in range(2)]
+      packets.append(ipv4(*addrs))
+      packets.append(ipv4(*reversed(addrs)))
+    elif kind == "ip6":
+      addrs = [socket.inet_ntop(socket.AF_INET6, rng.randbytes(16)) for j in range(2)]
+      packets.append(ipv6(*addrs))
+      packets.append(ipv6(*reversed(addrs)))
+    else:
+      packets.append(("arp", b""))
+  # addresses whose sum overflows 32 bits
+  packets.append(ipv4("255.255.255.255", "255.255.255.254"))
+  packets.append(ipv6("::ffff:ffff", "::ffff:fffe"))
+  return packets
+
+def test_single_shard_keeps_the_capture_filter():
+  assert capture_shards.shard_filter(0, 1) is None
+  assert capture_shards.shard_filter(0, 1, "tcp") == "tcp"
+
+def test_shards_split_every_packet_to_exactly_one_shard():
+  rng = random.Random(21)
+  packets = random_packets(rng, 300)
+  for shard_count in (2, 3, 4, 7):
+    filters = [capture_shards.shard_filter(shard, shard_count) for shard in range(shard_count)]
+    counts = [0]*shard_count
+    for packet in packets:
+      shards = [shard for shard in range(shard_count) if matches(filters[shard], packet)]
+      assert len(shards) == 1, (shard_count, packet)
+      counts[shards[0]] += 1
+      if packet[0] not in ("ip", "ip6"):
+        assert shards == [0]
+    # every shard gets a share of the traffic
+    assert all(count > 0 for count in counts)
+
+def test_both_directions_go_to_the_same_shard():
+  rng = random.Random(22)
+  for shard_count in (2, 5):
+    filters = [capture_shards.shard_filter(shard, shard_count) for shard in range(shard_count)]
+    for i in range(100):
+      for make, family, size in ((ipv4, socket.AF_INET, 4), (ipv6, socket.AF_INET6, 16)):
+        a, b = [socket.inet_ntop(family, rng.randbytes(size)) for j in range(2)]
+        forward = [matches(bpf_filter, make(a, b)) for bpf_filter in filters]
+        assert forward == [matches(bpf_filter, make(b, a)) for bpf_filter in filters]
+
+def test_capture_filter_applies_to_every_shard():
+  packets = random_packets(random.Random(23), 50)
+  filters = [capture_shards.shard_filter(shard, 3, "tcp") for shard in range(3)]
+  for packet in packets:
+    assert sum(matches(bpf_filter, packet, {"tcp": True}) for bpf_filter in filters) == 1
+    assert not any(matches(bpf_filter, packet, {"tcp": False}) for bpf_filter in filters)
@@ -0,0 +1,137 @@
+import csv
+import io
+import struct
+import threading
+
+import pytest
+
+import copy_stream
+
+LOGS = [(1600000000.25, "10.0.0.1", 51000, "10.0.0.2", 80, "TCP", 60),
+        (1600000000.5, "02:00:00:00:00:01", None, "02:00:00:00:00:02", None, None, 42),
+        (1600000001.0, "fe80::1", "", "fe80::2", 443, "", 1500),
+        (1600000001.5, "10.0.0.3", -1, "10.0.0.4", 65535, "UDP", 0)]
+
+# rows back from PostgreSQL's binary COPY format, NULLs as None
+def decode_binary(data, types):
+  assert data.startswith(copy_stream.BINARY_HEADER)
+  offset = len(copy_stream.BINARY_HEADER)
+  rows = []
+  while True:
+    field_count = struct.unpack_from("!h", data, offset)[0]
+    offset += 2
+    if field_count == -1:
+      break
+    assert field_count == len(types)
+    row = []
+    for kind in types:
+      length = struct.unpack_from("!i", data, offset)[0]
+      offset += 4
+      if length == -1:
+        row.append(None)
+        continue
+      value = data[offset:offset+length]
+      offset += length
+      if kind == "float8":
+        assert length == 8
+        row.append(struct.unpack("!d", value)[0])
+      elif kind == "int4":
+        assert length == 4
+        row.append(struct.unpack("!i", value)[0])
+      else:
+        row.append(value.decode("utf-8"))
+    rows.append(tuple(row))
+  assert offset == len(data)
+  return rows
+
+# what COPY ... NULL '' makes of the logs: empty strings are NULL too
+def expected_rows(logs):
+  return [tuple(None if value == None or value == "" else value for value in log) for log in logs]
+
+def read_all(reader, size):
+  parts = []
+  while True:
+    data = reader.read(size)
+    if not data:
+      return b"".join(parts)
+    parts.append(data)
+
+@pytest.mark.parametrize("rows_per_chunk", [1, 2, 1000])
+def test_binary_chunks_decode_back_to_the_rows(rows_per_chunk):
+  data = b"".join(copy_stream.binary_chunks(LOGS, copy_stream.LOG_BATCH_TYPES, rows_per_chunk))
+  assert decode_binary(data, copy_stream.LOG_BATCH_TYPES) == expected_rows(LOGS)
+
+def test_binary_text_is_utf8_with_its_byte_length():
+  data = b"".join(copy_stream.binary_chunks([("héllo",)], ("text",)))
+  assert decode_binary(data, ("text",)) == [("héllo",)]
+
+def test_empty_batch_is_header_and_trailer():
+  assert b"".join(copy_stream.binary_chunks([], copy_stream.LOG_BATCH_TYPES)) == copy_stream.BINARY_HEADER + copy_stream.BINARY_TRAILER
+
+# reads of every size, so values are split across reads and across chunks
+@pytest.mark.parametrize("size", [-1, 1, 3, 7, 64, 100000])
+def test_chunk_reader_read_gives_back_the_bytes(size):
+  data = b"".join(copy_stream.binary_chunks(LOGS, copy_stream.LOG_BATCH_TYPES, 1))
+  reader = copy_stream.binary_reader(LOGS)
+  assert read_all(reader, size) == data
+
+@pytest.mark.parametrize("size", [-1, 1, 5, 1000])
+def test_chunk_reader_readline_gives_back_the_lines(size):
+  chunks = [b"ab", b"c\nde", b"f\n\n", b"", b"gh\nij"]
+  reader = copy_stream.ChunkReader(chunks)
+  lines = []
+  while True:
+    line = reader.readline(size)
+    if not line:
+      break
+    assert b"\n" not in line[:-1]
+    if size > 0:
+      assert len(line) <= size
+    lines.append(line)
+  assert b"".join(lines) == b"".join(chunks)
+
+def test_csv_reader_matches_the_csv_files():
+  text = read_all(copy_stream.csv_reader(LOGS), 5).decode("utf-8")
+  rows = list(csv.reader(io.StringIO(text)))
+  assert rows == [["" if value == None else str(value) for value in log] for log in LOGS]
+
+def test_chunk_pipe_passes_the_bytes_through():
+  pipe = copy_stream.ChunkPipe(max_chunks=2, chunk_size=10)
+  data = bytes(range(256))*20
+  def write():
+    for i in range(0, len(data), 7):
+      pipe.write(data[i:i+7])
+    pipe.close()
+  writer = threading.Thread(target=write)
+  writer.start()
+  assert read_all(pipe, 13) == data
+  writer.join(5)
+  assert pipe.byte_count == len(data) and pipe.error is None
+
+def test_chunk_pipe_reports_a_failed_copy_to():
+  pipe = copy_stream.ChunkPipe()
+  pipe.write("partial")
+  error = IOError("COPY TO failed")
+  pipe.close(error)
+  # what was written before the failure is left out, the reader only sees the end
+  assert pipe.read() == b""
+  assert pipe.error is error
+
+def test_aborted_pipe_stops_the_writer():
+  pipe = copy_stream.ChunkPipe(max_chunks=1, chunk_size=1)
+  pipe.write(b"a")
+  pipe.abort()
+  with pytest.raises(IOError):
+    pipe.write(b"b")
+
+# both in-memory COPY formats load the same rows into network_log_batch
+@pytest.mark.parametrize("copy_mode", ["binary", "memory"])
+def test_copy_into_the_log_table(make_db_manager, summ_table, copy_mode):
+  db_manager = make_db_manager()
+  db_manager.copy_mode = copy_mode
+  db_manager.create_log_table(summ_table)
+  db_manager.insert_log_batch(summ_table, LOGS)
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT * FROM {summ_table} ORDER BY timestamp")
+  assert curs.fetchall() == expected_rows(LOGS)
+  db_manager.db_conn.commit()
@@ -0,0 +1,94 @@
+import decimal
+import io
+import json
+import time
+
+import pytest
+
+import dashboard
+
+# records what is printed where, like asciimatics' Screen
+class FakeScreen():
+  def __init__(self, width=20, height=3):
+    self.width = width
+    self.height = height
+    self.prints = []
+    self.refreshes = 0
+
+  def print_at(self, text, x, y):
+    self.prints.append((text, x, y))
+
+  def refresh(self):
+    self.refreshes += 1
+
+def test_headless_writes_one_json_object_per_tick():
+  out = io.StringIO()
+  ticks = []
+  def stats(max_rows):
+    ticks.append(max_rows)
+    return {"tick": len(ticks), "flows": dashboard.flow_dicts([("10.0.0.1", 80, "10.0.0.2", None, 0.5, 12.0, 0)])}
+  renderer = dashboard.Renderer(stats, None, interval=0.01, out=out, max_fps=100, max_rows=5)
+  renderer.start()
+  time.sleep(0.2)
+  renderer.stop()
+  lines = out.getvalue().splitlines()
+  assert len(lines) == len(ticks) > 2
+  assert [json.loads(line)["tick"] for line in lines] == list(range(1, len(ticks)+1))
+  assert json.loads(lines[0])["flows"] == [{"src": "10.0.0.1", "srcport": 80, "dst": "10.0.0.2", "dstport": None,
+                                            "last_seen": 0.5, "pps": 12.0, "pps_margin": 0}]
+  assert set(ticks) == {5}
+
+# pps read from the db are Decimals
+def test_headless_writes_values_json_cant_encode_as_strings():
+  out = io.StringIO()
+  renderer = dashboard.Renderer(lambda max_rows: {"pps": decimal.Decimal("12.5")}, None, out=out)
+  renderer.render()
+  assert json.loads(out.getvalue()) == {"pps": "12.5"}
+
+def test_only_changed_lines_are_redrawn():
+  screen = FakeScreen()
+  renderer = dashboard.Renderer(None, None, screen=screen)
+  renderer.draw(["header", "flow a", "flow b"])
+  assert screen.prints == [("header", 0, 0), ("flow a", 0, 1), ("flow b", 0, 2)]
+  screen.prints = []
+  renderer.draw(["header", "flow a 2", "flow b", "cut off"])
+  assert screen.prints == [("flow a 2", 0, 1)]
+  screen.prints = []
+  # a shorter line is padded over the old one, and lines that are gone are blanked
+  renderer.draw(["header", "a"])
+  assert screen.prints == [("a       ", 0, 1), ("      ", 0, 2)]
+  screen.prints = []
+  renderer.draw(["header " + "x"*30, "a"])
+  assert screen.prints == [(("header " + "x"*30)[:20], 0, 0)]
+  assert screen.refreshes == 4
+
+def test_screen_gets_rows_for_its_height():
+  screen = FakeScreen(width=60, height=6)
+  heights = []
+  def stats(max_rows):
+    heights.append(max_rows)
+    return [["10.0.0.1", "10.0.0.2", 1.0, 2.0]]
+  renderer = dashboard.Renderer(stats, lambda rows, width: dashboard.table_lines(["Src", 10, "Dst", 10, "Seen", 6, "PPS", 6], rows),
+                                screen=screen)
+  renderer.render()
+  assert heights == [6]
+  assert [text for text, x, y in screen.prints][2] == "10.0.0.1   | 10.0.0.2   | 1.00   | 2.00  "
+
+def test_renderer_error_is_raised_on_stop():
+  def stats(max_rows):
+    raise ValueError("stats failed")
+  renderer = dashboard.Renderer(stats, None, interval=0.01, out=io.StringIO(), max_fps=100)
+  renderer.start()
+  time.sleep(0.1)
+  with pytest.raises(ValueError):
+    renderer.stop()
+
+def test_margin_column_only_when_sampled():
+  cols = ["Src", 18, "Dst", 18, "Seen", 6, "PPS", 6]
+  exact = dashboard.flow_dicts([("a", 1, "b", 2, 0.5, 10.0, 0)])
+  sampled = dashboard.flow_dicts([("a", 1, "b", 2, 0.5, 10.0, 3.5)])
+  assert "+/-" not in dashboard.flow_table_lines(cols, exact)[0]
+  lines = dashboard.flow_table_lines(cols, sampled)
+  assert lines[0].endswith("+/-     ")
+  assert lines[2].split(" | ")[0].strip() == "a:1"
+  assert lines[2].endswith("3.50    ")
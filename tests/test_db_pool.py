@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+
+import db_pool
+
+class FakeConnection():
+  def __init__(self):
+    self.closed = 0
+    self.rollbacks = 0
+
+  def rollback(self):
+    if self.closed:
+      raise RuntimeError("connection already closed")
+    self.rollbacks += 1
+
+# stands in for a DBManager: alive until the test kills it, reconnect opens a new connection
+class FakeDBManager():
+  def __init__(self, name):
+    self.name = name
+    self.db_conn = FakeConnection()
+    self.alive = True
+    self.alive_checks = 0
+
+  def is_alive(self):
+    self.alive_checks += 1
+    return self.alive and not self.db_conn.closed
+
+  def reconnect(self):
+    self.close()
+    self.db_conn = FakeConnection()
+    self.alive = True
+
+  def close(self):
+    self.db_conn.closed = 1
+
+def make_pool(**kwargs):
+  made = []
+  def make():
+    dbmanager = FakeDBManager(len(made))
+    made.append(dbmanager)
+    return dbmanager
+  pool = db_pool.DBManagerPool(make, **kwargs)
+  return pool, made
+
+def test_released_connections_are_reused():
+  pool, made = make_pool(max_size=2)
+  with pool.connection() as first:
+    pass
+  with pool.connection() as second:
+    assert second is first
+    with pool.connection() as third:
+      assert third is not first
+  assert len(made) == 2
+  assert pool.size == 2
+  assert len(pool.idle) == 2
+
+def test_dead_connection_is_reconnected_after_check_interval():
+  pool, made = make_pool(check_interval=0)
+  with pool.connection() as dbmanager:
+    pass
+  old_conn = dbmanager.db_conn
+  dbmanager.alive = False
+  with pool.connection() as again:
+    assert again is dbmanager
+    assert again.db_conn is not old_conn
+    assert old_conn.closed
+  assert pool.reconnects == 1
+  assert len(made) == 1
+
+def test_idle_connection_isnt_checked_before_check_interval():
+  pool, made = make_pool(check_interval=60)
+  with pool.connection() as dbmanager:
+    pass
+  with pool.connection():
+    pass
+  assert dbmanager.alive_checks == 0
+  # a connection known to be closed is reopened whenever it is handed out
+  dbmanager.db_conn.closed = 1
+  with pool.connection() as again:
+    assert not again.db_conn.closed
+  assert pool.reconnects == 1
+
+def test_failed_transaction_is_rolled_back_and_kept():
+  pool, made = make_pool()
+  with pytest.raises(ValueError):
+    with pool.connection() as dbmanager:
+      raise ValueError("bad query")
+  assert dbmanager.db_conn.rollbacks == 1
+  assert pool.idle[0][0] is dbmanager
+  assert pool.discarded == 0
+
+def test_connection_broken_in_use_is_discarded():
+  pool, made = make_pool(max_size=1)
+  with pytest.raises(ValueError):
+    with pool.connection() as dbmanager:
+      dbmanager.db_conn.closed = 2
+      raise ValueError("server closed the connection")
+  assert (pool.size, pool.idle, pool.discarded) == (0, [], 1)
+  # its slot is free for a new one
+  with pool.connection() as new:
+    assert new is not dbmanager
+  assert len(made) == 2
+
+def test_failed_connect_frees_its_slot():
+  attempts = []
+  def make():
+    attempts.append(1)
+    if len(attempts) == 1:
+      raise ConnectionError("could not connect")
+    return FakeDBManager(len(attempts))
+  pool = db_pool.DBManagerPool(make, max_size=1, acquire_timeout=0.1)
+  with pytest.raises(ConnectionError):
+    pool.acquire()
+  assert pool.size == 0
+  assert pool.acquire().name == 2
+
+def test_exhausted_pool_times_out():
+  pool, made = make_pool(max_size=2, acquire_timeout=0.2)
+  held = [pool.acquire(), pool.acquire()]
+  start = time.time()
+  with pytest.raises(db_pool.PoolTimeout):
+    pool.acquire()
+  assert time.time()-start >= 0.2
+  pool.release(held[0])
+  assert pool.acquire() is held[0]
+
+def test_exhausted_pool_waits_for_a_release():
+  pool, made = make_pool(max_size=1, acquire_timeout=5)
+  held = pool.acquire()
+  threading.Timer(0.1, pool.release, (held,)).start()
+  assert pool.acquire() is held
+
+# sessions on more threads than connections: no connection is used by two of them at once, and no more than
+# max_size are ever opened
+def test_concurrent_sessions_share_max_size_connections():
+  pool, made = make_pool(max_size=3, acquire_timeout=10)
+  in_use = set()
+  lock = threading.Lock()
+  errors = []
+  most_in_use = [0]
+  def session():
+    try:
+      for i in range(50):
+        with pool.connection() as dbmanager:
+          with lock:
+            assert dbmanager not in in_use
+            in_use.add(dbmanager)
+            most_in_use[0] = max(most_in_use[0], len(in_use))
+          time.sleep(0.0005)
+          with lock:
+            in_use.remove(dbmanager)
+    except Exception as e:
+      errors.append(e)
+  threads = [threading.Thread(target=session) for i in range(10)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert errors == []
+  assert len(made) <= 3
+  assert most_in_use[0] <= 3
+  assert pool.size == len(pool.idle) == len(made)
+  pool.close()
+  assert pool.size == 0
+  assert all(dbmanager.db_conn.closed for dbmanager in made)
+
+def test_reconnects_a_terminated_backend(make_db_manager):
+  pool = db_pool.DBManagerPool(make_db_manager, max_size=1, check_interval=0)
+  with pool.connection() as dbmanager:
+    pid = dbmanager.db_conn.get_backend_pid()
+  killer = make_db_manager()
+  curs = killer.db_conn.cursor()
+  curs.execute("SELECT pg_terminate_backend(%(pid)s)", {"pid": pid})
+  killer.db_conn.commit()
+  with pool.connection() as again:
+    assert again is dbmanager
+    assert again.db_conn.get_backend_pid() != pid
+    assert again.is_alive()
+  assert pool.reconnects == 1
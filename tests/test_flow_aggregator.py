@@ -0,0 +1,84 @@
+import random
+import sqlite3
+
+import pytest
+
+import flow_aggregator
+
+# the GROUP BY of DBManager.summarize_table, run by sqlite over the same logs
+SUMMARIZE = """
+SELECT min(timestamp), max(timestamp), src, srcport, dst, dstport, protocol, min(length), max(length), avg(length), count(*)
+FROM network_log_batch
+GROUP BY src, srcport, dst, dstport, protocol
+"""
+
+def sql_rows(logs):
+  db_conn = sqlite3.connect(":memory:")
+  db_conn.execute("CREATE TABLE network_log_batch(timestamp double precision, src text, srcport integer, dst text, dstport integer, protocol text, length integer)")
+  # COPY turns the empty fields of the capture into NULLs
+  db_conn.executemany("INSERT INTO network_log_batch VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(float(log[0]), log[1], flow_aggregator.to_int(log[2]), log[3], flow_aggregator.to_int(log[4]), log[5], flow_aggregator.to_int(log[6]))
+                       for log in logs])
+  rows = db_conn.execute(SUMMARIZE).fetchall()
+  db_conn.close()
+  return rows
+
+def sort_key(row):
+  return tuple((value is None, "" if value is None else str(value)) for value in row[2:7])
+
+def assert_same_rows(aggregator, logs):
+  expected = sorted(sql_rows(logs), key=sort_key)
+  rows = sorted(aggregator.rows(), key=sort_key)
+  assert len(rows) == len(expected)
+  for row, expected_row in zip(rows, expected):
+    assert row[:9] == expected_row[:9]
+    if expected_row[9] is None:
+      assert row[9] is None
+    else:
+      assert float(row[9]) == pytest.approx(expected_row[9])
+    assert row[10] == expected_row[10]
+    assert row[11] == aggregator.sample_rate
+
+def random_logs(count, seed=7):
+  rand = random.Random(seed)
+  hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "fe80::1", None]
+  logs = []
+  ts = 1600000000.0
+  for i in range(count):
+    ts += rand.random()*0.01
+    # some packets arrive out of order, have no ports (ICMP, ARP) or no length
+    log_ts = ts - rand.random()*0.05 if rand.random() < 0.1 else ts
+    port = rand.choice(["80", "443", "53", ""])
+    length = "" if rand.random() < 0.05 else str(rand.randint(40, 1500))
+    logs.append((repr(log_ts), rand.choice(hosts), port, rand.choice(hosts), rand.choice(["80", "51000", ""]), rand.choice(["TCP", "UDP", None]), length))
+  return logs
+
+def test_matches_group_by():
+  logs = random_logs(5000)
+  aggregator = flow_aggregator.FlowAggregator()
+  for log in logs:
+    aggregator.add(log)
+  assert_same_rows(aggregator, logs)
+
+def test_null_keys_group_together_and_lengths_ignored():
+  logs = [("1.0", None, "", "10.0.0.2", "", "ARP", ""),
+          ("2.5", None, "", "10.0.0.2", "", "ARP", ""),
+          ("1.5", "10.0.0.1", "80", "10.0.0.2", "51000", "TCP", "60"),
+          ("0.5", "10.0.0.1", "80", "10.0.0.2", "51000", "TCP", ""),
+          ("3.0", "10.0.0.1", "80", "10.0.0.2", "51000", "TCP", "1500")]
+  aggregator = flow_aggregator.FlowAggregator(sample_rate=4)
+  for log in logs:
+    aggregator.add(log)
+  assert len(aggregator) == 2
+  assert_same_rows(aggregator, logs)
+  rows = {row[2]: row for row in aggregator.rows()}
+  assert rows[None][7:11] == (None, None, None, 2)
+  assert rows["10.0.0.1"][:2] == (0.5, 3.0)
+  assert rows["10.0.0.1"][7:] == (60, 1500, 780, 3, 4)
+
+def test_clear():
+  aggregator = flow_aggregator.FlowAggregator()
+  aggregator.add(("1.0", "a", "1", "b", "2", "TCP", "10"))
+  aggregator.clear()
+  assert len(aggregator) == 0
+  assert aggregator.rows() == []
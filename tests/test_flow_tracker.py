@@ -0,0 +1,93 @@
+import random
+
+import flow_tracker
+import packet_extractor
+import rollup
+
+# top of the flows counted straight from the packets still in the window
+def expected_top(packets, k, window_size, head):
+  totals = {}
+  last_seen = {}
+  for ts, flow in packets:
+    if int(ts) > head-window_size:
+      totals[flow] = totals.get(flow, 0)+1
+      last_seen[flow] = max(last_seen.get(flow, 0), ts)
+  flows = sorted(totals, key=lambda flow: (-totals[flow], -last_seen[flow]))
+  return [(flow, totals[flow]) for flow in flows[:k]]
+
+def test_top_matches_a_full_sort_as_flows_come_and_expire():
+  rng = random.Random(7)
+  window_size = 5
+  tracker = flow_tracker.FlowTracker(window_size)
+  packets = []
+  ts = 1000.0
+  for i in range(3000):
+    ts += rng.random()*0.05
+    # a few heavy flows among many light ones, and packets arriving a little out of order
+    src = f"10.0.0.{rng.randrange(4) if rng.random() < 0.5 else rng.randrange(4, 200)}"
+    packet_ts = ts-rng.random()*0.5
+    flow = (src, "1234", "10.0.1.1", "80")
+    tracker.add((packet_ts,)+flow)
+    if int(packet_ts) > tracker.head-window_size:
+      packets.append((packet_ts, flow))
+    if i % 50 == 0:
+      for k in (1, 5, 20):
+        rows = tracker.top(k, ts)
+        expected = expected_top(packets, k, window_size, tracker.head)
+        assert [(row[:4], row[5]*window_size) for row in rows] == [(flow, count) for flow, count in expected]
+  # the heap is rebuilt instead of growing with every refresh
+  assert len(tracker.heap) <= 2*len(tracker)+20
+
+def test_max_flows_evicts_the_smallest_flow():
+  tracker = flow_tracker.FlowTracker(10, max_flows=2)
+  for ts, src in ((1.0, "a"), (1.1, "a"), (1.2, "b"), (2.0, "b"), (2.1, "b"), (2.2, "c")):
+    tracker.add((ts, src, "1", "d", "2"))
+  # c took a's place: a had 2 packets, b 3
+  assert len(tracker) == 2
+  assert [(row[0], row[5]*10) for row in tracker.top(5, 3.0)] == [("b", 3), ("c", 1)]
+  # second 1 expires: a's packets left the ring with it, b loses one
+  tracker.add((11.5, "c", "1", "d", "2"))
+  assert [(row[0], row[5]*10) for row in tracker.top(5, 12.0)] == [("c", 2), ("b", 2)]
+
+def test_max_flows_keeps_the_heavy_flows_in_fixed_memory():
+  rng = random.Random(3)
+  window_size = 5
+  tracker = flow_tracker.FlowTracker(window_size, max_flows=50)
+  heavy = [(f"10.0.0.{i}", "1234", "10.0.1.1", "80") for i in range(5)]
+  packets = []
+  ts = 1000.0
+  for i in range(20000):
+    ts += 0.001
+    # a scan of one packet flows mixed with a few heavy ones, far more flows than max_flows
+    flow = rng.choice(heavy) if rng.random() < 0.3 else (f"10.1.{i//250}.{i%250}", "1234", "10.0.1.1", "80")
+    tracker.add((ts,)+flow)
+    packets.append((ts, flow))
+    assert len(tracker) <= 50
+    if i % 1000 == 999:
+      expected = expected_top(packets, 5, window_size, tracker.head)
+      assert [(row[:4], row[5]*window_size) for row in tracker.top(5, ts)] == expected
+  assert len(tracker.min_heap) <= 2*50+tracker.bucket_count
+
+def test_sampled_counts_are_scaled_back_up():
+  tracker = flow_tracker.FlowTracker(5, sample_rate=10)
+  for i in range(6):
+    tracker.add((100.0+i*0.5, "a", "1", "b", "2"))
+  row = tracker.top(1, 103.0)[0]
+  # 6 kept packets stand for 60 in 5 seconds
+  assert row[5] == 60/5
+  assert row[6] == rollup.pps_margin(6*10*9, 5)
+
+def test_sampled_pps_estimate_is_within_its_margin():
+  rng = random.Random(5)
+  window_size = 5
+  sampler = packet_extractor.Sampler(10, "random", seed=5)
+  tracker = flow_tracker.FlowTracker(window_size, sample_rate=10)
+  rates = {"a": 2000, "b": 500, "c": 100}
+  for src, pps in rates.items():
+    for i in range(pps*window_size):
+      if sampler.keep():
+        tracker.add((1000+rng.random()*window_size, src, "1", "d", "2"))
+  rows = tracker.top(3, 1000+window_size)
+  assert [row[0] for row in rows] == ["a", "b", "c"]
+  for row in rows:
+    assert abs(row[5]-rates[row[0]]) < 3*row[6]
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+import flush_queue
+
+def test_unknown_policy():
+  with pytest.raises(ValueError):
+    flush_queue.PacketQueue(4, policy="drop_newest")
+
+def test_get_many_in_order():
+  packet_queue = flush_queue.PacketQueue(10)
+  for i in range(5):
+    assert packet_queue.put(i)
+  assert packet_queue.get_many(3) == [0, 1, 2]
+  assert packet_queue.get_many() == [3, 4]
+  assert packet_queue.max_depth == 5
+
+def test_block_waits_for_room():
+  packet_queue = flush_queue.PacketQueue(2, policy="block")
+  packet_queue.put(0)
+  packet_queue.put(1)
+  done = threading.Event()
+  def produce():
+    packet_queue.put(2)
+    done.set()
+  producer = threading.Thread(target=produce, daemon=True)
+  producer.start()
+  assert not done.wait(0.1)
+  assert packet_queue.get_many(1) == [0]
+  assert done.wait(5)
+  producer.join(5)
+  assert packet_queue.get_many() == [1, 2]
+  assert packet_queue.full_count == 1
+  assert packet_queue.dropped() == 0
+
+def test_block_released_by_close():
+  packet_queue = flush_queue.PacketQueue(1, policy="block")
+  packet_queue.put(0)
+  results = []
+  producer = threading.Thread(target=lambda: results.append(packet_queue.put(1)), daemon=True)
+  producer.start()
+  time.sleep(0.05)
+  packet_queue.close()
+  producer.join(5)
+  assert results == [False]
+  assert packet_queue.get_many() == [0]
+  assert packet_queue.get_many() == []
+
+def test_drop_oldest_evicts_head():
+  packet_queue = flush_queue.PacketQueue(3, policy="drop_oldest")
+  for i in range(7):
+    assert packet_queue.put(i)
+  assert packet_queue.get_many() == [4, 5, 6]
+  assert packet_queue.full_count == 4
+  assert packet_queue.drop_count == 4
+  assert packet_queue.dropped() == 4
+
+def test_sample_keeps_every_nth():
+  packet_queue = flush_queue.PacketQueue(2, policy="sample", sample_rate=3)
+  kept = [packet_queue.put(i) for i in range(11)]
+  # the first two fill the queue, then only every third arrival while it is full gets in, evicting the oldest
+  assert kept == [True, True, False, False, True, False, False, True, False, False, True]
+  assert packet_queue.get_many() == [7, 10]
+  assert packet_queue.full_count == 9
+  assert packet_queue.sample_drop_count == 6
+  assert packet_queue.drop_count == 3
+  assert packet_queue.dropped() == 9
+
+def test_put_after_close():
+  packet_queue = flush_queue.PacketQueue(2)
+  packet_queue.close()
+  assert not packet_queue.put(0)
+  assert packet_queue.get_many() == []
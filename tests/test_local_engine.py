@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import local_engine
+
+# the four queries of query_process.py, row by row the way Postgres evaluates them. NULL never equals anything
+
+def sql_group_by(rows):
+  counts = {}
+  for ts, src, dst in rows:
+    counts[(src, dst)] = counts.get((src, dst), 0)+1
+  return [(src, dst, count) for (src, dst), count in counts.items()]
+
+def sql_sess_dur(rows):
+  spans = {}
+  for ts, src, dst in rows:
+    low, high = spans.get((src, dst), (ts, ts))
+    spans[(src, dst)] = (min(low, ts), max(high, ts))
+  return [(src, dst, high-low) for (src, dst), (low, high) in spans.items()]
+
+def sql_band_join(rows, join_range):
+  joined = 0
+  for ts1, src1, dst1 in rows:
+    for ts2, src2, dst2 in rows:
+      if ts1-join_range <= ts2 and ts2 <= ts1+join_range and src1 is not None and src2 is not None and src1 != src2:
+        joined += 1
+  return joined if joined > 0 else None
+
+def sql_req_res(rows):
+  return [(src, dst) for ts, src, dst in rows
+          if not any(src is not None and dst is not None and src == dst2 and dst == src2 for ts2, src2, dst2 in rows)]
+
+def window(rows):
+  def field(value):
+    return "\\N" if value is None else value
+  return local_engine.Window.from_csv("".join(f"{ts!r},{field(src)},{field(dst)}\n" for ts, src, dst in rows))
+
+def sort_key(row):
+  return tuple((value is None, "" if value is None else str(value)) for value in row)
+
+def assert_same(rows, join_ranges=(0, 0.5, 1)):
+  local = window(rows)
+  assert sorted(local_engine.group_by(local), key=sort_key) == sorted(sql_group_by(rows), key=sort_key)
+  assert sorted(local_engine.sess_dur(local), key=sort_key) == sorted(sql_sess_dur(rows), key=sort_key)
+  assert sorted(local_engine.req_res(local), key=sort_key) == sorted(sql_req_res(rows), key=sort_key)
+  for join_range in join_ranges:
+    assert local_engine.band_join(local, join_range) == sql_band_join(rows, join_range)
+
+def test_empty_window():
+  assert len(window([])) == 0
+  assert_same([])
+
+def test_nulls_and_duplicates():
+  rows = [(1.0, "a", "b"), (1.0, "a", "b"), (1.5, "b", "a"), (2.0, None, "a"), (2.0, "a", None), (2.5, None, None),
+          (3.0, None, None), (3.5, "c", "c"), (4.0, "b", None)]
+  assert_same(rows)
+
+# rows exactly join_range apart join, and a pair is joined both ways
+def test_rows_exactly_join_range_apart():
+  rows = [(10.0, "a", "x"), (11.0, "b", "x"), (12.0, "a", "x"), (12.0, "c", "y")]
+  assert_same(rows, join_ranges=(1, 2, 0.999))
+  assert local_engine.band_join(window(rows), 1) == sql_band_join(rows, 1) == 8
+
+def test_random_windows():
+  rng = random.Random(5)
+  hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "fe80::1", None]
+  for i in range(30):
+    rows = [(round(rng.uniform(0, 5), 1), rng.choice(hosts), rng.choice(hosts)) for j in range(rng.randrange(1, 40))]
+    assert_same(rows, join_ranges=(0, 0.1, 0.5, 2))
@@ -0,0 +1,84 @@
+import threading
+
+import retention
+import rollup
+import summary_merge
+
+TS = 1600000000.0
+
+def shipped_row(i, sensor="pi1", summ_size=10):
+  return (TS+i, TS+i+0.5, f"10.0.0.{i}", 1000+i, "10.0.0.254", 80, "TCP", 60, 60, 60, summ_size, 1, sensor, i)
+
+def make_master_tables(db_manager, summ_table):
+  db_manager.create_summary_table(summ_table, master=True)
+  db_manager.create_rollup_tables(summ_table)
+  retention.RetentionManager(summ_table, "min_timestamp", 3600).prepare(db_manager, TS, TS+60)
+
+# the master's own insert of rows that came over a socket, left open before it commits
+def begin_shipped_insert(db_manager, summ_table, rows):
+  staging_table = db_manager.create_summary_staging_table(summ_table)
+  curs = db_manager.db_conn.cursor()
+  curs.executemany(f"INSERT INTO {staging_table} VALUES ({', '.join(['%s']*14)})", rows)
+  db_manager.lock_summary_ids(summ_table)
+  curs.execute(f"INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate, sensor, sensor_id) SELECT * FROM {staging_table}")
+
+def start(target):
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  return thread
+
+def sum_packets(db_manager, table):
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT coalesce(sum(packets), 0) FROM {table}")
+  packets = curs.fetchone()[0]
+  db_manager.db_conn.commit()
+  return packets
+
+# a worker_server copying with -transport db commits after the master's insert drew its ids. every row is rolled up once,
+# whichever order they commit in, and a poll loop that reads the range meanwhile rolls up nothing
+def test_rollup_watermark_with_two_writers(make_db_manager, summ_table):
+  master, worker, reader = make_db_manager(), make_db_manager(), make_db_manager()
+  make_master_tables(reader, summ_table)
+  rollups = rollup.Rollups(summ_table, 3600)
+  rollup_id = reader.get_rollup_watermark(summ_table)
+  begin_shipped_insert(master, summ_table, [shipped_row(1, "pi1"), shipped_row(2, "pi1")])
+  writer = start(lambda: worker.insert_shipped_summary(summ_table, [shipped_row(1, "pi2"), shipped_row(3, "pi2")]))
+  writer.join(0.5)
+  for i in range(3):
+    if i == 1:
+      master.db_conn.commit()
+      writer.join(10)
+    until_id, row_count = reader.get_new_summary_range(summ_table, rollup_id)
+    if row_count > 0:
+      rollups.add(reader, reader.get_new_summary_rows(summ_table, rollup_id, until_id), until_id)
+      rollup_id = until_id
+    if i == 0:
+      assert row_count == 0
+  assert sum_packets(reader, rollup.rollup_table(summ_table, 1)) == 40
+  assert reader.get_rollup_watermark(summ_table) == rollup_id
+
+# the same two writers for the merged view: a row the merge skipped would be missing from its sensor's packets,
+# and one merged twice would count its packets twice
+def test_merge_watermark_with_two_writers(make_db_manager, summ_table):
+  master, worker, reader = make_db_manager(), make_db_manager(), make_db_manager()
+  make_master_tables(reader, summ_table)
+  reader.create_merge_tables(summ_table)
+  merger = summary_merge.SummaryMerger(summ_table, 3600)
+  merge_id = reader.get_rollup_watermark(summary_merge.merged_table(summ_table))
+  begin_shipped_insert(master, summ_table, [shipped_row(1, "pi1"), shipped_row(2, "pi1")])
+  writer = start(lambda: worker.insert_shipped_summary(summ_table, [shipped_row(1, "pi2"), shipped_row(3, "pi2")]))
+  writer.join(0.5)
+  for i in range(3):
+    if i == 1:
+      master.db_conn.commit()
+      writer.join(10)
+    until_id, row_count = reader.get_new_summary_range(summ_table, merge_id)
+    if row_count > 0:
+      merger.add(reader, reader.get_new_summary_rows(summ_table, merge_id, until_id, with_sensor=True), until_id)
+      merge_id = until_id
+    if i == 0:
+      assert row_count == 0
+  assert sum_packets(reader, summary_merge.sensor_table(summ_table)) == 40
+  # both pis saw flow 1, the merged view counts it once
+  assert sum_packets(reader, summary_merge.merged_table(summ_table)) == 30
+  assert reader.get_rollup_watermark(summary_merge.merged_table(summ_table)) == merge_id
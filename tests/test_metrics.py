@@ -0,0 +1,118 @@
+import json
+import math
+import urllib.request
+
+import metrics
+
+def make_registry():
+  registry = metrics.Registry()
+  packets = registry.counter("packets", "Packets read")
+  packets.inc()
+  packets.inc(2)
+  depth = registry.gauge("depth", "Packets waiting", function=lambda: 7)
+  flushes = registry.counter("flushes", "Windows flushed", ("table",))
+  flushes.labels("a").inc()
+  flushes.labels('quoted "b"\n').inc(4)
+  latency = registry.histogram("latency_seconds", "Flush latency", buckets=(0.1, 1))
+  for value in (0.05, 0.5, 0.5, 3):
+    latency.observe(value)
+  return registry
+
+def test_prometheus_text():
+  lines = make_registry().render_prometheus().splitlines()
+  assert lines == [
+    "# HELP packets Packets read",
+    "# TYPE packets counter",
+    "packets 3",
+    "# HELP depth Packets waiting",
+    "# TYPE depth gauge",
+    "depth 7",
+    "# HELP flushes Windows flushed",
+    "# TYPE flushes counter",
+    'flushes{table="a"} 1',
+    'flushes{table="quoted \\"b\\"\\n"} 4',
+    "# HELP latency_seconds Flush latency",
+    "# TYPE latency_seconds histogram",
+    'latency_seconds_bucket{le="0.1"} 1',
+    'latency_seconds_bucket{le="1.0"} 3',
+    'latency_seconds_bucket{le="+Inf"} 4',
+    "latency_seconds_sum 4.05",
+    "latency_seconds_count 4"]
+
+def test_snapshot_is_json():
+  stats = json.loads(json.dumps(make_registry().snapshot()))
+  assert stats["packets"] == 3
+  assert stats["depth"] == 7
+  assert stats["flushes"] == {"table=a": 1, 'table=quoted "b"\n': 4}
+  latency = stats["latency_seconds"]
+  assert (latency["count"], latency["sum"]) == (4, 4.05)
+  # the median falls in the (0.1, 1] bucket, p99 in +Inf which reports the highest bound
+  assert 0.1 < latency["p50"] <= 1
+  assert latency["p99"] == 1
+
+def test_histogram_percentiles_interpolate_within_buckets():
+  histogram = metrics.Histogram((1, 2, 3, 4))
+  for value in (0.5, 1.5, 2.5, 3.5):
+    histogram.observe(value)
+  assert histogram.percentile(50) == 2
+  assert histogram.percentile(25) == 1
+  assert math.isclose(histogram.percentile(62.5), 2.5)
+  assert metrics.Histogram().percentile(50) == 0
+
+def test_registering_again_returns_the_same_metric():
+  registry = metrics.Registry()
+  counter = registry.counter("packets", "Packets read")
+  assert registry.counter("packets", "Packets read") is counter
+  family = registry.histogram("stage_seconds", "Stage time", ("stage",))
+  assert registry.histogram("stage_seconds", "Stage time", ("stage",)) is family
+  assert family.labels("flush") is family.labels("flush")
+  # a gauge registered again reads the new function
+  registry.gauge("depth", "Packets waiting", function=lambda: 1)
+  gauge = registry.gauge("depth", "Packets waiting", function=lambda: 2)
+  assert gauge.get() == 2
+
+def test_instrumented_methods_are_timed():
+  registry = metrics.Registry()
+  family = registry.histogram("call_seconds", "Call time", ("method",))
+  class Store():
+    def put(self, value):
+      return value*2
+    def _private(self):
+      return 1
+  metrics.instrument_methods(Store, family)
+  store = Store()
+  assert store.put(2) == 4
+  assert store.put.__name__ == "put"
+  store._private()
+  assert list(family.children) == [("put",)]
+  assert family.labels("put").count == 1
+
+def test_stats_writer_rates(tmp_path):
+  registry = metrics.Registry()
+  packets = registry.counter("packets", "Packets read")
+  path = str(tmp_path / "stats.json")
+  writer = metrics.StatsWriter(path, registry=registry)
+  writer.write()
+  with open(path) as stats_file:
+    first = json.load(stats_file)
+  assert first["rates"] == {}
+  assert first["metrics"]["packets"] == 0
+  packets.inc(10)
+  writer.previous_time -= 2
+  writer.write()
+  with open(path) as stats_file:
+    second = json.load(stats_file)
+  assert second["metrics"]["packets"] == 10
+  assert 4 < second["rates"]["packets"] <= 5
+
+def test_http_endpoint_serves_prometheus_text():
+  registry = make_registry()
+  server = metrics.start_http_server(0, registry=registry)
+  try:
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    with urllib.request.urlopen(url + "/metrics") as response:
+      assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+      assert response.read().decode("utf-8") == registry.render_prometheus()
+  finally:
+    server.shutdown()
+    server.server_close()
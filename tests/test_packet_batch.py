@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+import copy_stream
+import packet_batch
+
+# as packet_extractor makes them: ports and lengths as ints or strings, empty or None when missing
+LOGS = [[1600000000.25, "10.0.0.1", 51000, "10.0.0.2", 80, "TCP", 60],
+        [1600000000.5, "02:00:00:00:00:01", None, "02:00:00:00:00:02", None, None, 42],
+        [1600000001.0, "fe80::1", "443", "fe80::2", "", "", "1500"],
+        [1600000001.0, None, None, "10.0.0.2", 53, "UDP", None],
+        [1600000002.75, "10.0.0.1", 51000, "host, with \"quotes\"", 80, "TCP", 0]]
+
+# a log the way the batch gives it back: ints, and None for what is missing
+def normalized(log):
+  def text(value):
+    return None if value == "" else value
+  def number(value):
+    return None if value == None or value == "" else int(value)
+  return (float(log[0]), text(log[1]), number(log[2]), text(log[3]), number(log[4]), text(log[5]), number(log[6]))
+
+def make_batch(logs):
+  batch = packet_batch.PacketBatch()
+  for log in logs:
+    batch.append(log)
+  return batch
+
+def random_logs(rng, count, ordered=True):
+  logs = []
+  ts = 1600000000.0
+  for i in range(count):
+    ts += rng.random()*0.01
+    logs.append([ts if ordered else ts-rng.random(), rng.choice(["10.0.0.1", "10.0.0.2", None]), rng.choice([None, "", 80, "443"]),
+                 rng.choice(["10.0.1.1", "fe80::1"]), rng.choice([None, 53, "8080"]), rng.choice(["TCP", "UDP", None]), rng.randrange(40, 1500)])
+  return logs
+
+def test_append_and_read_back():
+  batch = make_batch(LOGS)
+  assert len(batch) == len(LOGS)
+  assert list(batch) == [normalized(log) for log in LOGS]
+  assert [batch[i] for i in range(len(LOGS))] == [normalized(log) for log in LOGS]
+  assert batch.ordered
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_slice_is_the_packets_in_the_time_range(ordered):
+  rng = random.Random(11)
+  logs = random_logs(rng, 500, ordered)
+  batch = make_batch(logs)
+  assert batch.ordered == ordered
+  for i in range(20):
+    start_ts, end_ts = sorted(rng.uniform(1599999999, 1600000004) for j in range(2))
+    for start, end in ((start_ts, end_ts), (None, end_ts), (start_ts, None), (end_ts, start_ts)):
+      expected = [normalized(log) for log in logs if (start is None or log[0] >= start) and (end is None or log[0] < end)]
+      part = batch.slice(start, end)
+      assert list(part) == expected
+      assert part.strings is batch.strings
+
+def test_spool_encoding_round_trip():
+  batch = make_batch(LOGS)
+  data = batch.to_bytes()
+  assert list(packet_batch.PacketBatch.from_bytes(data)) == list(batch)
+  assert [tuple(log) for log in packet_batch.PacketBatch.read_logs(data)] == list(batch)
+  empty = packet_batch.PacketBatch().to_bytes()
+  assert list(packet_batch.PacketBatch.from_bytes(empty)) == []
+
+# the columnar encodings for COPY are byte for byte those of the same logs as lists
+@pytest.mark.parametrize("rows_per_chunk", [1, 2, 1000])
+def test_copy_encodings_match_the_list_rows(rows_per_chunk):
+  logs = LOGS + random_logs(random.Random(2), 50)
+  batch = make_batch(logs)
+  list_rows = [list(log) for log in logs]
+  assert b"".join(batch.binary_chunks(rows_per_chunk)) == b"".join(copy_stream.binary_chunks(list_rows, copy_stream.LOG_BATCH_TYPES, rows_per_chunk))
+  assert b"".join(batch.csv_chunks(rows_per_chunk)) == b"".join(copy_stream.csv_chunks([normalized(log) for log in logs], rows_per_chunk))
+
+@pytest.mark.parametrize("copy_mode", ["binary", "memory"])
+def test_copy_into_the_log_table(make_db_manager, summ_table, copy_mode):
+  db_manager = make_db_manager()
+  db_manager.copy_mode = copy_mode
+  db_manager.create_log_table(summ_table)
+  logs = [log for log in LOGS if log[1] is not None]
+  db_manager.insert_log_batch(summ_table, make_batch(logs))
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT * FROM {summ_table} ORDER BY timestamp")
+  assert curs.fetchall() == [normalized(log) for log in logs]
+  db_manager.db_conn.commit()
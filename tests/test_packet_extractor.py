@@ -0,0 +1,155 @@
+import shutil
+import socket
+import struct
+
+import pytest
+
+import packet_extractor
+
+MAC_A = bytes.fromhex("020000000001")
+MAC_B = bytes.fromhex("020000000002")
+
+def ethernet(ethertype, payload, vlan=None):
+  header = MAC_B + MAC_A
+  if vlan is not None:
+    header += struct.pack("!HH", 0x8100, vlan)
+  return header + struct.pack("!H", ethertype) + payload
+
+def ipv4(src, dst, protocol, payload):
+  header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20+len(payload), 1, 0, 64, protocol, 0, socket.inet_aton(src), socket.inet_aton(dst))
+  return header + payload
+
+def ipv6(src, dst, next_header, payload):
+  header = struct.pack("!IHBB16s16s", 6 << 28, len(payload), next_header, 64,
+                       socket.inet_pton(socket.AF_INET6, src), socket.inet_pton(socket.AF_INET6, dst))
+  return header + payload
+
+def tcp(srcport, dstport):
+  return struct.pack("!HHIIBBHHH", srcport, dstport, 1, 0, 5 << 4, 0x02, 65535, 0, 0)
+
+def udp(srcport, dstport, data=b"data"):
+  return struct.pack("!HHHH", srcport, dstport, 8+len(data), 0) + data
+
+def hop_by_hop(next_header, payload):
+  # PadN filling the 8 bytes of a minimal hop-by-hop options header
+  return struct.pack("!BB", next_header, 0) + b"\x01\x04\x00\x00\x00\x00" + payload
+
+def fragment(next_header, fragment_offset, payload):
+  return struct.pack("!BBHI", next_header, 0, fragment_offset << 3, 1234) + payload
+
+def icmpv6_echo():
+  return struct.pack("!BBHHH", 128, 0, 0, 1, 1)
+
+def arp():
+  return struct.pack("!HHBBH6s4s6s4s", 1, 0x0800, 6, 4, 1, MAC_A, socket.inet_aton("10.0.0.1"), b"\0"*6, socket.inet_aton("10.0.0.2"))
+
+def write_pcap(path, frames):
+  with open(path, "wb") as pcap:
+    pcap.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+    for i, frame in enumerate(frames):
+      pcap.write(struct.pack("<IIII", 1600000000+i, 250000, len(frame), len(frame)))
+      pcap.write(frame)
+
+# (frame, expected raw extractor log without the timestamp)
+PACKETS = [
+  (ethernet(0x0800, ipv4("10.0.0.1", "10.0.0.2", 6, tcp(51000, 80))),
+   ["10.0.0.1", 51000, "10.0.0.2", 80, "TCP"]),
+  (ethernet(0x0800, ipv4("10.0.0.2", "10.0.0.1", 17, udp(53, 40000))),
+   ["10.0.0.2", 53, "10.0.0.1", 40000, "UDP"]),
+  (ethernet(0x86dd, ipv6("2001:db8::1", "fe80::2", 6, tcp(443, 51001))),
+   ["2001:db8::1", 443, "fe80::2", 51001, "TCP"]),
+  (ethernet(0x86dd, ipv6("2001:db8::1", "ff02::fb", 0, hop_by_hop(17, udp(5353, 5353)))),
+   ["2001:db8::1", 5353, "ff02::fb", 5353, "UDP"]),
+  (ethernet(0x86dd, ipv6("2001:db8::3", "2001:db8::4", 44, fragment(17, 0, udp(4000, 4001)))),
+   ["2001:db8::3", 4000, "2001:db8::4", 4001, "UDP"]),
+  (ethernet(0x86dd, ipv6("2001:db8::3", "2001:db8::4", 44, fragment(17, 185, b"\0"*16))),
+   ["2001:db8::3", None, "2001:db8::4", None, "UDP"]),
+  (ethernet(0x86dd, ipv6("fe80::1", "fe80::2", 58, icmpv6_echo())),
+   ["fe80::1", None, "fe80::2", None, "ICMPV6"]),
+  (ethernet(0x86dd, ipv6("2001:db8::5", "2001:db8::6", 17, udp(1000, 2000)), vlan=10),
+   ["2001:db8::5", 1000, "2001:db8::6", 2000, "UDP"]),
+  (ethernet(0x0806, arp()),
+   ["02:00:00:00:00:01", None, "02:00:00:00:00:02", None, "ARP"]),
+]
+
+@pytest.fixture
+def pcap_file(tmp_path):
+  path = str(tmp_path / "mixed.pcap")
+  write_pcap(path, [frame for frame, log in PACKETS])
+  return path
+
+def read(extractor):
+  try:
+    return list(extractor.logs())
+  finally:
+    extractor.close()
+
+def test_raw_decodes_ipv4_and_ipv6(pcap_file):
+  logs = read(packet_extractor.RawPcapExtractor(pcap_file=pcap_file))
+  assert len(logs) == len(PACKETS)
+  for i, (log, (frame, expected)) in enumerate(zip(logs, PACKETS)):
+    assert log[0] == 1600000000+i+0.25
+    assert log[1:6] == expected
+    assert log[6] == len(frame)
+
+def test_raw_truncated_ipv6(tmp_path):
+  path = str(tmp_path / "truncated.pcap")
+  frame = ethernet(0x86dd, ipv6("2001:db8::1", "2001:db8::2", 6, tcp(1, 2)))
+  write_pcap(path, [frame[:14+20], frame[:14+40+2]])
+  logs = read(packet_extractor.RawPcapExtractor(pcap_file=path))
+  assert logs[0][1:6] == ["02:00:00:00:00:01", None, "02:00:00:00:00:02", None, "IPV6"]
+  assert logs[1][1:6] == ["2001:db8::1", None, "2001:db8::2", None, "TCP"]
+
+def test_raw_truncated_ipv4(tmp_path):
+  path = str(tmp_path / "truncated.pcap")
+  frame = ethernet(0x0800, ipv4("10.0.0.1", "10.0.0.2", 6, tcp(1, 2)))
+  bad_ihl = frame[:14] + bytes([0x44]) + frame[15:]
+  write_pcap(path, [frame[:14+16], frame[:14+20+2], bad_ihl])
+  logs = read(packet_extractor.RawPcapExtractor(pcap_file=path))
+  assert logs[0][1:6] == ["02:00:00:00:00:01", None, "02:00:00:00:00:02", None, "IP"]
+  assert logs[1][1:6] == ["10.0.0.1", None, "10.0.0.2", None, "TCP"]
+  assert logs[2][1:6] == ["02:00:00:00:00:01", None, "02:00:00:00:00:02", None, "IP"]
+
+# the fields every extractor agrees on. The protocol isn't compared: the raw extractor reports the highest header it
+# decodes, tshark and pyshark the application protocol they dissect
+def common_fields(log):
+  return [log[0]] + [None if value is None else str(value) for value in log[1:5]] + [str(log[6])]
+
+def assert_same_as_raw(pcap_file, extractor):
+  raw_logs = read(packet_extractor.RawPcapExtractor(pcap_file=pcap_file))
+  logs = read(extractor)
+  assert [common_fields(log) for log in logs] == [common_fields(log) for log in raw_logs]
+
+@pytest.mark.skipif(shutil.which("tshark") is None, reason="tshark is not installed")
+def test_tshark_matches_raw(pcap_file):
+  assert_same_as_raw(pcap_file, packet_extractor.TsharkExtractor(pcap_file=pcap_file))
+
+def test_pyshark_matches_raw(pcap_file):
+  pytest.importorskip("pyshark")
+  assert_same_as_raw(pcap_file, packet_extractor.PysharkExtractor(pcap_file=pcap_file))
+
+def test_count_sampler_keeps_every_rate_th_packet():
+  sampler = packet_extractor.Sampler(4)
+  kept = [i for i in range(1000) if sampler.keep()]
+  assert kept == list(range(3, 1000, 4))
+  assert (sampler.seen, sampler.kept) == (1000, 250)
+
+@pytest.mark.parametrize("rate", [2, 10, 100])
+def test_random_sampler_keeps_about_one_in_rate(rate):
+  sampler = packet_extractor.Sampler(rate, "random", seed=rate)
+  seen = 100000
+  kept = sum(sampler.keep() for i in range(seen))
+  assert sampler.kept == kept
+  # within 5 standard deviations of seen/rate
+  assert abs(kept-seen/rate) < 5*(seen*(1/rate)*(1-1/rate))**0.5
+
+def test_no_sampler_below_rate_two():
+  assert packet_extractor.make_sampler(1) is None
+  assert isinstance(packet_extractor.make_sampler(3, "random"), packet_extractor.Sampler)
+
+def test_raw_samples_before_decoding(pcap_file):
+  extractor = packet_extractor.make_extractor("raw", pcap_file=pcap_file, sample_rate=3)
+  logs = read(extractor)
+  assert [log[0] for log in logs] == [1600000000+i+0.25 for i in range(2, len(PACKETS), 3)]
+  assert [log[1:6] for log in logs] == [expected for frame, expected in PACKETS[2::3]]
+  assert extractor.sampler.seen == len(PACKETS)
@@ -0,0 +1,36 @@
+import retention
+
+TS = 1600000000.0
+
+def summary_row(ts):
+  return (ts, ts+0.5, "10.0.0.1", 1000, "10.0.0.254", 80, "TCP", 60, 60, 60, 1, 1)
+
+def table_names(db_manager, summ_table):
+  curs = db_manager.db_conn.cursor()
+  curs.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %(table)s ORDER BY tablename", {"table": summ_table + "%"})
+  names = [name for (name,) in curs.fetchall()]
+  db_manager.db_conn.commit()
+  return names
+
+def row_count(db_manager, table):
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT count(*) FROM {table}")
+  count = curs.fetchone()[0]
+  db_manager.db_conn.commit()
+  return count
+
+# a detached partition makes way for late rows in its range, like those of a spool replayed after an outage
+def test_detached_partition_can_be_created_again(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  db_manager.create_summary_table(summ_table)
+  table_retention = retention.RetentionManager(summ_table, "min_timestamp", 60, partition_size=60, precreate=0, detach=True)
+  partition = table_retention.partition_name(int(TS//60*60))
+  for i in range(2):
+    table_retention.prepare(db_manager, TS, TS)
+    db_manager.insert_summary_batch(summ_table, [summary_row(TS)])
+    table_retention.prepare(db_manager, TS+300, TS+300)
+    table_retention.enforce(db_manager, TS+300)
+    assert partition not in table_names(db_manager, summ_table)
+  assert row_count(db_manager, f"{partition}_detached_1") == 1
+  assert row_count(db_manager, f"{partition}_detached_2") == 1
+  assert row_count(db_manager, summ_table) == 0
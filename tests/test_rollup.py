@@ -0,0 +1,29 @@
+import retention
+import rollup
+
+TS = 1600000000.0
+
+# a summary row of summ_size packets kept 1 in sample_rate
+def summary_row(max_ts, src, summ_size, sample_rate=1):
+  return (max_ts-0.5, max_ts, src, 1000, "10.0.0.254", 80, "TCP", 60, 60, 60, summ_size, sample_rate)
+
+def test_sampled_rows_are_scaled_back_up():
+  rows = [summary_row(TS+0.2, "a", 3), summary_row(TS+0.7, "a", 2, 10), summary_row(TS+1.5, "b", 4, 100)]
+  assert rollup.rollup_rows(rows, 1) == [
+    (TS, "a", 1000, "10.0.0.254", 80, 3+2*10, TS+0.7, 2*10*9),
+    (TS+1, "b", 1000, "10.0.0.254", 80, 4*100, TS+1.5, 4*100*99)]
+  assert rollup.rollup_rows(rows, 10) == [
+    (TS, "a", 1000, "10.0.0.254", 80, 3+2*10, TS+0.7, 2*10*9),
+    (TS, "b", 1000, "10.0.0.254", 80, 4*100, TS+1.5, 4*100*99)]
+
+def test_dashboard_pps_of_sampled_rows(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  db_manager.create_summary_table(summ_table)
+  db_manager.create_rollup_tables(summ_table)
+  retention.RetentionManager(summ_table, "min_timestamp", 3600).prepare(db_manager, TS, TS+60)
+  rows = [summary_row(TS+i+0.5, "a", 5, 10) for i in range(10)] + [summary_row(TS+i+0.5, "b", 20) for i in range(10)]
+  db_manager.insert_summary_batch(summ_table, rows)
+  rollup.Rollups(summ_table, 3600).add(db_manager, rows)
+  pps = {row[0]: (float(row[5]), float(row[6])) for row in db_manager.get_summ_pps_info(summ_table, 10)}
+  assert pps["a"] == (5*10*10/10, rollup.pps_margin(10*5*10*9, 10))
+  assert pps["b"] == (20*10/10, 0)
@@ -0,0 +1,75 @@
+import math
+import random
+
+import sketches
+
+# a skewed stream: key i is seen about 1/(i+1) as often as key 0
+def zipf_stream(rng, keys, length):
+  weights = [1/(i+1) for i in range(keys)]
+  return rng.choices(range(keys), weights, k=length)
+
+def true_counts(stream):
+  counts = {}
+  for key in stream:
+    counts[key] = counts.get(key, 0)+1
+  return counts
+
+def assert_space_saving_bounds(sketch, counts, total):
+  assert len(sketch.counters) <= sketch.capacity
+  for key, (count, error) in sketch.counters.items():
+    assert count-error <= counts.get(key, 0) <= count
+  for key, count in counts.items():
+    if count > total/sketch.capacity:
+      assert key in sketch.counters
+
+def test_space_saving_error_bounds():
+  rng = random.Random(1)
+  stream = zipf_stream(rng, 5000, 50000)
+  sketch = sketches.SpaceSaving(100)
+  for key in stream:
+    sketch.add(key)
+  assert_space_saving_bounds(sketch, true_counts(stream), len(stream))
+  assert sum(counter[0] for counter in sketch.counters.values()) == len(stream)
+  # the heaviest keys come out first
+  top = sketch.top(3)
+  assert [key for key, count, error in top] == [0, 1, 2]
+
+def test_space_saving_merge_keeps_the_bounds():
+  rng = random.Random(2)
+  first_stream = zipf_stream(rng, 5000, 30000)
+  second_stream = [key+10 for key in zipf_stream(rng, 5000, 20000)]
+  first = sketches.SpaceSaving(100)
+  second = sketches.SpaceSaving(100)
+  for key in first_stream:
+    first.add(key)
+  for key in second_stream:
+    second.add(key)
+  first.merge(second)
+  assert_space_saving_bounds(first, true_counts(first_stream+second_stream), len(first_stream)+len(second_stream))
+  # the heap was rebuilt with the merged counters, so evicting still finds the smallest one
+  evicted = first.add("new")
+  assert "new" in first.counters and evicted not in first.counters
+
+def test_hyperloglog_error_at_precision_12():
+  precision = 12
+  sigma = 1.04/math.sqrt(2**precision)
+  for distinct in (100, 10000, 200000):
+    hll = sketches.HyperLogLog(precision)
+    for i in range(distinct):
+      hll.add(f"10.{i//65536}.{i//256%256}.{i%256}")
+    # hash64 is deterministic, so this isn't flaky: within 4 standard errors
+    assert abs(hll.count()-distinct) <= 4*sigma*distinct
+    # adding the same values again changes nothing
+    registers = bytes(hll.registers)
+    hll.add("10.0.0.1")
+    assert bytes(hll.registers) == registers
+
+def test_hyperloglog_merge_is_the_union():
+  first = sketches.HyperLogLog(12)
+  second = sketches.HyperLogLog(12)
+  union = sketches.HyperLogLog(12)
+  for i in range(30000):
+    (first if i % 3 else second).add(i)
+    union.add(i)
+  first.merge(second)
+  assert first.registers == union.registers
@@ -0,0 +1,60 @@
+import os
+
+import spool
+
+def drain(records):
+  payloads = []
+  while True:
+    head = records.head(timeout=0)
+    if head is None:
+      return payloads
+    entry, payload = head
+    payloads.append(payload)
+    records.done(entry)
+
+def segment_paths(directory):
+  return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".spool"))
+
+def test_corrupted_record_is_skipped(tmp_path):
+  records = spool.Spool(str(tmp_path), segment_size=4096)
+  for payload in (b"first", b"second", b"third"):
+    assert records.append(payload)
+  # flip a byte of the second payload on disk, behind the spool's back
+  path = segment_paths(str(tmp_path))[0]
+  offset = spool.RECORD.size+len(b"first")+spool.RECORD.size
+  with open(path, "r+b") as segment_file:
+    segment_file.seek(offset)
+    segment_file.write(b"S")
+  assert drain(records) == [b"first", b"third"]
+  assert records.corrupt == 1
+  assert records.replayed == 2
+
+def test_replay_resumes_in_order_after_a_restart(tmp_path):
+  # small segments, so the records span several files
+  records = spool.Spool(str(tmp_path), segment_size=spool.RECORD.size*2+16)
+  payloads = [f"window {i}".encode() for i in range(7)]
+  for payload in payloads:
+    assert records.append(payload)
+  assert len(segment_paths(str(tmp_path))) > 2
+  for i in range(3):
+    entry, payload = records.head(timeout=0)
+    assert payload == payloads[i]
+    records.done(entry)
+  # a new Spool over the same directory finds the records that weren't replayed, oldest first,
+  # and new records go after them
+  restarted = spool.Spool(str(tmp_path), segment_size=spool.RECORD.size*2+16)
+  assert restarted.depth() == 4
+  assert restarted.append(b"after restart")
+  assert drain(restarted) == payloads[3:] + [b"after restart"]
+  # every segment but the one being appended to is gone once its records are replayed
+  assert len(segment_paths(str(tmp_path))) == 1
+
+def test_record_cut_short_ends_the_segment(tmp_path):
+  records = spool.Spool(str(tmp_path), segment_size=4096)
+  assert records.append(b"whole")
+  # a crash after the payload was written but before its header: the header is still zeros
+  segment = records.active
+  offset = segment.end
+  segment.map[offset+spool.RECORD.size:offset+spool.RECORD.size+7] = b"partial"
+  restarted = spool.Spool(str(tmp_path), segment_size=4096)
+  assert drain(restarted) == [b"whole"]
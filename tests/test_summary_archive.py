@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import flow_aggregator
+import retention
+import summary_archive
+
+TS = 1600000000.0
+
+# a summary table that isn't partitioned, as an older version made them
+SUMMARY_TABLE = """
+CREATE TABLE {summ_table}(
+  id serial primary key,
+  min_timestamp double precision not null,
+  max_timestamp double precision not null,
+  src text not null,
+  srcport integer,
+  dst text not null,
+  dstport integer,
+  protocol text,
+  min_length integer,
+  max_length integer,
+  avg_length numeric,
+  summ_size integer,
+  sample_rate integer not null default 1
+)
+"""
+
+def summary_row(ts):
+  return (ts, ts+0.5, "10.0.0.1", 1000, "10.0.0.254", 80, "TCP", 60, 60, 60, 1, 1)
+
+def insert_rows(db_manager, summ_table, timestamps):
+  curs = db_manager.db_conn.cursor()
+  curs.executemany(f"INSERT INTO {summ_table}({', '.join(flow_aggregator.SUMMARY_COLUMNS)}) VALUES ({', '.join(['%s']*12)})",
+                   [summary_row(ts) for ts in timestamps])
+  db_manager.db_conn.commit()
+
+def table_timestamps(db_manager, summ_table):
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"SELECT min_timestamp FROM {summ_table} ORDER BY min_timestamp")
+  timestamps = [row[0] for row in curs.fetchall()]
+  db_manager.db_conn.commit()
+  return timestamps
+
+def archived_timestamps(directory):
+  archive = summary_archive.Archive(directory)
+  timestamps = sorted(ts for values in archive.scan(None, None, ["min_timestamp"]) for ts in values[0])
+  archive.close()
+  return timestamps
+
+def test_segments_with_the_same_range_are_all_kept(tmp_path):
+  archiver = summary_archive.SummaryArchiver(str(tmp_path), flow_aggregator.SUMMARY_COLUMNS)
+  rows = [summary_row(TS), summary_row(TS+0.25)]
+  first = archiver.range_path("summary", rows)
+  archiver.write(first, rows)
+  second = archiver.range_path("summary", rows)
+  archiver.write(second, rows)
+  assert first != second
+  assert archived_timestamps(str(tmp_path)) == [TS, TS, TS+0.25, TS+0.25]
+  assert archiver.archived_rows == 4
+
+# rows are archived as they're deleted, the one at clear_ts included, and two enforces within the same second
+# each leave their own segment
+def test_older_rows_are_archived_as_they_are_deleted(make_db_manager, summ_table, tmp_path):
+  db_manager = make_db_manager()
+  curs = db_manager.db_conn.cursor()
+  curs.execute(SUMMARY_TABLE.format(summ_table=summ_table))
+  db_manager.db_conn.commit()
+  directory = str(tmp_path / "archive")
+  archiver = summary_archive.SummaryArchiver(directory, flow_aggregator.SUMMARY_COLUMNS)
+  table_retention = retention.RetentionManager(summ_table, "min_timestamp", 10, archiver=archiver)
+  insert_rows(db_manager, summ_table, [TS, TS+5, TS+10, TS+11])
+  table_retention.enforce(db_manager, TS+15)
+  assert table_timestamps(db_manager, summ_table) == [TS+10, TS+11]
+  assert archived_timestamps(directory) == [TS, TS+5]
+  insert_rows(db_manager, summ_table, [TS+0.5, TS+5.25])
+  table_retention.enforce(db_manager, TS+15.5)
+  assert table_timestamps(db_manager, summ_table) == [TS+10, TS+11]
+  assert archived_timestamps(directory) == [TS, TS+0.5, TS+5, TS+5.25]
+  assert len(os.listdir(directory)) == 2
+  assert archiver.archived_rows == 4
+
+def test_rows_stay_when_the_segment_cant_be_written(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  curs = db_manager.db_conn.cursor()
+  curs.execute(SUMMARY_TABLE.format(summ_table=summ_table))
+  db_manager.db_conn.commit()
+  insert_rows(db_manager, summ_table, [TS, TS+1])
+  def write(rows):
+    raise OSError("disk full")
+  with pytest.raises(OSError):
+    db_manager.delete_archive_rows(summ_table, flow_aggregator.SUMMARY_COLUMNS, "min_timestamp", TS+1, write)
+  assert table_timestamps(db_manager, summ_table) == [TS, TS+1]
@@ -0,0 +1,87 @@
+import pytest
+
+TS = 1600000000.0
+
+# network_log_summary as the README used to have it made by hand on the master
+OLD_SUMMARY_TABLE = """
+CREATE TABLE {summ_table}(
+  id serial primary key,
+  min_timestamp double precision not null,
+  max_timestamp double precision not null,
+  src text not null,
+  srcport integer,
+  dst text not null,
+  dstport integer,
+  protocol text,
+  min_length integer,
+  max_length integer,
+  avg_length numeric,
+  summ_size integer
+)
+"""
+
+def shipped_row(i, sensor="pi1"):
+  return (TS+i, TS+i+0.5, f"10.0.0.{i}", 1000+i, "10.0.0.254", 80, "TCP", 60, 60, 60, 1, 1, sensor, i)
+
+def test_old_master_table_is_migrated(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  curs = db_manager.db_conn.cursor()
+  curs.execute(OLD_SUMMARY_TABLE.format(summ_table=summ_table))
+  curs.execute(f"INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, dst, summ_size) VALUES ({TS}, {TS}, 'a', 'b', 1)")
+  db_manager.db_conn.commit()
+
+  db_manager.create_summary_table(summ_table, master=True)
+  db_manager.create_summary_table(summ_table, master=True)
+  rows = [shipped_row(1), shipped_row(2), shipped_row(1, "pi2")]
+  assert db_manager.insert_shipped_summary(summ_table, rows) == 3
+  # rows sent again are skipped
+  assert db_manager.insert_shipped_summary(summ_table, rows[:2]) == 0
+  assert db_manager.get_row_count(summ_table) == 4
+  curs.execute("SELECT count(*) FROM pg_indexes WHERE tablename = %(table)s AND indexdef LIKE 'CREATE UNIQUE%%sensor%%'", {"table": summ_table})
+  assert curs.fetchone()[0] == 1
+  db_manager.db_conn.commit()
+
+def test_new_master_table_gets_no_second_index(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  db_manager.create_summary_table(summ_table, master=True)
+  db_manager.create_summary_table(summ_table, master=True)
+  curs = db_manager.db_conn.cursor()
+  curs.execute("SELECT count(*) FROM pg_indexes WHERE tablename = %(table)s AND indexdef LIKE 'CREATE UNIQUE%%sensor%%'", {"table": summ_table})
+  assert curs.fetchone()[0] == 1
+  db_manager.db_conn.commit()
+
+# network_log_batch as an older version made it
+OLD_LOG_TABLE = """
+CREATE UNLOGGED TABLE {table}(
+  timestamp double precision not null,
+  src text not null,
+  srcport integer,
+  dst text not null,
+  dstport integer,
+  protocol text,
+  length integer,
+  unique (timestamp)
+)
+"""
+
+# packets of two interfaces or capture shards with the same timestamp
+SAME_TS_LOGS = [(TS, "10.0.0.1", 1000, "10.0.0.2", 80, "TCP", 60), (TS, "10.0.1.1", 1001, "10.0.1.2", 53, "UDP", 70)]
+
+@pytest.mark.parametrize("old", [False, True])
+def test_log_table_takes_packets_with_the_same_timestamp(make_db_manager, summ_table, old):
+  db_manager = make_db_manager()
+  if old:
+    curs = db_manager.db_conn.cursor()
+    curs.execute(OLD_LOG_TABLE.format(table=summ_table))
+    db_manager.db_conn.commit()
+  db_manager.create_log_table(summ_table)
+  db_manager.create_log_table(summ_table)
+  db_manager.insert_log_batch(summ_table, SAME_TS_LOGS)
+  assert db_manager.get_row_count(summ_table) == 2
+
+def test_partitioned_log_table_takes_packets_with_the_same_timestamp(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  db_manager.create_log_table(summ_table, partitioned=True)
+  db_manager.create_partition(summ_table, f"{summ_table}_p0", TS-10, TS+10)
+  db_manager.insert_log_batch(summ_table, SAME_TS_LOGS)
+  assert db_manager.get_row_count(summ_table) == 2
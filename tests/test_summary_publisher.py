@@ -0,0 +1,74 @@
+import socket
+import time
+
+import summary_publisher
+
+ROWS = [(1600000000.0, 1600000000.5, "10.0.0.1", 1000, "10.0.0.254", 80, "TCP", 60, 60, 60.0, 1, 1, 1),
+        (1600000001.0, 1600000001.5, "10.0.0.2", None, "10.0.0.254", None, None, None, None, None, 2, 1, 2)]
+
+def free_port():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def test_new_subscriber_catches_up_from_the_db_first():
+  subscriber = summary_publisher.Subscriber(4)
+  assert subscriber.next_rows(0) == (None, True)
+  assert subscriber.next_rows(0) == (None, False)
+
+def test_batches_are_sent_together_in_order():
+  subscriber = summary_publisher.Subscriber(4)
+  subscriber.next_rows(0)
+  subscriber.push(ROWS[:1])
+  subscriber.push(ROWS[1:])
+  assert subscriber.depth() == 2
+  assert subscriber.next_rows(0) == (ROWS, False)
+  assert subscriber.depth() == 0
+
+# a subscriber that falls max_batches behind loses its buffer and reads the db instead
+def test_slow_subscriber_is_marked_lagging():
+  subscriber = summary_publisher.Subscriber(2)
+  subscriber.next_rows(0)
+  for i in range(3):
+    subscriber.push([ROWS[0][:12] + (i,)])
+  assert subscriber.dropped_batches == 1
+  rows, lagging = subscriber.next_rows(0)
+  assert lagging
+  assert rows == [ROWS[0][:12] + (2,)]
+  assert subscriber.next_rows(0) == (None, False)
+
+def test_hub_fans_out_to_every_subscriber():
+  hub = summary_publisher.SubscriberHub(4)
+  first, second = hub.subscribe(), hub.subscribe()
+  hub.publish(ROWS)
+  hub.unsubscribe(second)
+  hub.publish(ROWS[:1])
+  assert first.next_rows(0) == (ROWS + ROWS[:1], True)
+  assert second.next_rows(0) == (ROWS, True)
+  assert hub.published_rows == 3
+
+def test_publisher_sends_rows_to_the_hub():
+  port = free_port()
+  hub = summary_publisher.SubscriberHub(4)
+  subscriber = hub.subscribe()
+  subscriber.next_rows(0)
+  hub.start("127.0.0.1", port)
+  publisher = summary_publisher.Publisher(f"127.0.0.1:{port}", retry_interval=0)
+  deadline = time.time()+5
+  while publisher.sock is None and time.time() < deadline:
+    publisher.connect()
+    time.sleep(0.01)
+  publisher.publish(ROWS)
+  rows, lagging = subscriber.next_rows(5)
+  assert rows == ROWS
+  assert publisher.published_rows == 2
+  publisher.close()
+
+def test_publisher_drops_rows_without_a_worker():
+  publisher = summary_publisher.Publisher(f"127.0.0.1:{free_port()}")
+  publisher.publish(ROWS)
+  assert (publisher.published_rows, publisher.dropped_rows) == (0, 2)
+  # it doesn't try connecting again until retry_interval is up
+  assert not publisher.connect()
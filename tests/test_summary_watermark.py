@@ -0,0 +1,78 @@
+import threading
+
+import retention
+
+TS = 1600000000.0
+
+def summary_row(i, sample_rate=1):
+  return (TS+i, TS+i+0.5, f"10.0.0.{i}", 1000+i, "10.0.0.254", 80, "TCP", 60, 60, 60, 1, sample_rate)
+
+def make_summary_table(db_manager, summ_table):
+  db_manager.create_summary_table(summ_table)
+  retention.RetentionManager(summ_table, "min_timestamp", 3600).prepare(db_manager, TS, TS+60)
+
+# the first writer draws its id and holds its transaction open, like a flusher still copying a window
+def begin_insert(db_manager, summ_table, i):
+  db_manager.lock_summary_ids(summ_table)
+  curs = db_manager.db_conn.cursor()
+  curs.execute(f"""
+  INSERT INTO {summ_table}(min_timestamp, max_timestamp, src, srcport, dst, dstport, protocol, min_length, max_length, avg_length, summ_size, sample_rate)
+  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+  """, summary_row(i))
+  return curs.fetchone()[0]
+
+def start(target):
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  return thread
+
+# the second writer tries to commit first, the reader's watermark must not pass the first writer's id
+def check_out_of_order_commits(make_db_manager, summ_table, insert_second):
+  first, second, reader = make_db_manager(), make_db_manager(), make_db_manager()
+  make_summary_table(reader, summ_table)
+  first_id = begin_insert(first, summ_table, 1)
+  writer = start(lambda: insert_second(second))
+  writer.join(0.5)
+  assert writer.is_alive() # waiting for the first writer to commit
+  until_id, row_count = reader.get_new_summary_range(summ_table, 0)
+  assert (until_id, row_count) == (0, 0)
+  first.db_conn.commit()
+  writer.join(10)
+  assert not writer.is_alive()
+  until_id, row_count = reader.get_new_summary_range(summ_table, 0)
+  assert row_count == 2
+  rows = reader.get_new_summary_rows(summ_table, 0, until_id)
+  assert [row[12] for row in rows] == [first_id, until_id]
+  assert first_id < until_id
+
+def test_summary_batch_waits_for_earlier_ids(make_db_manager, summ_table):
+  check_out_of_order_commits(make_db_manager, summ_table,
+                             lambda db_manager: db_manager.insert_summary_batch(summ_table, [summary_row(2)], with_ids=True))
+
+def test_summarize_table_waits_for_earlier_ids(make_db_manager, summ_table):
+  log_table = summ_table + "_log"
+  def summarize(db_manager):
+    db_manager.insert_log_batch(log_table, [(TS+2, "10.0.0.2", 1002, "10.0.0.254", 80, "TCP", 60)])
+    db_manager.summarize_table(log_table, summ_table, returning=True)
+  setup = make_db_manager()
+  setup.create_log_table(log_table)
+  check_out_of_order_commits(make_db_manager, summ_table, summarize)
+
+# the watermark read while the first writer is open ships nothing, and nothing is skipped once both committed
+def test_ship_watermark_skips_nothing(make_db_manager, summ_table):
+  first, second, reader = make_db_manager(), make_db_manager(), make_db_manager()
+  make_summary_table(reader, summ_table)
+  begin_insert(first, summ_table, 1)
+  writer = start(lambda: second.insert_summary_batch(summ_table, [summary_row(2), summary_row(3)]))
+  writer.join(0.5)
+  shipped = []
+  ship_id = 0
+  for i in range(3):
+    if i == 1:
+      first.db_conn.commit()
+      writer.join(10)
+    until_id, row_count = reader.get_new_summary_range(summ_table, ship_id)
+    if row_count > 0:
+      shipped += reader.get_new_summary_rows(summ_table, ship_id, until_id)
+    ship_id = until_id
+  assert sorted(row[2] for row in shipped) == ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
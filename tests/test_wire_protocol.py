@@ -0,0 +1,114 @@
+import socket
+import struct
+
+import pytest
+
+import wire_protocol
+
+ROWS = [(1600000000.0, 1600000002.5, "10.0.0.1", 51000, "10.0.0.2", 80, "TCP", 60, 1500, 780.0, 3, 1, 41),
+        (1600000001.0, 1600000001.0, "02:00:00:00:00:01", None, "02:00:00:00:00:02", None, None, None, None, None, 1, 4, 42),
+        (1600000001.5, 1600000003.0, "10.0.0.1", 51000, "fe80::2", 443, "TCP", 40, 40, 40.0, 7, 1, 43)]
+
+def test_frame_round_trip():
+  payload = b"x"*1000
+  for compression in ("none", "zlib"):
+    frame = wire_protocol.encode_frame(wire_protocol.SUMMARY, payload, compression)
+    msg_type, flags, length = wire_protocol.decode_header(frame[:wire_protocol.HEADER.size])
+    assert msg_type == wire_protocol.SUMMARY
+    assert length == len(frame)-wire_protocol.HEADER.size
+    assert wire_protocol.decompress(frame[wire_protocol.HEADER.size:], flags) == payload
+  # the zlib frame is compressed, a small payload isn't
+  assert len(wire_protocol.encode_frame(wire_protocol.SUMMARY, payload, "zlib")) < len(payload)
+  assert wire_protocol.encode_frame(wire_protocol.POLL, b"\x01", "zlib")[wire_protocol.HEADER.size:] == b"\x01"
+
+def test_lz4_round_trip():
+  pytest.importorskip("lz4.frame")
+  payload = b"y"*1000
+  frame = wire_protocol.encode_frame(wire_protocol.SUMMARY, payload, "lz4")
+  msg_type, flags, length = wire_protocol.decode_header(frame[:wire_protocol.HEADER.size])
+  assert wire_protocol.decompress(frame[wire_protocol.HEADER.size:], flags) == payload
+
+def test_socket_round_trip():
+  left, right = socket.socketpair()
+  try:
+    payload = wire_protocol.encode_summary("pi1", ROWS)
+    wire_protocol.send_message(left, wire_protocol.SUMMARY, payload, "zlib")
+    wire_protocol.send_message(left, wire_protocol.POLL, wire_protocol.encode_poll(resync=True))
+    msg_type, received = wire_protocol.recv_message(right)
+    assert (msg_type, received) == (wire_protocol.SUMMARY, payload)
+    msg_type, received = wire_protocol.recv_message(right)
+    assert msg_type == wire_protocol.POLL
+    assert wire_protocol.decode_poll(received) == (True, None)
+  finally:
+    left.close()
+    right.close()
+
+def test_frame_buffer_reassembles_split_frames():
+  frames = (wire_protocol.encode_frame(wire_protocol.HEARTBEAT) +
+            wire_protocol.encode_frame(wire_protocol.SHIPPED, wire_protocol.encode_shipped(5, 1234)))
+  buffer = wire_protocol.FrameBuffer()
+  messages = []
+  for i in range(len(frames)):
+    messages += buffer.feed(frames[i:i+1])
+  assert [(msg_type, payload) for msg_type, payload, size in messages] == [(wire_protocol.HEARTBEAT, b""), (wire_protocol.SHIPPED, struct.pack("!QQ", 5, 1234))]
+  assert wire_protocol.decode_shipped(messages[1][1]) == (5, 1234)
+  assert sum(size for msg_type, payload, size in messages) == len(frames)
+
+def test_summary_round_trip():
+  sensor, rows = wire_protocol.decode_summary(wire_protocol.encode_summary("pi1", ROWS))
+  assert sensor == "pi1"
+  assert rows == [row[:12] + ("pi1", row[12]) for row in ROWS]
+  sensor, rows = wire_protocol.decode_summary(wire_protocol.encode_summary("pi1", ROWS), with_ids=True)
+  assert rows == ROWS
+  assert wire_protocol.decode_summary(wire_protocol.encode_summary("pi1", [])) == ("pi1", [])
+
+def test_bad_magic():
+  frame = bytearray(wire_protocol.encode_frame(wire_protocol.POLL, b"\x00"))
+  frame[:4] = b"HTTP"
+  with pytest.raises(wire_protocol.ProtocolError):
+    wire_protocol.decode_header(bytes(frame[:wire_protocol.HEADER.size]))
+  with pytest.raises(wire_protocol.ProtocolError):
+    wire_protocol.FrameBuffer().feed(bytes(frame))
+
+def test_bad_version():
+  frame = bytearray(wire_protocol.encode_frame(wire_protocol.POLL, b"\x00"))
+  frame[4] = wire_protocol.VERSION-1
+  with pytest.raises(wire_protocol.ProtocolError, match="version"):
+    wire_protocol.decode_header(bytes(frame[:wire_protocol.HEADER.size]))
+
+def test_oversized_frame():
+  header = wire_protocol.HEADER.pack(wire_protocol.MAGIC, wire_protocol.VERSION, wire_protocol.SUMMARY, 0, wire_protocol.MAX_PAYLOAD_SIZE+1)
+  with pytest.raises(wire_protocol.ProtocolError):
+    wire_protocol.decode_header(header)
+
+def test_truncated_frame():
+  frame = wire_protocol.encode_frame(wire_protocol.SUMMARY, wire_protocol.encode_summary("pi1", ROWS))
+  # a partial frame waits for the rest
+  buffer = wire_protocol.FrameBuffer()
+  assert buffer.feed(frame[:-1]) == []
+  assert len(buffer.feed(frame[-1:])) == 1
+  # a connection closed in the middle of a frame is an error, not a short message
+  left, right = socket.socketpair()
+  try:
+    left.sendall(frame[:-10])
+    left.close()
+    with pytest.raises(ConnectionError):
+      wire_protocol.recv_message(right)
+  finally:
+    right.close()
+
+def test_truncated_summary():
+  payload = wire_protocol.encode_summary("pi1", ROWS)
+  # cut inside the string table, inside a row, and on a row boundary
+  for size in (3, 20, len(payload)-5, len(payload)-wire_protocol.ROW.size):
+    with pytest.raises(wire_protocol.ProtocolError):
+      wire_protocol.decode_summary(payload[:size])
+  with pytest.raises(wire_protocol.ProtocolError):
+    wire_protocol.decode_summary(payload + b"\x00")
+
+def test_poll_acknowledges_received_id():
+  assert wire_protocol.decode_poll(wire_protocol.encode_poll(False, 42)) == (False, 42)
+  assert wire_protocol.decode_poll(wire_protocol.encode_poll(True, 0)) == (True, 0)
+  assert wire_protocol.decode_poll(wire_protocol.encode_poll()) == (False, None)
+  # a master from before acknowledgements only sends the flags
+  assert wire_protocol.decode_poll(struct.pack("!B", wire_protocol.POLL_RESYNC)) == (True, None)
@@ -0,0 +1,106 @@
+import socket
+import threading
+
+import pytest
+
+import db_pool
+import retention
+import wire_protocol
+import worker_poller
+
+TS = 1600000000.0
+
+def summary_row(i):
+  return (TS+i, TS+i+0.5, f"10.0.0.{i}", 1000+i, "10.0.0.254", 80, "TCP", 60, 60, 60, 1, 1)
+
+# a worker socket whose chosen SUMMARY frames only half make it to the master, like a reply in flight when the
+# connection drops: sendall returns, so the worker thinks it was sent
+class CutConnection():
+  def __init__(self, sock, cut):
+    self.sock = sock
+    self.cut = cut # summary frame numbers to cut, counted over every connection
+    self.summaries = cut.setdefault("sent", [0])
+
+  def sendall(self, data):
+    if data[5] == wire_protocol.SUMMARY:
+      self.summaries[0] += 1
+      if self.summaries[0] in self.cut["frames"]:
+        self.sock.sendall(data[:len(data)//2])
+        return
+    self.sock.sendall(data)
+
+  def __getattr__(self, name):
+    return getattr(self.sock, name)
+
+# worker_server on a local port, its sessions reading summ_table through a pool
+def start_worker(make_db_manager, summ_table, cut, hub=None):
+  worker_server = pytest.importorskip("worker_server")
+  local_pool = db_pool.DBManagerPool(make_db_manager, 2)
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(5)
+  ship_states = {}
+  ship_states_lock = threading.Lock()
+  def accept():
+    while True:
+      connection, address = listener.accept()
+      threading.Thread(target=worker_server.serve_master,
+                       args=(CutConnection(connection, cut), address, local_pool, None, None, summ_table, ship_states, ship_states_lock,
+                             "pi1", "none", hub),
+                       daemon=True).start()
+  threading.Thread(target=accept, daemon=True).start()
+  return listener
+
+def make_worker_table(db_manager, summ_table):
+  db_manager.create_summary_table(summ_table)
+  retention.RetentionManager(summ_table, "min_timestamp", 3600).prepare(db_manager, TS, TS+60)
+
+def received_ids(poller, rounds, wait=0):
+  ids = []
+  for i in range(rounds):
+    poller.poll(wait)
+    ids += [row[-1] for row in poller.take_summary_rows()]
+  return ids
+
+def test_cut_reply_is_sent_again_after_reconnecting(make_db_manager, summ_table):
+  db_manager = make_db_manager()
+  make_worker_table(db_manager, summ_table)
+  listener = start_worker(make_db_manager, summ_table, {"frames": (2,)})
+  poller = worker_poller.WorkerPoller(["127.0.0.1"], listener.getsockname()[1], timeout=0.5, min_backoff=0)
+  try:
+    db_manager.insert_summary_batch(summ_table, [summary_row(i) for i in range(1, 4)])
+    assert received_ids(poller, 1) == [1, 2, 3]
+    db_manager.insert_summary_batch(summ_table, [summary_row(i) for i in range(4, 7)])
+    # the second reply is cut, the master times out and reconnects, and gets rows 4 to 6 after all
+    assert received_ids(poller, 1) == []
+    assert poller.workers[0].state == "down"
+    assert received_ids(poller, 3) == [4, 5, 6]
+    assert poller.workers[0].failures == 1
+  finally:
+    for worker in poller.workers:
+      if worker.sock is not None:
+        worker.sock.close()
+    listener.close()
+
+def test_cut_push_is_sent_again_after_subscribing_again(make_db_manager, summ_table):
+  summary_publisher = pytest.importorskip("summary_publisher")
+  db_manager = make_db_manager()
+  make_worker_table(db_manager, summ_table)
+  hub = summary_publisher.SubscriberHub()
+  listener = start_worker(make_db_manager, summ_table, {"frames": (2,)}, hub)
+  poller = worker_poller.WorkerPoller(["127.0.0.1"], listener.getsockname()[1], timeout=0.5, min_backoff=0, mode="subscribe")
+  try:
+    db_manager.insert_summary_batch(summ_table, [summary_row(i) for i in range(1, 4)])
+    # the subscription catches up from the db first
+    assert received_ids(poller, 1, wait=0.3) == [1, 2, 3]
+    # rows 4 to 6 are published, and their push is cut
+    hub.publish(db_manager.insert_summary_batch(summ_table, [summary_row(i) for i in range(4, 7)], with_ids=True))
+    ids = received_ids(poller, 1, wait=1)
+    assert ids == []
+    assert poller.workers[0].failures == 1
+    assert received_ids(poller, 1, wait=0.5) == [4, 5, 6]
+  finally:
+    for worker in poller.workers:
+      if worker.sock is not None:
+        worker.sock.close()
+    listener.close()